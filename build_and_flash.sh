@@ -35,7 +35,7 @@ echo "Building Docker image (this may take a while)..."
 docker build --platform linux/amd64 -t $IMAGE_NAME . || { echo "Docker build failed"; exit 1; }
 
 echo "Building firmware..."
-docker run --rm --platform linux/amd64 -v "$PWD/$FIRMWARE_DIR:/firmware" $IMAGE_NAME || { echo "Firmware build failed"; exit 1; }
+docker run --rm --platform linux/amd64 -v "$PWD/$FIRMWARE_DIR:/firmware" -v "$PWD/$SOURCE_DIR:/source:ro" $IMAGE_NAME || { echo "Firmware build failed"; exit 1; }
 
 if [ ! -f "$FIRMWARE_DIR/firmware.bin" ]; then
     echo "ERROR: firmware.bin not found after build"
@@ -60,8 +60,12 @@ esptool.py --chip esp32 --port "$PORT" --baud 460800 write_flash -z 0x1000 "$FIR
 echo "Flashing complete. Waiting for device to boot..."
 sleep 5
 
-# Upload application files
+# Upload application files, compiled by the firmware build (firmware/app)
 echo "Uploading application files..."
+if [ ! -d "$FIRMWARE_DIR/app" ]; then
+    echo "ERROR: $FIRMWARE_DIR/app not found after build"
+    exit 1
+fi
 
 # Kill any mpremote/ampy processes that might hold the port
 pkill -f mpremote 2>/dev/null || true
@@ -69,7 +73,7 @@ sleep 1
 
 success=0
 fail=0
-for file in "$SOURCE_DIR"/*.py; do
+for file in "$FIRMWARE_DIR/app"/*; do
     [ -f "$file" ] || continue
     filename=$(basename "$file")
     echo -n "  $filename... "
@@ -136,7 +136,10 @@ sleep 5
 
 info "Step 3/3: Uploading application files..."
 fail_count=0
-for file in "$SOURCE_DIR"/*.py; do
+# The compiled app from build_and_flash.sh (firmware/app), else the sources
+APP_DIR="$SCRIPT_DIR/firmware/app"
+[ -d "$APP_DIR" ] || APP_DIR="$SOURCE_DIR"
+for file in "$APP_DIR"/*.py "$APP_DIR"/*.mpy; do
     if [ -f "$file" ]; then
         filename=$(basename "$file")
         echo -n "  $filename... "
@@ -0,0 +1,248 @@
+import uasyncio as asyncio
+import utime as time
+from micropython import const
+
+# Minimal asyncio MQTT 3.1.1 client with the same surface as umqtt.simple.
+# A reader task wakes on socket data and calls the callback as soon as a
+# PUBLISH arrives, instead of the caller polling check_msg() on a timer.
+
+_CONNECT = const(0x10)
+_CONNACK = const(0x20)
+_PUBLISH = const(0x30)
+_PUBACK = const(0x40)
+_SUBSCRIBE = const(0x82)
+_SUBACK = const(0x90)
+_PINGREQ = b"\xc0\x00"
+_DISCONNECT = b"\xe0\x00"
+
+
+class MQTTException(Exception):
+    pass
+
+
+def _str(s):
+    """MQTT length-prefixed UTF-8 string."""
+    if isinstance(s, str):
+        s = s.encode()
+    return bytes((len(s) >> 8, len(s) & 0xFF)) + s
+
+
+def _packet(first, body):
+    """Fixed header (type byte + remaining length varint) followed by body."""
+    n = len(body)
+    head = bytearray((first,))
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        head.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(head) + body
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=1883, keepalive=0):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.cb = None
+        self.lw = None  # (topic, msg, retain, qos)
+        self._r = None
+        self._w = None
+        self._task = None
+        self._pid = 0
+        self._acks = {}  # packet id -> Event, for SUBACK / PUBACK waiters
+        self._closed = asyncio.Event()
+        self.closed = True
+        self.error = None  # Exception that ended the last connection, if any
+        self.rx_tick = 0  # ticks_ms when the last packet started arriving
+        self.last_rx = 0  # ticks_ms of the last complete packet (any type)
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 1
+        assert topic
+        self.lw = (topic, msg, retain, qos)
+
+    def _next_pid(self):
+        self._pid = self._pid % 0xFFFF + 1
+        return self._pid
+
+    # --- Connection ---
+
+    async def connect(self, clean_session=True, timeout_s=10):
+        """Open the socket, send CONNECT and wait for CONNACK. Returns the
+        broker's session-present flag, like umqtt.simple."""
+        self._r, self._w = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), timeout_s
+        )
+        flags = 0x02 if clean_session else 0
+        payload = _str(self.client_id)
+        if self.lw:
+            topic, msg, retain, qos = self.lw
+            flags |= 0x04 | qos << 3 | (0x20 if retain else 0)
+            payload += _str(topic) + _str(msg)
+        body = (
+            b"\x00\x04MQTT\x04"
+            + bytes((flags, self.keepalive >> 8, self.keepalive & 0xFF))
+            + payload
+        )
+        self._w.write(_packet(_CONNECT, body))
+        await self._w.drain()
+
+        first, resp = await asyncio.wait_for(self._read_packet(), timeout_s)
+        if first != _CONNACK or len(resp) != 2:
+            raise MQTTException("bad CONNACK")
+        if resp[1] != 0:
+            raise MQTTException(resp[1])
+        self.closed = False
+        self.error = None
+        self._closed = asyncio.Event()
+        self.last_rx = time.ticks_ms()
+        self._task = asyncio.create_task(self._reader())
+        return resp[0] & 1
+
+    def disconnect(self):
+        """Send DISCONNECT (best effort) and close the socket."""
+        if not self.closed:
+            try:
+                self._w.write(_DISCONNECT)
+            except Exception:
+                pass
+        self.close()
+
+    def close(self):
+        """Drop the connection without DISCONNECT, so the broker sends the LWT."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            if self._w:
+                self._w.close()
+        except Exception:
+            pass
+        self._r = self._w = None
+        self.closed = True
+        self._closed.set()
+        for ev in self._acks.values():
+            ev.set()  # Wake waiters; they see the connection is gone
+
+    async def wait_closed(self):
+        """Return once the connection has been lost or closed."""
+        await self._closed.wait()
+
+    # --- Outgoing ---
+
+    def _write(self, data):
+        if self.closed:
+            raise OSError("MQTT not connected")
+        self._w.write(data)
+
+    async def drain(self):
+        if not self.closed:
+            await self._w.drain()
+
+    def ping(self):
+        self._write(_PINGREQ)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        """Queue a PUBLISH on the socket. For qos=1 the packet id is returned;
+        await published(pid) to wait for the PUBACK."""
+        assert 0 <= qos <= 1
+        if isinstance(msg, str):
+            msg = msg.encode()
+        pid = 0
+        body = _str(topic)
+        if qos:
+            pid = self._next_pid()
+            self._acks[pid] = asyncio.Event()
+            body += bytes((pid >> 8, pid & 0xFF))
+        self._write(_packet(_PUBLISH | qos << 1 | (1 if retain else 0), body + msg))
+        return pid
+
+    async def published(self, pid, timeout_s=10):
+        """Wait for the PUBACK of a qos=1 publish. True if acknowledged."""
+        return await self._ack(pid, timeout_s)
+
+    async def subscribe(self, topic, qos=0, timeout_s=10):
+        """Subscribe and wait for the SUBACK."""
+        pid = self._next_pid()
+        self._acks[pid] = asyncio.Event()
+        body = bytes((pid >> 8, pid & 0xFF)) + _str(topic) + bytes((qos,))
+        self._write(_packet(_SUBSCRIBE, body))
+        await self._w.drain()
+        if not await self._ack(pid, timeout_s):
+            raise MQTTException("no SUBACK for %s" % topic)
+
+    async def _ack(self, pid, timeout_s):
+        ev = self._acks.get(pid)
+        if ev is None:
+            return True  # Acknowledged before we started waiting
+        try:
+            await asyncio.wait_for(ev.wait(), timeout_s)
+        except asyncio.TimeoutError:
+            pass
+        self._acks.pop(pid, None)
+        return ev.is_set() and not self.closed
+
+    # --- Incoming ---
+
+    async def _read_packet(self):
+        """Read one packet; returns (first byte, body)."""
+        first = (await self._r.readexactly(1))[0]
+        self.rx_tick = time.ticks_ms()
+        n = 0
+        shift = 0
+        while True:
+            b = (await self._r.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        body = await self._r.readexactly(n) if n else b""
+        self.last_rx = time.ticks_ms()
+        return first, body
+
+    async def _reader(self):
+        try:
+            while True:
+                first, body = await self._read_packet()
+                kind = first & 0xF0
+                if kind == _PUBLISH:
+                    self._on_publish(first, body)
+                elif kind == _PUBACK or kind == _SUBACK:
+                    if len(body) < 2:
+                        raise MQTTException("short ack")
+                    ev = self._acks.pop(body[0] << 8 | body[1], None)
+                    if ev:
+                        ev.set()
+                # PINGRESP only needs to refresh last_rx
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("MQTT: connection lost:", e)
+            self.error = e
+        self._task = None
+        self.close()
+
+    def _on_publish(self, first, body):
+        n = body[0] << 8 | body[1]
+        topic = body[2 : 2 + n]
+        i = 2 + n
+        pid = 0
+        if first & 0x06:
+            pid = body[i] << 8 | body[i + 1]
+            i += 2
+        try:
+            if self.cb:
+                self.cb(topic, body[i:])
+        except Exception as e:
+            # A bad command must not take the connection down with it
+            print("MQTT: callback error:", e)
+            import sys
+
+            sys.print_exception(e)
+        if pid and not self.closed:
+            self._write(bytes((_PUBACK, 2, pid >> 8, pid & 0xFF)))
@@ -0,0 +1,25 @@
+import random
+
+# Exponential backoff with "equal jitter": the ceiling doubles per attempt up
+# to a cap, and each delay is half the ceiling plus a random part of the
+# other half. Devices that lost the same broker at the same moment then
+# spread their retries over the window instead of arriving together, while
+# no delay drops to near zero.
+
+
+class Backoff:
+    def __init__(self, base_ms, cap_ms):
+        self.base = base_ms
+        self.cap = cap_ms
+        self.attempts = 0  # Delays handed out since the last reset()
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        """Delay in ms before the next attempt."""
+        ceiling = min(self.cap, self.base << min(self.attempts, 16))
+        self.attempts += 1
+        half = ceiling // 2
+        # 10 random bits keep the product a small int on the device
+        return half + ((ceiling - half) * random.getrandbits(10) >> 10)
@@ -7,7 +7,7 @@ from utils import (
     led_toggle,
     set_wifi,
     get_mac,
-    monitor_reset_button,
+    start_reset_button,
     ntfy_alert,
 )  # Custom utility functions
 import machine  # Hardware control
@@ -124,8 +124,8 @@ async def run_ble(cached_networks=None):
     Args:
         cached_networks: Pre-scanned WiFi networks from boot
     """
-    # Start factory reset button monitoring in background
-    asyncio.create_task(monitor_reset_button())
+    # Factory reset button (a pin IRQ; nothing to poll)
+    start_reset_button()
 
     while True:
         # Create BLE service and characteristics
@@ -1,8 +1,9 @@
-import usocket as socket
 import ssl
 import time
-from struct import pack, unpack
+import uasyncio as asyncio
+from struct import pack_into, unpack_from
 import gc
+from micropython import const
 
 # Chromecast Configuration
 # Note: Using byte strings (b"...") is common and efficient in MicroPython
@@ -16,19 +17,100 @@ _RECV = b"receiver-0"
 _NS_CONN = b"urn:x-cast:com.google.cast.tp.connection"
 _NS_RECV = b"urn:x-cast:com.google.cast.receiver"
 _NS_MEDIA = b"urn:x-cast:com.google.cast.media"
+_NS_HEARTBEAT = b"urn:x-cast:com.google.cast.tp.heartbeat"
 
 # App ID for the Default Media Receiver (used for audio/video streaming)
 _DEFAULT_MEDIA_APP_ID = b"CC1AD845"
 
+# Connection pool: warm sessions kept open between plays, keyed by (ip, port)
+_POOL_MAX = const(2)  # Max parked sessions (each TLS session holds ~40KB)
+_POOL_IDLE_MS = const(300000)  # Close sessions unused for 5 minutes
+_POOL_MIN_FREE = const(50000)  # Heap headroom to keep for a cold TLS handshake
+_pool = {}
+_watched = []  # Sessions held open outside the pool (a playlist being followed)
 
-def _varint(n):
-    """Minimal protobuf varint encoder (bytes)."""
-    out = bytearray()
+# Group play: cold sessions opened at once must fit in the SSL memory budget
+_TLS_SESSION_COST = const(40000)  # Estimate until connect() has measured one
+_session_cost = 0  # Heap one open TLS session took on this device (largest seen)
+_GROUP_SSL_BUDGET = const(90000)  # Default heap we let a group play spend on TLS
+_GROUP_RESERVE = const(30000)  # Heap kept free for MQTT and JSON while casting
+_handshake_lock = None  # Serialises TLS handshakes (created on first use)
+
+# Receive buffer per session; larger frames are drained without being stored
+_RX_SIZE = const(4096)
+_MAX_FRAME = const(65536)  # Anything bigger means the stream is out of sync
+_HEAD_SIZE = const(128)  # Enough for source, destination and namespace
+
+
+# Frame encoder: every outgoing frame is written into one preallocated buffer
+_TX_SIZE = const(1024)  # Largest frame we send (LOAD with a long media URL)
+_tx = bytearray(_TX_SIZE)
+_txv = memoryview(_tx)
+
+
+def _varint_len(n):
+    """Number of bytes the protobuf varint encoding of n takes."""
+    size = 1
+    while n > 0x7F:
+        n >>= 7
+        size += 1
+    return size
+
+
+def _put_varint(buf, i, n):
+    """Write a protobuf varint into buf at offset i, return the new offset."""
     while n > 0x7F:
-        out.append((n & 0x7F) | 0x80)
+        buf[i] = (n & 0x7F) | 0x80
         n >>= 7
-    out.append(n)
-    return bytes(out)
+        i += 1
+    buf[i] = n
+    return i + 1
+
+
+def _put_field(buf, i, tag, data):
+    """Write a length-delimited protobuf field, return the new offset."""
+    buf[i] = tag
+    i = _put_varint(buf, i + 1, len(data))
+    buf[i : i + len(data)] = data
+    return i + len(data)
+
+
+def _encode(namespace, parts, dest=_RECV, src=_SRC, buf=_txv):
+    """
+    Encode a CastMessage frame (4-byte length + protobuf body) into buf, the
+    shared transmit buffer by default, without building temporaries. The
+    payload is the concatenation of parts, so templates only need the variable
+    pieces spliced in. Returns a memoryview of the frame, valid until the next
+    _encode() into the same buffer.
+    """
+    plen = 0
+    for part in parts:
+        plen += len(part)
+    size = (
+        2  # protocol_version
+        + 1 + _varint_len(len(src)) + len(src)
+        + 1 + _varint_len(len(dest)) + len(dest)
+        + 1 + _varint_len(len(namespace)) + len(namespace)
+        + 2  # payload_type
+        + 1 + _varint_len(plen) + plen
+    )
+    if size + 4 > len(buf):
+        raise ValueError("cast frame too large: %d" % size)
+
+    pack_into(">I", buf, 0, size)
+    buf[4] = 0x08  # protocol_version = 0
+    buf[5] = 0x00
+    i = _put_field(buf, 6, 0x12, src)  # source_id
+    i = _put_field(buf, i, 0x1A, dest)  # destination_id
+    i = _put_field(buf, i, 0x22, namespace)  # namespace
+    buf[i] = 0x28  # payload_type = STRING (0)
+    buf[i + 1] = 0x00
+    buf[i + 2] = 0x32  # payload_utf8
+    i = _put_varint(buf, i + 3, plen)
+    for part in parts:
+        buf[i : i + len(part)] = part
+        i += len(part)
+    return buf[:i]
 
 
 def _frame(namespace, payload_utf8, dest=_RECV, src=_SRC):
@@ -41,84 +123,304 @@ def _frame(namespace, payload_utf8, dest=_RECV, src=_SRC):
         dest = dest.encode()
     if isinstance(payload_utf8, str):
         payload_utf8 = payload_utf8.encode()
-
-    # Protobuf body fields
-    body = (
-        b"\x08\x00"  # protocol_version = 0
-        + b"\x12"
-        + _varint(len(src))
-        + src  # source_id
-        + b"\x1a"
-        + _varint(len(dest))
-        + dest  # destination_id
-        + b"\x22"
-        + _varint(len(namespace))
-        + namespace  # namespace
-        + b"\x28\x00"  # payload_type = STRING (0)
-        + b"\x32"
-        + _varint(len(payload_utf8))
-        + payload_utf8  # payload_utf8
-    )
-    # Prepend 4-byte big-endian length of the body
-    return pack(">I", len(body)) + body
+    # Headroom for the length prefix, tags and varints
+    n = len(namespace) + len(payload_utf8) + len(dest) + len(src) + 32
+    buf = _txv if n <= _TX_SIZE else memoryview(bytearray(n))
+    return bytes(_encode(namespace, (payload_utf8,), dest, src, buf))
+
+
+# Pre-encoded frames that never change
+_CONNECT = _frame(_NS_CONN, b'{"type":"CONNECT"}')
+_GET_STATUS = _frame(_NS_RECV, b'{"type":"GET_STATUS","requestId":1}')
+_LAUNCH = _frame(
+    _NS_RECV,
+    b'{"type":"LAUNCH","appId":"' + _DEFAULT_MEDIA_APP_ID + b'","requestId":3}',
+)
+_PONG = _frame(_NS_HEARTBEAT, b'{"type":"PONG"}')
+
+# Payload templates; only the URL, volume and transport ID are spliced in
+_P_CONNECT = (b'{"type":"CONNECT"}',)
+_P_MEDIA_STATUS = (b'{"type":"GET_STATUS","requestId":4}',)
+_P_VOLUME = (b'{"type":"SET_VOLUME","volume":{"level":', b'},"requestId":2}')
+_P_MEDIA = (
+    b'{"media":{"contentId":"',
+    b'","streamType":"BUFFERED","contentType":"audio/mp3","metadata":'
+    b'{"metadataType":0,"title":"Bilal Cast","thumb":"'
+    + THUMB
+    + b'","images":[{"url":"'
+    + THUMB
+    + b'"}]}}',
+)
+_P_LOAD = (
+    _P_MEDIA[0],
+    _P_MEDIA[1]
+    + b',"type":"LOAD","autoplay":true,"customData":{},"requestId":5,"sessionId":"',
+    b'"}',
+)
+_P_QUEUE = (
+    b'{"type":"QUEUE_LOAD","requestId":6,"startIndex":0,'
+    b'"repeatMode":"REPEAT_OFF","items":[',
+    b',"autoplay":true,"preloadTime":',
+    b"]}",
+)
+
+# Playlists: the speaker buffers the next item this many seconds before the
+# current one ends, so items follow each other without a gap
+_PRELOAD_S = const(10)
+_QUEUE_MAX = const(5)  # MEDIA_STATUS lists every queued item; keep it in _RX_SIZE
+
+
+def _load_frame(url, transport_id, preload_s=None):
+    """
+    Encode LOAD for a single URL, or QUEUE_LOAD when url is a list of URLs
+    (played in order, each preloaded preload_s seconds ahead).
+    """
+    if isinstance(url, (list, tuple)) and len(url) == 1:
+        url = url[0]
+    if isinstance(url, (list, tuple)):
+        if len(url) > _QUEUE_MAX:
+            raise ValueError("playlist too long: %d items" % len(url))
+        preload = str(_PRELOAD_S if preload_s is None else preload_s).encode()
+        parts = [_P_QUEUE[0]]
+        for i, item in enumerate(url):
+            parts.append(_P_MEDIA[0] if i == 0 else b"," + _P_MEDIA[0])
+            parts.append(item.encode() if isinstance(item, str) else item)
+            parts.append(_P_MEDIA[1] + _P_QUEUE[1])
+            parts.append(preload + b"}")
+        parts.append(_P_QUEUE[2])
+    else:
+        if isinstance(url, str):
+            url = url.encode()
+        parts = (_P_LOAD[0], url, _P_LOAD[1], transport_id, _P_LOAD[2])
+    n = len(transport_id) + 128  # Header fields, tags and varints
+    for part in parts:
+        n += len(part)
+    buf = _txv if n <= _TX_SIZE else memoryview(bytearray(n))
+    return _encode(_NS_MEDIA, parts, dest=transport_id, buf=buf)
+
+
+def _eq(buf, b):
+    """Compare a memoryview with bytes without copying (from the end, since
+    Cast namespaces share a long common prefix)."""
+    n = len(b)
+    if len(buf) != n:
+        return False
+    for i in range(n - 1, -1, -1):
+        if buf[i] != b[i]:
+            return False
+    return True
+
+
+def _find(buf, b, i=0):
+    """buf.find(b, i) for a memoryview, which has no find(): index of the
+    first b in buf at or after i, or -1. Allocates nothing."""
+    first = b[0]
+    n = len(b)
+    for i in range(i, len(buf) - n + 1):
+        if buf[i] == first:
+            j = 1
+            while j < n and buf[i + j] == b[j]:
+                j += 1
+            if j == n:
+                return i
+    return -1
+
+
+def _get_varint(buf, i):
+    """Read a protobuf varint from buf at offset i, return (value, new offset)."""
+    n = 0
+    shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def _decode(buf):
+    """
+    Decode CastMessage fields 2-6 from a protobuf body. Returns memoryviews
+    (source, destination, namespace, payload); fields that run past the end
+    of buf (e.g. when only the header was read) are None.
+    """
+    src = dst = ns = payload = None
+    i = 0
+    n = len(buf)
+    try:
+        while i < n:
+            key, i = _get_varint(buf, i)
+            wire = key & 7
+            if wire == 0:  # protocol_version, payload_type
+                i = _get_varint(buf, i)[1]
+                continue
+            if wire != 2:
+                raise OSError("unexpected cast field: %d" % key)
+            size, i = _get_varint(buf, i)
+            if i + size > n:
+                break
+            field = key >> 3
+            if field == 2:
+                src = buf[i : i + size]
+            elif field == 3:
+                dst = buf[i : i + size]
+            elif field == 4:
+                ns = buf[i : i + size]
+            elif field == 6:
+                payload = buf[i : i + size]
+            i += size
+    except IndexError:
+        pass  # Truncated varint at the end of a header-only read
+    return src, dst, ns, payload
 
 
-class Chromecast(object):
-    """A class to handle Chromecast communication and media control."""
+_APP_ID_QUOTED = b'"' + _DEFAULT_MEDIA_APP_ID + b'"'
 
-    def __init__(self, cast_ip, cast_port, timeout_s=5):
-        self.ip = cast_ip
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.settimeout(timeout_s)
-        self.s = None
 
-        try:
-            # Connect and wrap socket with SSL
-            self._sock.connect((self.ip, cast_port))
-            self.s = ssl.wrap_socket(self._sock)
+def _value(payload, key):
+    """
+    Return a copy of the raw value following key (e.g. b'"idleReason":') in
+    a JSON payload: the contents of a string, or the digits of a number.
+    None if the key is absent.
+    """
+    i = _find(payload, key)
+    if i == -1:
+        return None
+    i += len(key)
+    if i < len(payload) and payload[i] == 0x22:  # '"'
+        j = _find(payload, b'"', i + 1)
+        return bytes(payload[i + 1 : j]) if j != -1 else None
+    j = i
+    while j < len(payload) and 0x30 <= payload[j] <= 0x39:
+        j += 1
+    return bytes(payload[i:j]) if j > i else None
+
+
+def _transport_id(payload):
+    """Return the Default Media Receiver's transportId from a RECEIVER_STATUS
+    payload, or None if that app is not running."""
+    # CRITICAL FIX: Only take the transportId inside the Default Media
+    # Receiver's own application entry, never another app's session
+    i = _find(payload, _APP_ID_QUOTED)
+    if i == -1:
+        return None
+    key = b'"transportId":"'
+    j = _find(payload, key, i)
+    if j == -1:
+        return None
+    nxt = _find(payload, b'"appId"', i)
+    if nxt != -1 and nxt < j:
+        return None
+    j += len(key)
+    k = _find(payload, b'"', j)
+    if k == -1:
+        return None
+    return bytes(payload[j:k])
 
-            # Send initial CONNECT and GET_STATUS messages
-            self._send(_frame(_NS_CONN, b'{"type":"CONNECT"}'))
-            self._send(_frame(_NS_RECV, b'{"type":"GET_STATUS","requestId":1}'))
 
-            # After handshake, use shorter timeout for message polling
-            self._sock.settimeout(3)
-        except Exception:
-            self.disconnect()
-            raise
+class CastSession(object):
+    """
+    Session state and CastV2 namespace handlers. Subclasses supply the
+    transport: _send() to queue a frame and a pump that reads frames and
+    passes each payload to the handler _handler() returns for its namespace.
+    """
 
-    # --- Low-Level Socket Operations (for MicroPython reliability) ---
+    def __init__(self, cast_ip, cast_port):
+        self.ip = cast_ip
+        self.port = cast_port
+        self.last_used = self._ticks_ms()
+        self._status_requested = False
+        self._rx = bytearray(_RX_SIZE)
+        self._rxv = memoryview(self._rx)
+
+        # Session state, updated by the namespace handlers as frames arrive
+        self.closed = False
+        self.transport_id = None
+        self.media_confirmed = False
+        self._receiver_status = False
+        self.timings = {}  # Per-phase milliseconds for the last play
+        self._load_tick = 0
+        self._start_queue(0)
+        self._handlers = (
+            (_NS_HEARTBEAT, self._on_heartbeat),
+            (_NS_RECV, self._on_receiver),
+            (_NS_MEDIA, self._on_media),
+            (_NS_CONN, self._on_connection),
+        )
 
-    def _send(self, data):
-        """Send all data on SSL sockets (handles partial writes)."""
-        mv = memoryview(data)
-        total = 0
-        while total < len(data):
-            n = self.s.write(mv[total:])
-            if n is None:
-                # Some MicroPython ports return None; treat as all written
-                break
-            total += n
+    def _handler(self, ns):
+        for name, fn in self._handlers:
+            if _eq(ns, name):
+                return fn
+        return None
 
-    def _read_exact(self, n):
-        """Read exactly n bytes or raise (handles partial reads)."""
-        chunks = bytearray()
-        got = 0
-        while got < n:
-            chunk = self.s.read(n - got)
-            if not chunk:
-                raise OSError("socket closed while reading")
-            chunks.extend(chunk)
-            got += len(chunk)
-        return bytes(chunks)
-
-    def read_message(self, max_size=65536):
-        """Read one Cast message (4-byte size + protobuf body)."""
-        size_bytes = self._read_exact(4)
-        siz = unpack(">I", size_bytes)[0]
-        if siz <= 0 or siz > max_size:
-            raise OSError("invalid cast frame size: %d" % siz)
-        return self._read_exact(siz)
+    # --- Namespace Handlers ---
+    # payload is a memoryview into the receive buffer, reused by the next
+    # frame: handlers parse it during the call and copy only what they keep.
+
+    def _on_heartbeat(self, src, payload):
+        if _find(payload, b'"PING"') != -1:
+            self._send(_PONG)
+
+    def _on_receiver(self, src, payload):
+        if _find(payload, b'"type":"RECEIVER_STATUS"') != -1:
+            self.transport_id = _transport_id(payload)
+            self._receiver_status = True
+
+    def _on_media(self, src, payload):
+        # Only our own media session counts, not another sender's app
+        if not self.transport_id or not _eq(src, self.transport_id):
+            return
+        if (
+            _find(payload, b'"type":"MEDIA_STATUS"') != -1
+            and _find(payload, b'"Bilal Cast"') != -1
+        ):
+            self.media_confirmed = True
+        if len(self.items) < self.queue_len:
+            self._track_queue(payload)
+
+    # --- Playlist Progress ---
+
+    def _start_queue(self, length):
+        """Reset per-item progress before a LOAD (length 0) or QUEUE_LOAD."""
+        self.queue_len = length
+        self.items = []  # idleReason per finished item: FINISHED, ERROR, ...
+        self._item_id = None
+        self._item_over = False
+
+    def _track_queue(self, payload):
+        """Follow a playlist through MEDIA_STATUS: an item is over when the
+        speaker moves on to the next itemId or goes IDLE with a reason."""
+        item_id = _value(payload, b'"currentItemId":')
+        if item_id is not None and item_id != self._item_id:
+            if self._item_id is not None:
+                self._end_item(b"FINISHED")
+            self._item_id = item_id
+            self._item_over = False
+        if _find(payload, b'"playerState":"IDLE"') == -1:
+            return
+        reason = _value(payload, b'"idleReason":')
+        if reason is None:
+            return
+        self._end_item(reason)
+        if reason == b"INTERRUPTED" or reason == b"CANCELLED":
+            # Another LOAD or a STOP replaced the queue; the rest never plays
+            while len(self.items) < self.queue_len:
+                self.items.append(reason.decode())
+
+    def _end_item(self, reason):
+        if not self._item_over and len(self.items) < self.queue_len:
+            self._item_over = True
+            self.items.append(reason.decode())
+
+    def _on_connection(self, src, payload):
+        if _find(payload, b'"CLOSE"') == -1:
+            return
+        if _eq(src, _RECV):
+            self.closed = True
+        elif self.transport_id and _eq(src, self.transport_id):
+            self.transport_id = None
 
     # --- Utility Methods for Time (MicroPython compatibility) ---
 
@@ -146,120 +448,497 @@ class Chromecast(object):
         else:
             v = str(volume)
 
-        payload = (
-            b'{"type":"SET_VOLUME","volume":{"level":'
-            + v.encode()
-            + b'},"requestId":2}'
+        self._send(
+            _encode(_NS_RECV, (_P_VOLUME[0], v.encode(), _P_VOLUME[1]), dest=_RECV)
         )
-        self._send(_frame(_NS_RECV, payload, dest=_RECV))
 
-    def play_url(self, url, volume=None):
-        """Play audio from specified URL on the Chromecast.
 
-        Args:
-            url: The media URL to play
-            volume: Optional volume level (0.0 to 1.0). If None, volume is not changed.
-        """
-        if isinstance(url, str):
-            url_b = url.encode()
-        else:
-            url_b = url
+def _ssl_context():
+    """TLS client context; Cast receivers present self-signed certificates."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if hasattr(ctx, "check_hostname"):
+        ctx.check_hostname = False  # CPython only
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
 
-        # 1. Launch the Default Media Receiver app
-        self._send(
-            _frame(
-                _NS_RECV,
-                b'{"type":"LAUNCH","appId":"'
-                + _DEFAULT_MEDIA_APP_ID
-                + b'","requestId":3}',
+
+class AsyncChromecast(CastSession):
+    """
+    Non-blocking Chromecast client for uasyncio. A reader task pumps frames
+    into the namespace handlers as soon as the socket is readable (answering
+    heartbeats while idle), and waiters are woken by an Event instead of
+    sleep-polling. Create with ``await connect(ip, port)``.
+    """
+
+    def __init__(self, cast_ip, cast_port):
+        CastSession.__init__(self, cast_ip, cast_port)
+        self._r = self._w = None
+        self._task = None
+        self._changed = asyncio.Event()
+
+    async def open(self, timeout_s=5):
+        """Connect, start TLS and send the initial CONNECT and GET_STATUS."""
+        try:
+            start = self._ticks_ms()
+            self._r, self._w = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port, ssl=_ssl_context()),
+                timeout_s,
             )
-        )
+            mark = self._ticks_ms()
+            self.timings["tcp"] = self._ticks_diff(mark, start)
+            # MicroPython runs the TLS handshake lazily on the first write
+            self._send(_CONNECT)
+            self._send(_GET_STATUS)
+            self._status_requested = True
+            await asyncio.wait_for(self._w.drain(), timeout_s)
+            self.timings["tls"] = self._ticks_diff(self._ticks_ms(), mark)
+        except asyncio.TimeoutError:
+            self.disconnect()
+            raise OSError("ETIMEDOUT: no answer from %s:%s" % (self.ip, self.port))
+        except Exception:
+            self.disconnect()
+            raise
+        self._task = asyncio.create_task(self._reader())
 
-        # 2. Wait for the new session's transport ID
-        transport_id = self._wait_for_transport_id(timeout_ms=8000)
-        if not transport_id:
-            print("Error: Failed to get transport ID for new session.")
-            return False
+    # --- Low-Level Stream Operations ---
 
-        # 3. Connect to the media session transport
-        self._send(_frame(_NS_CONN, b'{"type":"CONNECT"}', dest=transport_id))
+    def _send(self, data):
+        """Queue data on the stream; the stream copies it, so shared buffers
+        can be reused immediately. Call _flush() to wait until it is sent."""
+        self._w.write(data)
 
-        # 4. Set volume AFTER app is running (before loading media)
-        if volume is not None:
-            self.set_volume(volume)
-            time.sleep(0.3)  # Let volume settle before loading media
-            print(f"Volume set to {volume} after app launch")
+    async def _flush(self):
+        await self._w.drain()
 
-        self._send(
-            _frame(_NS_MEDIA, b'{"type":"GET_STATUS","requestId":4}', dest=transport_id)
-        )
+    async def _read_into(self, mv):
+        """Fill mv completely from the stream (handles partial reads)."""
+        got = 0
+        n = len(mv)
+        while got < n:
+            k = await self._r.readinto(mv[got:])
+            if k is None:
+                continue  # TLS record not complete yet
+            if not k:
+                self.closed = True
+                raise OSError("socket closed while reading")
+            got += k
 
-        # 5. Construct and send the LOAD command
-        load_payload = (
-            b'{"media":{"contentId":"'
-            + url_b
-            + b'","streamType":"BUFFERED","contentType":"audio/mp3","metadata":'
-            b'{"metadataType":0,"title":"Bilal Cast","thumb":"'
-            + THUMB
-            + b'","images":[{"url":"'
-            + THUMB
-            + b'"}]}},'
-            b'"type":"LOAD","autoplay":true,"customData":{},"requestId":5,"sessionId":"'
-            + transport_id
-            + b'"}'
-        )
-        self._send(_frame(_NS_MEDIA, load_payload, dest=transport_id))
+    async def _drain(self, n):
+        """Discard n bytes from the stream, reusing the receive buffer."""
+        while n > 0:
+            k = min(n, _RX_SIZE)
+            await self._read_into(self._rxv[:k])
+            n -= k
 
-        # 6. Wait for MEDIA_STATUS confirmation with timeout
+    async def _pump(self):
+        """
+        Read one frame and hand its payload (a slice of the receive buffer)
+        to the handler for its namespace. Only the header is read first; frames for namespaces
+        without a handler (or too big for the buffer) are drained without
+        being decoded.
+        """
+        rx = self._rxv
+        await self._read_into(rx[:4])
+        siz = unpack_from(">I", self._rx)[0]
+        if siz <= 0 or siz > _MAX_FRAME:
+            raise OSError("invalid cast frame size: %d" % siz)
+
+        got = min(siz, _HEAD_SIZE)
+        await self._read_into(rx[:got])
+        src, _, ns, payload = _decode(rx[:got])
+        handler = None
+        if ns is not None:
+            handler = self._handler(ns)
+            if handler is None or siz > _RX_SIZE:
+                await self._drain(siz - got)
+                return
+        elif siz > _RX_SIZE:
+            await self._drain(siz - got)
+            return
+
+        if siz > got:
+            await self._read_into(rx[got:siz])
+            src, _, ns, payload = _decode(rx[:siz])
+        if handler is None and ns is not None:
+            handler = self._handler(ns)
+        if handler is not None and src is not None and payload is not None:
+            handler(src, payload)
+
+    async def _reader(self):
+        """Background task: dispatch frames until the session closes."""
+        try:
+            while not self.closed:
+                await self._pump()
+                await self._flush()  # e.g. a PONG queued by the handler
+                self._changed.set()
+        except Exception as e:
+            if not self.closed:
+                print("Cast: %s:%s reader stopped: %s" % (self.ip, self.port, e))
+        self.closed = True
+        self._changed.set()
+
+    async def _wait(self, done, timeout_ms):
+        """Sleep until done() is true; False on timeout or close."""
         start = self._ticks_ms()
-        timeout_ms = 8000  # 8 seconds total for confirmation
-        while self._ticks_diff(self._ticks_ms(), start) < timeout_ms:
+        while not done():
+            remaining = timeout_ms - self._ticks_diff(self._ticks_ms(), start)
+            if self.closed or remaining <= 0:
+                return False
+            self._changed.clear()
             try:
-                status = self.read_message()
-            except OSError:
-                time.sleep(0.3)
-                continue  # Retry on socket timeout, don't give up
-            if b'"type":"MEDIA_STATUS"' in status and b'"Bilal Cast"' in status:
-                return True
-            time.sleep(0.2)  # Brief delay to avoid busy-looping
+                await asyncio.wait_for(self._changed.wait(), remaining / 1000)
+            except asyncio.TimeoutError:
+                pass
+        return True
 
-        return False
+    # --- Core Chromecast Methods ---
 
-    def _wait_for_transport_id(self, timeout_ms=4000):
+    async def prepare(self, volume=None):
         """
-        Wait for a message containing a transportId associated with the launched App ID.
-        This is the fix for session ID confusion.
+        Attach to the Default Media Receiver (launching it only if it is not
+        already running), connect to its transport and set the volume, so a
+        following load() starts playback in one round trip.
+        Returns the transport ID, or None on failure.
         """
         start = self._ticks_ms()
-        key = b'"transportId":"'
+        transport_id = await self._running_transport_id()
+        mark = self._ticks_ms()
+        self.timings["status"] = self._ticks_diff(mark, start)
+        if transport_id:
+            print("Default Media Receiver already running, skipping LAUNCH")
+            self.timings["launch"] = 0
+        else:
+            self._send(_LAUNCH)
+            await self._flush()
+            transport_id = await self._wait_for_transport_id(timeout_ms=8000)
+            self.timings["launch"] = self._ticks_diff(self._ticks_ms(), mark)
+        if not transport_id:
+            print("Error: Failed to get transport ID for new session.")
+            return None
 
-        while self._ticks_diff(self._ticks_ms(), start) < timeout_ms:
-            try:
-                msg = self.read_message()
-            except OSError:
-                time.sleep(0.3)
-                continue  # Don't abort on single socket timeout
-
-            # CRITICAL FIX: Ensure the message is for the Default Media Receiver app
-            if _DEFAULT_MEDIA_APP_ID in msg:
-                i = msg.find(key)
-                if i != -1:
-                    j = msg.find(b'"', i + len(key))
-                    if j != -1:
-                        # transportId found and confirmed to be for the newly launched app
-                        return msg[i + len(key) : j]
+        self._send(_encode(_NS_CONN, _P_CONNECT, dest=transport_id))
+        if volume is not None:
+            self.set_volume(volume)
+            await self._flush()
+            await asyncio.sleep(0.3)  # Let volume settle before loading media
+            print(f"Volume set to {volume} after app launch")
+        self._send(_encode(_NS_MEDIA, _P_MEDIA_STATUS, dest=transport_id))
+        await self._flush()
+        return transport_id
+
+    async def load(self, url, preload_s=None):
+        """Send LOAD (or QUEUE_LOAD for a list of URLs) on the prepared media
+        session. Returns False if the session is gone."""
+        transport_id = self.transport_id
+        if not transport_id or self.closed:
+            return False
+        self.media_confirmed = False
+        self._start_queue(len(url) if isinstance(url, (list, tuple)) else 0)
+        self._load_tick = self._ticks_ms()
+        self._send(_load_frame(url, transport_id, preload_s))
+        await self._flush()
+        return True
+
+    async def confirmed(self, timeout_ms=8000):
+        """Wait for the MEDIA_STATUS confirming our LOAD."""
+        ok = await self._wait(lambda: self.media_confirmed, timeout_ms)
+        self.timings["load"] = self._ticks_diff(self._ticks_ms(), self._load_tick)
+        return ok
+
+    async def item_done(self, index, timeout_ms):
+        """
+        Wait until playlist item index has finished. Returns its idleReason
+        (FINISHED, ERROR, INTERRUPTED, ...) or None on timeout or close.
+        """
+        if await self._wait(lambda: len(self.items) > index, timeout_ms):
+            return self.items[index]
+        return None
 
+    async def play_url(self, url, volume=None, preload_s=None):
+        """Play audio from specified URL on the Chromecast.
+
+        Args:
+            url: The media URL to play, or a list of URLs to queue in order
+            volume: Optional volume level (0.0 to 1.0). If None, volume is not changed.
+            preload_s: For a list, seconds before an item ends to buffer the next
+        """
+        if not await self.prepare(volume):
+            return False
+        if not await self.load(url, preload_s):
+            return False
+        return await self.confirmed()
+
+    async def _running_transport_id(self, timeout_ms=2000):
+        """
+        Read the RECEIVER_STATUS answering GET_STATUS and return the transportId
+        of the Default Media Receiver if it is already running, else None.
+        """
+        if not self._status_requested:
+            self._send(_GET_STATUS)
+            await self._flush()
+        self._status_requested = False
+        self._receiver_status = False
+        self.transport_id = None
+
+        if await self._wait(lambda: self._receiver_status, timeout_ms):
+            return self.transport_id
+        return None  # No status yet; launching is the safe default
+
+    async def _wait_for_transport_id(self, timeout_ms=4000):
+        """
+        Wait for a RECEIVER_STATUS listing a transportId for the launched App ID.
+        This is the fix for session ID confusion.
+        """
+        if await self._wait(lambda: self.transport_id, timeout_ms):
+            return self.transport_id
         return None
 
+    def service(self):
+        """The reader task answers heartbeats; just report liveness."""
+        return not self.closed
+
     def disconnect(self):
-        """Close the connection to the Chromecast device."""
+        """Stop the reader task and close the stream."""
+        self.closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
         try:
-            if self.s:
-                self.s.close()
-        finally:
-            try:
-                self._sock.close()
-            except Exception:
-                pass
-        # Perform garbage collection if running on MicroPython
+            if self._w:
+                self._w.close()
+        except Exception:
+            pass
+        self._r = self._w = None
+        self._changed.set()  # Wake any waiter so it sees the close
+        gc.collect()
+
+
+async def connect(ip, port, timeout_s=5):
+    """Open an AsyncChromecast session to (ip, port). One TLS handshake runs
+    at a time, whichever task asks, which keeps peak TLS memory down."""
+    global _handshake_lock
+    if _handshake_lock is None:
+        _handshake_lock = asyncio.Lock()
+    global _session_cost
+    device = AsyncChromecast(ip, port)
+    async with _handshake_lock:
+        gc.collect()
+        free = gc.mem_free()
+        await device.open(timeout_s)
         gc.collect()
+        _session_cost = max(_session_cost, free - gc.mem_free())
+    return device
+
+
+def session_cost():
+    """Heap held by one open TLS session, as measured by connect()."""
+    return _session_cost or _TLS_SESSION_COST
+
+
+def heap_stats():
+    """[open sessions (pooled and watched), measured session cost]."""
+    return [len(_pool) + len(_watched), _session_cost]
+
+
+# --- Connection Pool ---
+
+
+def pooled(ip, port):
+    """Take a live pooled session for (ip, port) out of the pool, or None."""
+    device = _pool.pop((ip, port), None)
+    if device and not device.service():
+        device.disconnect()
+        return None
+    if device:
+        device.timings = {}  # No connect phases on a warm session
+    return device
+
+
+def keep(device):
+    """Park a healthy session in the pool so the next play skips TLS setup."""
+    key = (device.ip, device.port)
+    old = _pool.pop(key, None)
+    if old and old is not device:
+        old.disconnect()
+    device.last_used = CastSession._ticks_ms()
+    _pool[key] = device
+    evict()
+
+
+def watch(device):
+    """Count a session held open outside the pool (e.g. one following a
+    playlist) against _POOL_MAX and the group SSL budget until unwatch()."""
+    _watched.append(device)
+    evict()
+
+
+def unwatch(device):
+    if device in _watched:
+        _watched.remove(device)
+
+
+def evict(min_free=_POOL_MIN_FREE):
+    """Close idle sessions, then least recently used ones until the pool and
+    the watched sessions fit in _POOL_MAX and the heap has min_free bytes of
+    headroom."""
+    now = CastSession._ticks_ms()
+    for key, device in list(_pool.items()):
+        if CastSession._ticks_diff(now, device.last_used) > _POOL_IDLE_MS:
+            print("Cast: closing idle session %s:%s" % key)
+            _pool.pop(key).disconnect()
+    gc.collect()
+    while _pool and (len(_pool) + len(_watched) > _POOL_MAX or gc.mem_free() < min_free):
+        key = min(_pool, key=lambda k: CastSession._ticks_diff(_pool[k].last_used, now))
+        print("Cast: evicting session %s:%s (free: %d)" % (key[0], key[1], gc.mem_free()))
+        _pool.pop(key).disconnect()
+
+
+def service_pool():
+    """Answer heartbeats on parked sessions and drop dead or idle ones."""
+    for key, device in list(_pool.items()):
+        if not device.service():
+            _pool.pop(key).disconnect()
+    evict()
+
+
+def close_pool():
+    """Close every parked and watched session (e.g. before OTA or after WiFi
+    loss)."""
+    while _pool:
+        _pool.popitem()[1].disconnect()
+    for device in _watched:
+        device.disconnect()
+
+
+# --- Group Play ---
+
+
+def _affordable_sessions(ssl_budget):
+    """How many cold TLS sessions fit in the budget and the free heap now.
+    Watched sessions are already spending part of the budget."""
+    gc.collect()
+    cost = session_cost()
+    free = gc.mem_free() - _GROUP_RESERVE
+    ssl_budget -= len(_watched) * cost
+    return max(1, min(ssl_budget, free) // cost)
+
+
+async def _group_prepare(device, volume):
+    """Prepare device for a group LOAD; closes it and returns False on
+    failure."""
+    try:
+        if await device.prepare(volume) and not device.closed:
+            return True
+        print("Cast: %s:%s could not attach a media session" % (device.ip, device.port))
+    except Exception as e:
+        print("Cast: %s:%s group session failed: %s" % (device.ip, device.port, e))
+    device.disconnect()
+    return False
+
+
+async def _group_session(ip, port, volume):
+    """Open (or reuse) and prepare one speaker's session; None on failure.
+    A pooled session that fails is most likely a stale socket, so the
+    speaker gets one cold connect before it counts as failed."""
+    device = pooled(ip, port)
+    if device is not None:
+        if await _group_prepare(device, volume):
+            return device
+        print("Cast: %s:%s warm session failed, reconnecting..." % (ip, port))
+    try:
+        # connect() runs one handshake at a time, while speakers that
+        # already connected carry on launching meanwhile
+        try:
+            device = await connect(ip, port)
+        except OSError as e:
+            if "ETIMEDOUT" not in str(e):
+                raise
+            print("Cast: %s:%s may be asleep, retrying in 3s..." % (ip, port))
+            await asyncio.sleep(3)
+            device = await connect(ip, port)
+    except Exception as e:
+        print("Cast: %s:%s group session failed: %s" % (ip, port, e))
+        return None
+    if await _group_prepare(device, volume):
+        return device
+    return None
+
+
+async def play_group(
+    speakers,
+    url,
+    volume=None,
+    ssl_budget=None,
+    timings=None,
+    before_load=None,
+):
+    """
+    Cast url to several speakers from one command. speakers is a list of
+    (ip, port, volume) tuples; a volume of None falls back to volume. A
+    fourth item, if present and not None, is that speaker's own URL.
+    ssl_budget (bytes) defaults to _GROUP_SSL_BUDGET. If a timings list is
+    given, each speaker's per-phase timings are stored in it.
+    before_load, if given, is awaited once a wave is prepared and before its
+    LOADs go out (e.g. to hold playback until a deadline).
+
+    Speakers are handled in waves sized to the SSL memory budget: warm pooled
+    sessions are free, cold ones are opened one handshake at a time while the
+    others launch. LOAD is then sent to every prepared speaker back to back
+    and the MEDIA_STATUS confirmations are awaited together.
+    Returns a list of confirmed flags in speaker order.
+    """
+    if ssl_budget is None:
+        ssl_budget = _GROUP_SSL_BUDGET
+    results = [False] * len(speakers)
+    pending = list(range(len(speakers)))
+    while pending:
+        cold = _affordable_sessions(ssl_budget)
+        wave = []
+        for i in pending:
+            if (speakers[i][0], speakers[i][1]) in _pool:
+                wave.append(i)  # Warm session, already paid for
+            elif cold > 0:
+                cold -= 1
+                wave.append(i)
+        pending = [i for i in pending if i not in wave]
+
+        devices = await asyncio.gather(
+            *[
+                _group_session(
+                    speakers[i][0],
+                    speakers[i][1],
+                    volume if speakers[i][2] is None else speakers[i][2],
+                )
+                for i in wave
+            ]
+        )
+        ready = [(i, d) for i, d in zip(wave, devices) if d]
+        if before_load:
+            await before_load()
+
+        # Fire all LOADs together so the speakers start in step
+        loaded = await asyncio.gather(
+            *[
+                d.load(speakers[i][3] if len(speakers[i]) > 3 and speakers[i][3] else url)
+                for i, d in ready
+            ]
+        )
+        confirmed = await asyncio.gather(
+            *[d.confirmed() if ok else _false() for (_, d), ok in zip(ready, loaded)]
+        )
+
+        last = not pending
+        for (i, device), ok in zip(ready, confirmed):
+            results[i] = ok
+            if timings is not None:
+                timings[i] = device.timings
+            # Keep the final wave warm; earlier waves give their memory back
+            if ok and last:
+                keep(device)
+            else:
+                device.disconnect()
+    return results
+
+
+async def _false():
+    return False
@@ -0,0 +1,126 @@
+import esp32
+import json
+import utime as time
+from micropython import const
+
+# Server lists for the services the device talks to (the MQTT broker, the
+# ntfy server), kept in NVS so they can be changed over MQTT without a
+# firmware update. Every endpoint keeps a smoothed connect round-trip time
+# and a failure count. pick() prefers the fastest endpoint that is not
+# cooling down after failures, so a slow or dead server is left for a
+# healthy one without rebooting; when all are cooling down it returns the
+# one that becomes eligible first.
+
+_NVS_NAME = "endpoints"
+_MAX = const(4)  # Endpoints per service
+_BLOB_MAX = const(256)  # Stored list, as JSON
+_COOLDOWN_MS = const(30000)  # After a failure; doubles with each further one
+_COOLDOWN_CAP_MS = const(600000)
+
+
+def parse(items):
+    """[[host, port], ...] from a list of "host:port" strings or [host, port]
+    pairs. Raises ValueError for anything else, or for a list too long to
+    store."""
+    if not isinstance(items, list) or not 0 < len(items) <= _MAX:
+        raise ValueError("expected 1-%d endpoints" % _MAX)
+    endpoints = []
+    for item in items:
+        if isinstance(item, str):
+            host, _, port = item.rpartition(":")
+        else:
+            host, port = item
+        port = int(port)
+        if not isinstance(host, str) or not host or not 0 < port < 65536:
+            raise ValueError("bad endpoint %s" % item)
+        endpoints.append([host, port])
+    if len(json.dumps(endpoints)) > _BLOB_MAX:
+        raise ValueError("endpoint list over %d bytes" % _BLOB_MAX)
+    return endpoints
+
+
+class Endpoints:
+    def __init__(self, name, default):
+        self.name = name  # NVS key
+        self.list = self._load() or [list(default)]
+        self.current = None  # Index of the endpoint in use
+        self._reset_stats()
+
+    def _reset_stats(self):
+        # Per endpoint: [smoothed rtt ms or None, consecutive failures, ticks
+        # when it may be picked again]
+        self._stats = [[None, 0, 0] for _ in self.list]
+
+    def _load(self):
+        try:
+            buf = bytearray(_BLOB_MAX)
+            length = esp32.NVS(_NVS_NAME).get_blob(self.name, buf)
+            return parse(json.loads(buf[:length]))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def set(self, items):
+        """Replace and store the list (see parse()). Returns True if the
+        endpoint in use is no longer on it."""
+        endpoints = parse(items)
+        nvs = esp32.NVS(_NVS_NAME)
+        nvs.set_blob(self.name, json.dumps(endpoints))
+        nvs.commit()
+        dropped = self.current is not None and self.list[self.current] not in endpoints
+        if self.current is not None and not dropped:
+            self.current = endpoints.index(self.list[self.current])
+        self.list = endpoints
+        self._reset_stats()
+        if dropped:
+            self.current = None
+        return dropped
+
+    def _cooling(self, i, now):
+        stat = self._stats[i]
+        return stat[1] and time.ticks_diff(stat[2], now) > 0
+
+    def available(self, exclude=None):
+        """Whether an endpoint other than `exclude` is not cooling down."""
+        now = time.ticks_ms()
+        return any(
+            i != exclude and not self._cooling(i, now) for i in range(len(self.list))
+        )
+
+    def pick(self):
+        """Index of the endpoint to use next: healthy before cooling down,
+        measured before unmeasured, then fastest, then list order."""
+        now = time.ticks_ms()
+
+        def rank(i):
+            rtt, _, retry = self._stats[i]
+            if self._cooling(i, now):
+                return (1, time.ticks_diff(retry, now), i)
+            return (0, 0 if rtt is not None else 1, rtt or 0, i)
+
+        return min(range(len(self.list)), key=rank)
+
+    def ok(self, i, rtt_ms):
+        """Record a successful connect to endpoint i that took rtt_ms."""
+        stat = self._stats[i]
+        stat[0] = rtt_ms if stat[0] is None else (stat[0] * 3 + rtt_ms) // 4
+        stat[1] = 0
+
+    def failed(self, i):
+        """Record a failed connect to (or lost connection with) endpoint i."""
+        stat = self._stats[i]
+        stat[1] += 1
+        cooldown = min(_COOLDOWN_CAP_MS, _COOLDOWN_MS << min(stat[1] - 1, 8))
+        stat[2] = time.ticks_add(time.ticks_ms(), cooldown)
+
+    def rtt(self, i):
+        return self._stats[i][0]
+
+    def health(self):
+        """[index in use, [["host:port", rtt ms, failures], ...]]"""
+        return [
+            self.current,
+            [
+                ["%s:%d" % (host, port), stat[0], stat[1]]
+                for (host, port), stat in zip(self.list, self._stats)
+            ],
+        ]
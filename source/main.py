@@ -6,15 +6,45 @@ from utils import (
     check_reset_button,
     clear_device_state,
     ntfy_alert,
+    ntfy_flush,
 )
 from ble import run_ble
 import machine
 import ota.rollback
 import utime as time
 import uasyncio as asyncio
-import mqtt
 from version import FIRMWARE_VERSION
 
+_APP_HOST = "34.53.103.114"  # Where deploy.yml publishes the app files
+
+
+def _app_urls():
+    """App file servers to try: the broker hosts from set_brokers (the app
+    is published next to the broker), then the default host."""
+    hosts = []
+    try:
+        from endpoints import Endpoints
+
+        hosts = [host for host, _ in Endpoints("mqtt", (_APP_HOST, 0)).list]
+    except Exception as e:
+        print("No broker list: %s" % e)
+    if _APP_HOST not in hosts:
+        hosts.append(_APP_HOST)
+    return ["http://%s/app/" % host for host in hosts]
+
+
+def _fetch(urls, filename, path):
+    """Download filename from the first of urls that has it."""
+    from utils import download
+
+    for url in urls:
+        try:
+            return download(url + filename, path)
+        except Exception as e:
+            error = e
+            print("Could not fetch %s%s: %s" % (url, filename, e))
+    raise error
+
 
 def _get_device_label():
     """Get device name from NVS for boot-time alerts, fallback to MAC."""
@@ -50,6 +80,79 @@ def startup():
     return False
 
 
+def _restore_app(error):
+    """
+    `import mqtt` failed. An update_app from older firmware only knows its
+    own file list, so it can install this mqtt.py without the modules it
+    imports: fetch manifest.py and every file on it that is missing here
+    (or, without a manifest, the module named in the error). If instead
+    the .mpy files were compiled for another MicroPython (the firmware was
+    updated under them), replace each with its source. Then reboot.
+    """
+    import os
+    from utils import file_exists
+
+    print("Import failed (%s), fetching app files..." % error)
+    mismatch = ".mpy" in str(error)  # incompatible .mpy file
+    urls = _app_urls()
+    try:
+        _fetch(urls, "manifest.py", "/manifest.py")
+    except Exception as e:
+        print("No manifest from server: %s" % e)
+    try:
+        import manifest
+
+        files = manifest.FILES
+        source = getattr(manifest, "SOURCE", files)
+    except Exception as e:
+        print("No manifest: %s" % e)
+        name = str(error).split("'")  # no module named 'amqtt'
+        files = source = [name[1] + ".py"] if len(name) == 3 else []
+    fetched = []
+    for f in files:
+        mpy = "/" + f[:-3] + ".mpy"
+        if mismatch:
+            if not file_exists(mpy):
+                continue
+            filename = f  # Source runs on any MicroPython version
+        elif file_exists("/" + f) or file_exists(mpy):
+            continue
+        else:
+            filename = f if f in source else f[:-3] + ".mpy"
+        try:
+            _fetch(urls, filename, "/" + filename + ".new")
+            os.rename("/" + filename + ".new", "/" + filename)
+            if mismatch:
+                os.remove(mpy)
+            fetched.append(filename)
+        except Exception as e:
+            print("Could not fetch %s: %s" % (filename, e))
+    if not fetched:
+        raise error  # Boot crash handler below: alert and reboot
+    ntfy_alert(
+        "[ESP32 %s] Fetched missing app files: %s" % (_get_device_label(), ", ".join(fetched)),
+        priority=4,
+        tags="warning",
+    )
+    time.sleep(1)
+    machine.reset()
+
+
+async def serve(client, label, free):
+    """MQTT, casting and (on request) BLE all share this one event loop.
+    free is the heap left after importing mqtt."""
+    import ntfy
+
+    ntfy.start()  # From here on alerts are sent in the background
+    try:
+        await client.mqtt_connect()
+        ntfy_alert("[ESP32 %s] Online (v%s, %d KB free)" % (label, FIRMWARE_VERSION, free // 1024), topic="projectbilal-events", priority=2, tags="electric_plug")
+    except Exception as e:
+        # mqtt_run's reconnect state machine retries, trying the other brokers
+        ntfy_alert("[ESP32 %s] MQTT connect failed: %s" % (label, e), priority=4, tags="warning")
+    await client.mqtt_run()
+
+
 def main():
     import ota.status
 
@@ -57,15 +160,21 @@ def main():
 
     wifi_success = startup()
     if wifi_success:
+        # Imported once WiFi is up, so missing modules can be fetched
+        try:
+            import mqtt
+        except (ImportError, ValueError) as e:
+            _restore_app(e)
+        import gc
+
+        gc.collect()
+        free = gc.mem_free()
+        print("Free heap after import mqtt: %d bytes" % free)
         device_id = get_mac()
         label = _get_device_label()
         client = mqtt.MQTTHandler(device_id)
-        conn = client.mqtt_connect()
-        if conn:
-            ntfy_alert("[ESP32 %s] Online (v%s)" % (label, FIRMWARE_VERSION), topic="projectbilal-events", priority=2, tags="electric_plug")
-            client.mqtt_run()
-        else:
-            ntfy_alert("[ESP32 %s] MQTT connect failed" % label, priority=4, tags="warning")
+        client.boot_free = free
+        asyncio.run(serve(client, label, free))
     else:
         # Scan WiFi BEFORE starting BLE — the shared radio can't do both.
         # Cache results so BLE can serve them instantly when phone asks.
@@ -86,5 +195,6 @@ try:
     main()
 except Exception as e:
     ntfy_alert("[ESP32 %s] Boot crash: %s" % (_get_device_label(), e), priority=4, tags="warning")
+    ntfy_flush()  # The event loop is gone: send what it had queued
     time.sleep(1)
     machine.reset()
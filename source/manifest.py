@@ -0,0 +1,32 @@
+# Application files, in the order update_app writes them. Modules come
+# first and mqtt.py and main.py, which import the rest, come last, so an
+# update that stops part way never leaves a main.py whose imports are
+# missing. update_app reads the server's copy of this file before anything
+# else, so a device installs the file list of the version it updates to.
+# Add every new module here.
+#
+# deploy.yml also publishes every module not in SOURCE compiled with
+# mpy-cross (name.mpy), and devices install that instead of the .py, so
+# nothing is compiled on the device at import. SOURCE stays text: this file
+# is read with exec(), and MicroPython only runs a main.py.
+
+FILES = (
+    "manifest.py",
+    "version.py",
+    "utils.py",
+    "backoff.py",
+    "endpoints.py",
+    "ntfy.py",
+    "amqtt.py",
+    "outbox.py",
+    "rpc.py",
+    "scheduler.py",
+    "schedule.py",
+    "prayer.py",
+    "cast.py",
+    "ble.py",
+    "mqtt.py",
+    "main.py",
+)
+
+SOURCE = ("manifest.py", "main.py")
@@ -1,18 +1,90 @@
-from umqtt.simple import MQTTClient
-from utils import led_toggle, check_reset_button, clear_device_state, ntfy_alert
+from amqtt import MQTTClient
+from utils import (
+    led_toggle,
+    factory_reset,
+    clear_device_state,
+    start_reset_button,
+    ntfy_alert,
+    ntfy_flush,
+    sync_clock,
+    unix_ms,
+)
 import utime as time
 import json
 from micropython import const
 import ota.update
 import uasyncio as asyncio
 from ble import run_ble
+from outbox import Outbox
+from schedule import Schedule
+from scheduler import Scheduler
+from backoff import Backoff
+from endpoints import Endpoints, parse as parse_endpoints
+import rpc
+import ntfy
 import machine
 from version import FIRMWARE_VERSION
 
 _PING_INTERVAL = const(15)  # this needs to be less than keepalive
 _KEEPALIVE = const(45)  # Relaxed now that mDNS is disabled — less overhead
-_MQTT_HOST = const("34.53.103.114")
+_MQTT_HOST = const("34.53.103.114")  # Default broker, until set_brokers stores a list
 _MQTT_PORT = const(1883)
+_PREWARM_LEAD = const(20)  # Seconds before a play_at deadline to warm the speaker
+_PREWARM_MAX = const(60)  # Longest pre-warm lead a play_at may ask for
+_CLOCK_MAX_AGE = const(21600000)  # Resync NTP every 6 hours (ms)
+_QUEUE_ITEM_TIMEOUT = const(900)  # Seconds to wait for one playlist item to finish
+_HEALTH_INTERVAL = const(600)  # Publish health every 10 minutes
+_WDT_TIMEOUT = const(120000)  # Hardware watchdog (ms)
+_WDT_FEED = const(10000)  # ms between watchdog feeds
+_POOL_INTERVAL = const(2000)  # ms between heartbeat checks on parked speakers
+_REBOOT_DELAY = const(1000)  # ms between a requested reboot and the reset
+# Reconnect: separate jittered backoff for the radio and the broker (ms)
+_WIFI_BACKOFF = const(5000)
+_WIFI_BACKOFF_CAP = const(120000)
+_BROKER_BACKOFF = const(2000)
+_BROKER_BACKOFF_CAP = const(60000)
+_FAST_RECONNECT = const(2000)  # Broker retry after a post-cast WiFi recovery
+_STUCK_AFTER = const(900)  # Seconds an incident may last before a reboot
+_FAILOVER_DELAY = const(1000)  # Broker retry when another endpoint is healthy
+_PROBE_INTERVAL = const(1800)  # Seconds between connect-RTT probes of all brokers
+_PROBE_TIMEOUT = const(5)
+_SWITCH_MARGIN = const(100)  # ms a broker must be faster (and 2x) to move to it
+# Persistent session: the broker queues QoS1 commands while we are away
+_PLAY_MAX_AGE = const(120)  # Seconds after which a delivered play is stale
+_COMMAND_MAX_AGE = const(86400)  # Same for every other action
+_BACKLOG_WINDOW = const(3000)  # ms after a resumed CONNACK that count as backlog
+_SCHEDULE_LATE = const(60)  # Seconds a missed schedule entry may still fire late
+_PRAYER_CONFIG = "/prayer.json"  # Location and URLs for on-device prayer times
+_PRAYER_DAYS = const(7)  # Days of prayer times kept in the schedule
+
+# Work queue: actions run one at a time on a worker task, lowest value first
+_PRIO_PLAY = const(0)
+_PRIO_CONTROL = const(1)
+_PRIO_MAINTENANCE = const(2)
+_WORK_QUEUE_MAX = const(8)
+
+# Connection states (see _reconnect)
+_CONNECTED = const(0)
+_WIFI_DOWN = const(1)
+_BROKER_DOWN = const(2)
+_STATE_NAMES = ("connected", "WiFi down", "broker down")
+
+
+def _phase(trace, name):
+    """Record the ms since the previous mark in a play trace under name."""
+    now = time.ticks_ms()
+    trace[name] = time.ticks_diff(now, trace["_t"])
+    trace["_t"] = now
+
+
+async def _sleep_until(at_ms):
+    """Sleep until a unix-ms deadline on the NTP-anchored clock."""
+    while True:
+        remaining = at_ms - unix_ms()
+        if remaining <= 0:
+            return
+        # Re-check at least every second in case the loop was blocked
+        await asyncio.sleep(min(remaining, 1000) / 1000)
 
 
 class MQTTHandler(object):
@@ -21,18 +93,57 @@ class MQTTHandler(object):
         self.id = id
         self.device_name = self._load_device_name()
         self.connected = False
-        self.reboot_requested = False
         self.discovery_in_progress = False
-        self._play_in_progress = False
-        self._last_play_url = None
-        self._last_play_time = 0
+        self._recent_plays = {}  # str(url) -> time.time() it (will) play, for dedup
         self._dedup_window = 10  # seconds
         self._play_count = 0
         self._play_confirmed_count = 0
         self._error_count = 0
         self._start_time = time.time()
-        self._pending_playback_result = None
+        self._outbox = self._open_outbox()  # Telemetry kept while offline
+        self._flushing = False
+        self._schedule = self._open_schedule()  # Plays fired from a local timer
+        self._schedule_changed = asyncio.Event()
+        self._prayer = self._load_prayer()  # set_prayer config, or None
+        self._prayer_day = None  # UTC day the schedule was last filled from it
+        self._prayer_table = None  # prayer.PrayerTable, opened on first use
         self._post_cast_reconnect = False
+        self._cast = None  # cast module, imported lazily on first play
+        self.boot_free = None  # Heap free after import, set by main.py
+        self._ble_task = None  # run_ble() started by the ble action
+        self._phase_stats = {}  # phase -> [count, total_ms, max_ms] since last health
+        self._housekeeping = Scheduler()  # Watchdog, pings, health, cast heartbeats
+
+        # Action registry: name -> (priority, async handler(props, topic, trace))
+        self._actions = {
+            "play": (_PRIO_PLAY, self._act_play),
+            "play_queue": (_PRIO_PLAY, self._act_play_queue),
+            "discover": (_PRIO_CONTROL, self._act_discover),
+            "set_device_name": (_PRIO_CONTROL, self._act_set_device_name),
+            "delete_device": (_PRIO_CONTROL, self._act_delete_device),
+            "set_schedule": (_PRIO_CONTROL, self._act_set_schedule),
+            "set_prayer": (_PRIO_CONTROL, self._act_set_prayer),
+            "set_brokers": (_PRIO_CONTROL, self._act_set_brokers),
+            "ble": (_PRIO_CONTROL, self._act_ble),
+            "update": (_PRIO_MAINTENANCE, self._act_update),
+            "update_app": (_PRIO_MAINTENANCE, self._act_update_app),
+        }
+        # [priority, seq, key, handler, args, action, queued_tick, (rpc id, rx_tick) or None]
+        self._jobs = []
+        self._job_seq = 0
+        self._work = asyncio.Event()
+        self._running_key = None  # Coalescing key of the job on the worker
+        self._timed = []  # Keys of play_at commands playing from their own task
+        self._queue_stats = self._new_queue_stats()
+        self._down_tick = None  # When the last connection was lost
+        self._resumed_tick = None  # When a stored session was last resumed
+        self._session_stats = self._new_session_stats()
+        self._brokers = Endpoints("mqtt", (_MQTT_HOST, _MQTT_PORT))
+        self._switching = False  # Connection closed on purpose: don't blame the broker
+        self._updating = False  # An update holds the link down; don't reconnect
+        self._journal = rpc.Journal()  # Replies to recent request ids
+        self._running_rpc = None  # (id, rx_tick) of the job on the worker
+        self.rpc_topic = f"projectbilal/{self.id}/rpc"
         self.lwt_topic = f"projectbilal/{self.id}/status"
         self.lwt_message = json.dumps(
             {
@@ -57,6 +168,30 @@ class MQTTHandler(object):
             pass
         return self.id
 
+    @staticmethod
+    def _open_outbox():
+        try:
+            return Outbox()
+        except Exception as e:
+            print(f"Outbox unavailable, offline telemetry will be lost: {e}")
+            return None
+
+    @staticmethod
+    def _open_schedule():
+        try:
+            return Schedule()
+        except Exception as e:
+            print(f"Schedule unavailable, plays need the server: {e}")
+            return None
+
+    @staticmethod
+    def _load_prayer():
+        try:
+            with open(_PRAYER_CONFIG) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
     @property
     def _label(self):
         """Short label for ntfy messages: name if set, otherwise MAC."""
@@ -64,11 +199,20 @@ class MQTTHandler(object):
             return '"%s"' % self.device_name
         return self.id
 
-    def mqtt_connect(self):
+    async def mqtt_connect(self):
+        """
+        Connect with a persistent session (clean_session=False) under the
+        stable MAC client id. If the broker still holds our session, the QoS1
+        subscription survives and commands published while we were away are
+        delivered right after CONNACK, so the subscribe round trip is skipped.
+        """
+        sync_clock(_CLOCK_MAX_AGE)  # Ages of queued commands need wall-clock time
+        broker = self._brokers.current = self._brokers.pick()
+        host, port = self._brokers.list[broker]
         self.mqtt = MQTTClient(
             client_id=self.id,
-            server=_MQTT_HOST,
-            port=_MQTT_PORT,
+            server=host,
+            port=port,
             keepalive=_KEEPALIVE,
         )
 
@@ -80,13 +224,27 @@ class MQTTHandler(object):
         except Exception as e:
             print("Warning: set_last_will failed:", e)
 
-        self.mqtt.connect()
         self.mqtt.set_callback(self.sub_cb)
-        topic = f"projectbilal/{self.id}"
-        self.mqtt.subscribe(topic)
+        start = time.ticks_ms()
+        try:
+            resumed = await self.mqtt.connect(clean_session=False)
+        except Exception:
+            self._brokers.failed(broker)
+            raise
+        self._brokers.ok(broker, time.ticks_diff(time.ticks_ms(), start))
+        print("MQTT: Connected to %s:%d" % (host, port))
+        if resumed:
+            self._resumed_tick = time.ticks_ms()
+            print("MQTT: Session resumed, subscription kept by broker")
+        else:
+            await self.mqtt.subscribe(f"projectbilal/{self.id}", qos=1)
         self.connected = True
+        self._record_resume(resumed)
         led_toggle("mqtt")
 
+        # Deliver what was recorded while offline before the current status
+        await self._flush_outbox()
+
         # Send online status when connecting
         self.send_status_update("online")
 
@@ -100,8 +258,8 @@ class MQTTHandler(object):
                 "timestamp": time.time(),
                 "firmware_version": FIRMWARE_VERSION,
             }
-            self.mqtt.publish(self.lwt_topic, json.dumps(message))
-            print(f"Status update sent: {status} (firmware: {FIRMWARE_VERSION})")
+            if self._publish(self.lwt_topic, json.dumps(message)):
+                print(f"Status update sent: {status} (firmware: {FIRMWARE_VERSION})")
         except Exception as e:
             print(f"Failed to send status update: {e}")
 
@@ -118,8 +276,13 @@ class MQTTHandler(object):
             print(f"Error during disconnect: {e}")
 
     def sub_cb(self, topic, msg):
+        # The client stamps each packet as its first byte arrives
+        rx_tick = self.mqtt.rx_tick
+        trace = {"_t0": rx_tick, "_t": rx_tick}
+        _phase(trace, "recv")
         try:
             msg = json.loads(msg)
+            _phase(trace, "parse")
 
             # Immediately ignore keepalive messages to prevent interference
             # These come from the phone app every 30 seconds and don't need processing
@@ -128,337 +291,907 @@ class MQTTHandler(object):
 
             led_toggle("mqtt")
 
-            action = msg.get("action", {})
+            action = msg.get("action")
             props = msg.get("props", {})
         except (ValueError, TypeError) as e:
             print(f"Message not for process: {msg} (JSON parse error: {e})")
             return
 
-        if action == "play":
-            # Reject if a play is already in progress
-            if self._play_in_progress:
-                print("MQTT: Play already in progress, ignoring")
+        # Commands with an id are executed at most once: a repeat is
+        # answered with the reply already given
+        rid = msg.get("id")
+        req = None
+        if rid is not None:
+            seen = self._journal.get(rid)
+            if seen is not None:
+                print("MQTT: Request %s already handled, replaying reply" % rid)
+                reply = dict(seen)
+                reply["duplicate"] = True
+                self._publish(self.rpc_topic, json.dumps(reply))
                 return
+            req = (rid, rx_tick)
+
+        entry = self._actions.get(action)
+        if entry is None:
+            # Our own replies on this topic carry no action
+            if action:
+                print(f"MQTT: Unknown action: {action}")
+                self._ack(req, action, "unknown")
+            return
 
-            url = props.get("url")
+        # Times the publisher set ("ts", "at", "lead") must be numbers, and
+        # endpoint lists must fit in NVS
+        try:
+            age = self._command_age(msg, props)
+            at_ms = lead_ms = None
+            if entry[0] == _PRIO_PLAY:
+                at_ms = self._deadline(props)
+                lead_ms = self._lead_ms(props)
+            elif action == "set_brokers":
+                for name in ("brokers", "ntfy"):
+                    if props.get(name) is not None:
+                        parse_endpoints(props[name])
+        except (ValueError, TypeError) as e:
+            print("MQTT: Bad %s: %s" % (action, e))
+            self._ack(req, action, "bad_request", error=str(e))
+            return
 
-            # Deduplication: reject duplicate play commands within window
-            now = time.time()
-            if url == self._last_play_url and (now - self._last_play_time) < self._dedup_window:
-                print("MQTT: Ignoring duplicate play command (within %ds window)" % self._dedup_window)
-                ntfy_alert(
-                    "[ESP32 %s] Duplicate play rejected: %s" % (self._label, props.get("label", "audio")),
-                    topic="projectbilal-events",
-                    priority=2,
-                    tags="speaker",
+        stats = self._session_stats
+        if self._resumed_tick is not None and (
+            time.ticks_diff(rx_tick, self._resumed_tick) < _BACKLOG_WINDOW
+        ):
+            stats["backlog"] += 1
+        if age is not None and age > (
+            _PLAY_MAX_AGE if entry[0] == _PRIO_PLAY else _COMMAND_MAX_AGE
+        ):
+            print("MQTT: Discarding stale %s (%d s old)" % (action, age))
+            stats["stale"] += 1
+            self._ack(req, action, "stale", age_s=int(age))
+            return
+
+        key = None
+        if entry[0] == _PRIO_PLAY:
+            # With a request id the journal handles repeats, not URL matching
+            key = self._admit_play(action, props, dedup=req is None)
+            if key is None:
+                return
+            _phase(trace, "dedup")
+
+            # play_at: a future "at" (unix seconds) pre-warms the speaker
+            # "lead" seconds ahead and sends LOAD on the deadline
+            if at_ms is not None:
+                print("MQTT: play_at scheduled in %d ms" % (at_ms - unix_ms()))
+                asyncio.create_task(
+                    self._submit_at(at_ms, lead_ms, action, props, topic, key, req)
                 )
+                self._note_play(self._play_url(action, props), time.time())
+                self._ack(req, action, "scheduled", at=at_ms // 1000)
                 return
-            self._last_play_url = url
-            self._last_play_time = now
 
-            # Wait if discovery is in progress to prevent socket exhaustion
-            if self.discovery_in_progress:
-                print("Waiting for discovery to complete before playing...")
-                max_wait = 15  # Max 15 seconds wait
-                wait_count = 0
-                while self.discovery_in_progress and wait_count < max_wait:
-                    time.sleep(1)
-                    wait_count += 1
-                if self.discovery_in_progress:
-                    print("Discovery still in progress, proceeding anyway")
-
-            ip = props.get("ip")
-            port = props.get("port")
-            volume = props.get("volume")
-            label = props.get("label", "audio")
-
-            if all([url, ip, port]):
-                ntfy_alert(
-                    "[ESP32 %s] Received play: %s" % (self._label, label),
-                    topic="projectbilal-events",
-                    priority=2,
-                    tags="speaker",
-                )
-                # Clean up the IP string (remove whitespace/newlines)
-                ip = str(ip).strip()
-                self._play_in_progress = True
-                try:
-                    self.play(url=url, ip=ip, port=port, vol=volume, label=label)
-                finally:
-                    self._play_in_progress = False
+        # A play counts for dedup only once the queue has taken it
+        if self.submit(action, props, topic, trace, key, req) and key is not None:
+            self._note_play(self._play_url(action, props), time.time())
 
-        if action == "update":
-            url = props.get("url")
-            if url:
-                print(f"Starting OTA update from: {url}")
+    def _ack(self, req, action, status, **extra):
+        """Acknowledge a command that carries a request id (req). Only an
+        admitted command is journaled; a refused one (even one dropped
+        after it was queued) can be retried with the same id."""
+        if req is None:
+            return
+        reply = rpc.ack(req[0], action, status, req[1], **extra)
+        if status == "queued" or status == "scheduled":
+            self._journal.put(req[0], reply)
+        else:
+            self._journal.forget(req[0])
+        self._publish(self.rpc_topic, json.dumps(reply))
+
+    # --- Work Queue ---
+
+    def _coalesces(self, key):
+        return (
+            key == self._running_key
+            or key in self._timed
+            or any(job[2] == key for job in self._jobs)
+        )
 
-                # Disconnect from MQTT to free up network resources
-                print("Disconnecting from MQTT for OTA update...")
-                try:
-                    if self.connected and self.mqtt:
-                        self.mqtt.disconnect()
-                        self.connected = False
-                        print("MQTT disconnected successfully")
-                except Exception as e:
-                    print(f"Error disconnecting MQTT: {e}")
+    def submit(self, action, props, topic, trace=None, key=None, req=None):
+        """
+        Queue a registered action for the worker. Plays carry a key so an
+        identical play that is already queued or running absorbs the new one.
+        When the queue is full, the least urgent job gives way (or the new one
+        is dropped if nothing queued is less urgent). Returns True if queued.
+        A request id (req) is acknowledged here with the outcome.
+        """
+        prio, handler = self._actions[action]
+        stats = self._queue_stats
+        if key is not None and self._coalesces(key):
+            print("MQTT: Same %s already queued, coalescing" % action)
+            stats["coalesced"] += 1
+            self._ack(req, action, "coalesced")
+            return False
+        if len(self._jobs) >= _WORK_QUEUE_MAX:
+            worst = max(self._jobs)
+            stats["dropped"] += 1
+            if worst[0] <= prio:
+                print("MQTT: Work queue full, dropping %s" % action)
+                self._ack(req, action, "dropped")
+                return False
+            print("MQTT: Work queue full, dropping queued %s" % worst[5])
+            self._jobs.remove(worst)
+            if worst[2] is not None:  # A play that will not run now
+                self._recent_plays.pop(str(self._play_url(worst[5], worst[4][0])), None)
+            self._ack(worst[7], worst[5], "dropped")
+        self._job_seq += 1
+        self._jobs.append(
+            [prio, self._job_seq, key, handler, (props, topic, trace), action, time.ticks_ms(), req]
+        )
+        stats["depth"] = max(stats["depth"], len(self._jobs))
+        self._work.set()
+        self._ack(req, action, "queued", depth=len(self._jobs))
+        return True
 
-                # Small delay to ensure disconnection is complete
-                time.sleep(1)
+    async def _submit_at(self, at_ms, lead_ms, action, props, topic, key, req=None):
+        """
+        Play a play_at beside the work queue: wake lead_ms before the
+        deadline, then warm the speaker and send LOAD on the deadline from
+        this task, so neither a long job on the worker nor another play_at
+        can hold it up.
+        """
+        await _sleep_until(at_ms - lead_ms)
+        if self._coalesces(key):
+            print("MQTT: Same %s already queued, coalescing" % action)
+            self._queue_stats["coalesced"] += 1
+            self._ack(req, action, "coalesced")
+            return
+        self._timed.append(key)
+        try:
+            url = self._play_url(action, props)
+            call = self._cast_props(url, props, None, req[0] if req else None)
+            await self._run(action, call, req, time.ticks_ms(), True)
+        finally:
+            self._timed.remove(key)
 
-                # Start OTA update
-                print("Starting firmware download and flash...")
-                ota.update.from_file(url=url, verify=True, reboot=True)
+    async def _worker(self):
+        """Run queued actions one at a time, most urgent (then oldest) first."""
+        while True:
+            while not self._jobs:
+                self._work.clear()
+                await self._work.wait()
+            job = min(self._jobs)
+            self._jobs.remove(job)
+            _, _, key, handler, args, action, queued, req = job
+
+            wait = time.ticks_diff(time.ticks_ms(), queued)
+            stat = self._queue_stats["wait"]
+            stat[0] += 1
+            stat[1] += wait
+            stat[2] = max(stat[2], wait)
+            if args[2] is not None:
+                _phase(args[2], "queue")
+
+            self._running_key = key
+            self._running_rpc = req
+            try:
+                await self._run(action, handler(*args), req, queued, job[0] == _PRIO_PLAY)
+            finally:
+                self._running_key = None
+                self._running_rpc = None
+
+    async def _run(self, action, call, req, queued, casting):
+        """Await an action's coroutine, then answer its request id (req)
+        with the result. Alerts are held back while it casts."""
+        if casting:
+            ntfy.hold()  # Alerts wait until the cast is done
+        start = time.ticks_ms()
+        error = None
+        try:
+            await call
+        except Exception as e:
+            error = e
+            self._error_count += 1
+            print(f"MQTT: Action {action} failed: {e}")
+            import sys
+            sys.print_exception(e)
+        finally:
+            if casting:
+                ntfy.release()
+        if req is not None:
+            reply = rpc.result(req[0], action, error, req[1], queued, start)
+            self._journal.put(req[0], reply)
+            self._publish(self.rpc_topic, json.dumps(reply))
+
+    # --- Actions (run on the worker) ---
+
+    def _admit_play(self, action, props, dedup=True):
+        """
+        Screen a play command on arrival. Returns its coalescing key, or None
+        if it repeats a play admitted within the dedup window (only checked
+        with dedup, i.e. for commands without a request id). The play counts
+        for dedup once it is queued or scheduled (see _note_play()).
+        """
+        # Deduplication: reject duplicate play commands within window
+        last = self._recent_plays.get(str(self._play_url(action, props)))
+        if dedup and last is not None and time.time() - last < self._dedup_window:
+            print("MQTT: Ignoring duplicate play command (within %ds window)" % self._dedup_window)
+            ntfy_alert(
+                "[ESP32 %s] Duplicate play rejected: %s" % (self._label, props.get("label", "audio")),
+                topic="projectbilal-events",
+                priority=2,
+                tags="speaker",
+            )
+            return None
+        return self._play_key(action, props)
+
+    def _note_play(self, url, when):
+        """Remember that url plays at time.time() `when`, for the dedup
+        window; entries whose window has passed are forgotten."""
+        now = time.time()
+        for old in [u for u, t in self._recent_plays.items() if now - t >= self._dedup_window]:
+            del self._recent_plays[old]
+        self._recent_plays[str(url)] = when
+
+    @staticmethod
+    def _play_url(action, props):
+        return props.get("urls") if action == "play_queue" else props.get("url")
+
+    @staticmethod
+    def _play_key(action, props):
+        """Coalescing key: the same play to the same speakers."""
+        url = MQTTHandler._play_url(action, props)
+        return "%s|%s|%s|%s|%s" % (
+            action, url, props.get("ip"), props.get("port"), props.get("speakers")
+        )
 
-        if action == "update_app":
-            """
-            Update individual application files on filesystem
+    @property
+    def _running_id(self):
+        """Request id of the job on the worker, or None."""
+        return self._running_rpc[0] if self._running_rpc else None
+
+    async def _act_play(self, props, topic, trace):
+        await self._cast_props(props.get("url"), props, trace, self._running_id)
+
+    async def _act_play_queue(self, props, topic, trace):
+        # Playlist (e.g. athan then dua): one session, one QUEUE_LOAD,
+        # the speaker preloads each next item
+        await self._cast_props(props.get("urls"), props, trace, self._running_id)
+
+    async def _cast_props(self, url, props, trace, rid=None):
+        # play_at commands get here from _submit_at at the pre-warm time;
+        # the deadline itself is still ahead, and play()/play_group() wait
+        # for it. rid is the request id to tag playback reports with.
+        at_ms = self._deadline(props)
+
+        # Wait if discovery is in progress to prevent socket exhaustion
+        if self.discovery_in_progress:
+            print("Waiting for discovery to complete before playing...")
+            max_wait = 15  # Max 15 seconds wait
+            wait_count = 0
+            while self.discovery_in_progress and wait_count < max_wait:
+                await asyncio.sleep(1)
+                wait_count += 1
+            if self.discovery_in_progress:
+                print("Discovery still in progress, proceeding anyway")
+
+        ip = props.get("ip")
+        port = props.get("port")
+        volume = props.get("volume")
+        label = props.get("label", "audio")
+        speakers = props.get("speakers")
+
+        if url and speakers and not isinstance(url, list):
+            # Group play: one command casts to several speakers at once
+            targets = [
+                (str(spk.get("ip")).strip(), spk.get("port"), spk.get("volume"), spk.get("url"))
+                for spk in speakers
+                if spk.get("ip") and spk.get("port")
+            ]
+            if not targets:
+                raise ValueError("no speaker to play on")
+            ntfy_alert(
+                "[ESP32 %s] Received group play: %s (%d speakers)"
+                % (self._label, label, len(targets)),
+                topic="projectbilal-events",
+                priority=2,
+                tags="speaker",
+            )
+            await self.play_group(
+                url=url,
+                speakers=targets,
+                vol=volume,
+                label=label,
+                ssl_budget=props.get("ssl_budget"),
+                at=at_ms,
+                trace=trace,
+                rid=rid,
+            )
 
-            Expected MQTT message:
-            {
-                "action": "update_app",
-                "props": {
-                    "files": ["mqtt.py", "utils.py"],  // or ["*"] or ["all"] for all files
-                    "url": "http://your-server.com/app/"
-                }
-            }
-            """
-            files = props.get("files", [])
-            base_url = props.get("url")
+        elif all([url, ip, port]):
+            ntfy_alert(
+                "[ESP32 %s] Received play: %s" % (self._label, label),
+                topic="projectbilal-events",
+                priority=2,
+                tags="speaker",
+            )
+            # Clean up the IP string (remove whitespace/newlines)
+            ip = str(ip).strip()
+            await self.play(
+                url=url,
+                ip=ip,
+                port=port,
+                vol=volume,
+                label=label,
+                at=at_ms,
+                trace=trace,
+                preload=props.get("preload"),
+                rid=rid,
+            )
+        else:
+            # Reported as the request's result ("error"), not a silent "ok"
+            raise ValueError("no speaker to play on")
 
-            if not files:
-                print("ERROR: No files specified for app update")
-                return
+    async def _act_update(self, props, topic, trace):
+        url = props.get("url")
+        if url:
+            print(f"Starting OTA update from: {url}")
 
-            # Handle "update all" shortcut
-            if files == ["*"] or files == ["all"]:
-                files = [
-                    "main.py",
-                    "mqtt.py",
-                    "utils.py",
-                    "cast.py",
-                    "ble.py",
-                    "version.py",
-                ]
-                print("Update all files requested - will download all app files")
-
-            if not base_url:
-                print("ERROR: No URL specified for app update")
-                return
+            # Disconnect from MQTT and speakers to free up network resources
+            print("Disconnecting from MQTT for OTA update...")
+            self._disconnect_for_update()
 
-            print(f"Starting app update for files: {files}")
-            print(f"Base URL: {base_url}")
+            # Small delay to ensure disconnection is complete
+            await asyncio.sleep(1)
 
-            # Disconnect MQTT to free up resources
+            # Start OTA update
+            print("Starting firmware download and flash...")
             try:
-                if self.connected and self.mqtt:
-                    self.mqtt.disconnect()
-                    self.connected = False
-                    print("MQTT disconnected for app update")
-            except Exception as e:
-                print(f"Error disconnecting MQTT: {e}")
-
-            # Import dependencies
-            import urequests
-            import os
-            import gc
+                ota.update.from_file(url=url, verify=True, reboot=True)
+            finally:
+                self._updating = False  # Only reached if the update failed
+
+    async def _act_update_app(self, props, topic, trace):
+        """
+        Update individual application files on filesystem
+
+        Expected MQTT message:
+        {
+            "action": "update_app",
+            "props": {
+                "files": ["mqtt.py", "utils.py"],  // or ["*"] or ["all"] for all files
+                "url": "http://your-server.com/app/"
+            }
+        }
 
-            # Download and write each file with streaming to avoid RAM exhaustion.
-            # Files are backed up first so a failed download can be rolled back.
-            updated_files = []
-            failed_files = []
+        Application modules that are missing on the device are fetched as
+        well, following the server's manifest.py. Modules the manifest does
+        not list as SOURCE are installed compiled (.mpy).
+        """
+        files = props.get("files", [])
+        base_url = props.get("url")
 
-            for filename in files:
-                file_path = "/" + filename
-                backup_path = "/" + filename + ".bak"
-                gc.collect()
+        if not files:
+            print("ERROR: No files specified for app update")
+            return
 
-                try:
-                    print(f"Downloading {filename}...")
-                    file_url = base_url + filename
+        if not base_url:
+            print("ERROR: No URL specified for app update")
+            return
 
-                    r = urequests.get(file_url)
-                    if r.status_code != 200:
-                        print(f"Failed to download {filename}: HTTP {r.status_code}")
-                        failed_files.append(filename)
-                        r.close()
-                        break
+        # Disconnect MQTT and speakers to free up resources
+        self._disconnect_for_update()
 
-                    # Backup existing file before overwriting
-                    try:
-                        os.rename(file_path, backup_path)
-                    except Exception as e:
-                        print(f"No existing file to backup ({filename}): {e}")
+        import os
+        import gc
+        from utils import download, file_exists
+
+        # The file list of the version being installed, so modules it adds
+        # arrive with it; mqtt.py and main.py are written last
+        manifest, source = self._app_manifest(base_url)
+        if files == ["*"] or files == ["all"]:
+            files = list(manifest)
+            print("Update all files requested - will download all app files")
+        else:
+            files = [f for f in files if f not in manifest] + [
+                f
+                for f in manifest
+                if f in files
+                or not (file_exists("/" + f) or file_exists("/" + f[:-3] + ".mpy"))
+            ]
+        # Compiled modules skip the compile (and its heap peak) at import
+        files = [f[:-3] + ".mpy" if f in manifest and f not in source else f for f in files]
+
+        print(f"Starting app update for files: {files}")
+        print(f"Base URL: {base_url}")
+
+        # Download each file next to the old one, then swap it in. Replaced
+        # files are kept as .bak so a failed update can be rolled back.
+        updated_files = []
+        backed_up = []
+        failed_files = []
+
+        for filename in files:
+            file_path = "/" + filename
+            backup_path = file_path + ".bak"
+            gc.collect()
 
-                    # Stream response to file in chunks to avoid OOM
-                    total = 0
-                    with open(file_path, "wb") as f:
-                        while True:
-                            chunk = r.raw.read(1024)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            total += len(chunk)
-                    r.close()
+            try:
+                print(f"Downloading {filename}...")
+                total = download(base_url + filename, file_path + ".new")
+                if file_exists(file_path):
+                    os.rename(file_path, backup_path)
+                    backed_up.append(filename)
+                os.rename(file_path + ".new", file_path)
 
-                    print(f"Downloaded and wrote {filename} ({total} bytes)")
-                    updated_files.append(filename)
+                print(f"Downloaded and wrote {filename} ({total} bytes)")
+                updated_files.append(filename)
 
-                    time.sleep(0.5)
+                await asyncio.sleep(0.5)  # Let housekeeping run
 
-                except Exception as e:
-                    print(f"Error updating {filename}: {e}")
-                    failed_files.append(filename)
-                    # Restore backup if download/write failed
+            except Exception as e:
+                print(f"Error updating {filename}: {e}")
+                failed_files.append(filename)
+                try:
+                    os.remove(file_path + ".new")
+                except OSError:
+                    pass
+                # Restore the backup if the swap itself failed
+                if filename in backed_up and not file_exists(file_path):
                     try:
                         os.rename(backup_path, file_path)
                         print(f"Restored backup for {filename}")
                     except Exception as e:
                         print(f"WARNING: Could not restore backup for {filename}: {e}")
-                    break
-
-            # If any file failed, roll back all updated files
-            if failed_files:
-                print("=" * 40)
-                print("Update failed, rolling back...")
-                for fn in updated_files:
-                    try:
-                        os.rename("/" + fn + ".bak", "/" + fn)
-                        print(f"  Rolled back {fn}")
-                    except Exception as e:
-                        print(f"  WARNING: Rollback failed for {fn}: {e}")
-                print("  Failed: %s" % failed_files)
-                ntfy_alert(
-                    "[ESP32 %s] App update failed: %s" % (self._label, failed_files),
-                    priority=4,
-                    tags="warning",
-                )
-                print("=" * 40)
-                print("Reconnecting to MQTT...")
-                from utils import wifi_connect
-
-                wifi_connect()
-                self.mqtt_connect()
-                return
-
-            # Clean up all backup files
-            print("Cleaning up backup files...")
-            for filename in updated_files:
-                try:
-                    os.remove("/" + filename + ".bak")
-                except:
-                    pass
+                break
 
-            # Report results
+        # If any file failed, roll back all replaced files. Files that are
+        # new to this device stay: nothing older imports them.
+        if failed_files:
             print("=" * 40)
-            print("App update complete - all files updated successfully")
-            print("  Updated: %s" % updated_files)
+            print("Update failed, rolling back...")
+            for fn in backed_up:
+                try:
+                    os.rename("/" + fn + ".bak", "/" + fn)
+                    print(f"  Rolled back {fn}")
+                except Exception as e:
+                    print(f"  WARNING: Rollback failed for {fn}: {e}")
+            print("  Failed: %s" % failed_files)
+            ntfy_alert(
+                "[ESP32 %s] App update failed: %s" % (self._label, failed_files),
+                priority=4,
+                tags="warning",
+            )
             print("=" * 40)
+            print("Reconnecting to MQTT...")
+            from utils import wifi_connect
 
-            if updated_files:
-                ntfy_alert(
-                    "[ESP32 %s] App updated: %s" % (self._label, ", ".join(updated_files)),
-                    topic="projectbilal-events",
-                    priority=2,
-                    tags="package",
-                )
-                print("Rebooting with updated files...")
-                print("Reboot will occur after returning from callback...")
-                self.reboot_requested = True
-                return  # Exit callback cleanly, reboot will happen in mqtt_run
-            else:
-                print("No files were updated. Reconnecting to MQTT...")
-                # Reconnect to MQTT
-                from utils import wifi_connect
-
-                wifi_connect()
-                self.mqtt_connect()
-
-        if action == "ble":
-            asyncio.run(run_ble())
-
-        if action == "discover":
-            # mDNS discovery moved to mobile app to prevent WiFi instability.
-            # Respond immediately so older app versions don't hang.
-            response = {"discovery_complete": True, "total_found": 0}
-            self.mqtt.publish(topic, json.dumps(response))
-            print("Discovery delegated to mobile app")
-
-        if action == "set_device_name":
-            name = props.get("name")
-            if not name:
-                print("MQTT: set_device_name missing name")
-                return
+            wifi_connect()
+            self._updating = False  # The reconnect task brings MQTT back
+            return
+
+        # Clean up all backup files
+        print("Cleaning up backup files...")
+        for filename in backed_up:
             try:
-                import esp32
-                nvs = esp32.NVS("device")
-                nvs.set_blob("name", name)
-                nvs.commit()
-                self.device_name = name
-                print(f"MQTT: Device name saved to NVS: {name}")
-                ntfy_alert(
-                    "[ESP32 %s] Device name set: %s" % (self.id, name),
-                    topic="projectbilal-events",
-                    priority=2,
-                    tags="label",
-                )
-            except Exception as e:
-                print(f"MQTT: Failed to save device name to NVS: {e}")
-                ntfy_alert("[ESP32 %s] Failed to save device name: %s" % (self.id, e), priority=4, tags="warning")
+                os.remove("/" + filename + ".bak")
+            except:
+                pass
+        # Remove the other form of each module: a .py is imported before
+        # the .mpy that replaced it, and a replaced .mpy is dead weight
+        for filename in updated_files:
+            if filename.endswith(".mpy"):
+                stale = "/" + filename[:-4] + ".py"
+            else:
+                stale = "/" + filename[:-3] + ".mpy"
+            if file_exists(stale):
+                os.remove(stale)
+
+        # Report results
+        print("=" * 40)
+        print("App update complete - all files updated successfully")
+        print("  Updated: %s" % updated_files)
+        print("=" * 40)
+
+        if updated_files:
+            ntfy_alert(
+                "[ESP32 %s] App updated: %s" % (self._label, ", ".join(updated_files)),
+                topic="projectbilal-events",
+                priority=2,
+                tags="package",
+            )
+            print("Rebooting with updated files...")
+            print("Reboot will occur after returning from callback...")
+            self._housekeeping.after("reboot", _REBOOT_DELAY, self._reboot)
+            return  # Exit callback cleanly, the result reply goes out first
+        else:
+            print("No files were updated. Reconnecting to MQTT...")
+            # The reconnect task brings MQTT back once WiFi is up
+            from utils import wifi_connect
+
+            wifi_connect()
+            self._updating = False
+
+    @staticmethod
+    def _app_manifest(base_url):
+        """(FILES, SOURCE) from the server's manifest.py, i.e. of the version
+        being installed; the local one if the server has none. A manifest
+        without SOURCE predates .mpy files: everything is source."""
+        import os
+        from utils import download
 
-        if action == "delete_device":
+        try:
+            download(base_url + "manifest.py", "/manifest.new")
+            scope = {}
+            with open("/manifest.new") as f:
+                exec(f.read(), scope)
+            return scope["FILES"], scope.get("SOURCE", scope["FILES"])
+        except Exception as e:
+            print(f"No manifest from server ({e}), using the local one")
+        finally:
             try:
-                import esp32
+                os.remove("/manifest.new")
+            except OSError:
+                pass
+        try:
+            import manifest
+
+            return manifest.FILES, getattr(manifest, "SOURCE", manifest.FILES)
+        except ImportError:
+            return (), ()
+
+    def _disconnect_for_update(self):
+        """Drop speakers and MQTT while an update downloads. The reconnect
+        state machine waits until _updating is cleared (only a failed update
+        clears it; a good one reboots) and does not count this drop against
+        the broker."""
+        self._close_cast_pool()
+        self._updating = True
+        try:
+            if self.connected and self.mqtt:
+                self._switching = True
+                self.mqtt.disconnect()
+                self.connected = False
+                print("MQTT disconnected for update")
+        except Exception as e:
+            print(f"Error disconnecting MQTT: {e}")
+
+    async def _act_ble(self, props, topic, trace):
+        # Already inside the MQTT event loop; run BLE alongside it. One
+        # advertise loop only: a second would register the services again.
+        if self._ble_task is not None and not self._ble_task.done():
+            print("MQTT: BLE already running")
+            return
+        self._ble_task = asyncio.create_task(run_ble())
+
+    async def _act_discover(self, props, topic, trace):
+        # mDNS discovery moved to mobile app to prevent WiFi instability.
+        # Respond immediately so older app versions don't hang.
+        response = {"discovery_complete": True, "total_found": 0}
+        self.mqtt.publish(topic, json.dumps(response))
+        print("Discovery delegated to mobile app")
+
+    async def _act_set_brokers(self, props, topic, trace):
+        """
+        Replace the broker and/or ntfy server lists: props "brokers" and
+        "ntfy", each a list of "host:port" strings or [host, port] pairs,
+        tried fastest first. Stored in NVS, so they survive reboots. If the
+        broker in use is no longer listed, the connection moves now.
+        """
+        import endpoints
+
+        try:
+            brokers = props.get("brokers")
+            servers = props.get("ntfy")
+            if brokers is None and servers is None:
+                raise ValueError("brokers or ntfy required")
+            # Check both before storing either
+            if brokers is not None:
+                endpoints.parse(brokers)
+            if servers is not None:
+                endpoints.parse(servers)
+                ntfy.set_servers(servers)
+            moved = brokers is not None and self._brokers.set(brokers)
+            response = {
+                "type": "brokers",
+                "status": "success",
+                "brokers": self._brokers.health()[1],
+                "ntfy": ntfy.servers().health()[1],
+            }
+        except (ValueError, TypeError, OSError) as e:
+            print(f"MQTT: Rejected endpoint list: {e}")
+            response = {"type": "brokers", "status": "error", "message": str(e)}
+            moved = False
+        self._publish(topic, json.dumps(response))
+        if moved:
+            print("MQTT: Broker in use was removed, reconnecting...")
+            # After the replies have gone out on the old connection
+            self._housekeeping.after("brokers", _REBOOT_DELAY, self._move_broker)
+
+    async def _act_set_device_name(self, props, topic, trace):
+        name = props.get("name")
+        if not name:
+            print("MQTT: set_device_name missing name")
+            return
+        try:
+            import esp32
+            nvs = esp32.NVS("device")
+            nvs.set_blob("name", name)
+            nvs.commit()
+            self.device_name = name
+            print(f"MQTT: Device name saved to NVS: {name}")
+            ntfy_alert(
+                "[ESP32 %s] Device name set: %s" % (self.id, name),
+                topic="projectbilal-events",
+                priority=2,
+                tags="label",
+            )
+        except Exception as e:
+            print(f"MQTT: Failed to save device name to NVS: {e}")
+            ntfy_alert("[ESP32 %s] Failed to save device name: %s" % (self.id, e), priority=4, tags="warning")
 
-                nvs = esp32.NVS("wifi_creds")
-                nvs.erase_key("PASSWORD")
-                nvs.erase_key("SSID")
-                nvs.erase_key("SECURITY")
-                nvs.commit()
-                print("WiFi credentials deleted from NVS")
+    async def _act_set_schedule(self, props, topic, trace):
+        if self._schedule is None:
+            return
+        try:
+            count = self._schedule.store(props)
+            entries, first, last = self._schedule.summary()
+            print("MQTT: Schedule stored: %d entries" % count)
+            self._set_prayer_config(None)  # The server's schedule takes over
+            response = {"type": "schedule", "status": "success",
+                        "entries": entries, "first": first, "last": last}
+        except (ValueError, TypeError, KeyError, IndexError, OSError) as e:
+            print(f"MQTT: Rejected schedule: {e}")
+            response = {"type": "schedule", "status": "error", "message": str(e)}
+            ntfy_alert("[ESP32 %s] Schedule rejected: %s" % (self._label, e), priority=4, tags="warning")
+        self._schedule_changed.set()
+        self._publish(topic, json.dumps(response))
+
+    def _set_prayer_config(self, config):
+        """Save (or with None, remove) the on-device prayer-time config."""
+        import os
+
+        self._prayer = config
+        self._prayer_day = None
+        if config is None:
+            try:
+                os.remove(_PRAYER_CONFIG)
+            except OSError:
+                pass
+            return
+        with open(_PRAYER_CONFIG, "w") as f:
+            json.dump(config, f)
+
+    async def _act_set_prayer(self, props, topic, trace):
+        """
+        Compute prayer times on the device: props carry lat, lon, method,
+        asr, target (ip/port or speakers), urls {prayer name: url} and an
+        optional volume. Without lat, on-device prayer times are switched off.
+        """
+        if self._schedule is None:
+            return
+        import prayer
 
-                # Clear device name
+        if props.get("lat") is None:
+            self._set_prayer_config(None)
+            self._schedule.clear()
+            self._schedule_changed.set()
+            self._publish(topic, json.dumps({"type": "prayer", "status": "off"}))
+            return
+        try:
+            prayer.table_key(props, 2000)  # Validates method and coordinates
+            if not props.get("target") or not props.get("urls"):
+                raise ValueError("target and urls are required")
+            if unix_ms() is None:
+                # Prayer times need the date; the server can send it again
+                raise ValueError("clock not synced yet")
+            config = {
+                k: props.get(k)
+                for k in ("lat", "lon", "method", "asr", "target", "urls", "volume")
+                if props.get(k) is not None
+            }
+            self._set_prayer_config(config)
+            await self._refresh_prayer()
+            if self._prayer_table is None:
+                raise ValueError("prayer table unavailable")
+            today = self._prayer_table.day(unix_ms() // 86400000)
+            response = {
+                "type": "prayer",
+                "status": "success",
+                "today": dict(zip(prayer.NAMES, today)) if today else None,
+                "entries": self._schedule.summary()[0],
+            }
+        except (ValueError, TypeError, KeyError, OSError) as e:
+            print(f"MQTT: Rejected prayer config: {e}")
+            response = {"type": "prayer", "status": "error", "message": str(e)}
+            ntfy_alert("[ESP32 %s] Prayer config rejected: %s" % (self._label, e), priority=4, tags="warning")
+        self._publish(topic, json.dumps(response))
+
+    async def _refresh_prayer(self):
+        """
+        Refill the schedule with the next _PRAYER_DAYS days of on-device
+        prayer times, rebuilding the yearly table first if the year or the
+        config changed. Needs the clock; a no-op without it.
+        """
+        import prayer
+
+        now = unix_ms()
+        if self._prayer is None or now is None:
+            return
+        now_s = now // 1000
+        today = now_s // 86400
+        key = prayer.table_key(self._prayer, prayer.civil(today)[0])
+        if self._prayer_table is None:
+            self._prayer_table = prayer.PrayerTable()
+        if self._prayer_table.key != key:
+            t0 = time.ticks_ms()
+            await self._prayer_table.build(key)
+            print("MQTT: Prayer table for %d built in %d ms" % (key[0], time.ticks_diff(time.ticks_ms(), t0)))
+        count = self._schedule.store(
+            prayer.schedule_props(self._prayer_table, self._prayer, now_s, _PRAYER_DAYS)
+        )
+        self._prayer_day = today
+        self._schedule_changed.set()
+        print("MQTT: Schedule refilled with %d prayer times" % count)
+
+    async def _run_schedule(self):
+        """
+        Fire stored schedule entries from a local timer. Entries due at the
+        same second fire together _PREWARM_LEAD seconds early, with their
+        deadline in "at", like a play_at command from the server, so they
+        play on time even while MQTT is down.
+        """
+        while True:
+            now = unix_ms()
+            if self._prayer is not None and now is not None and self._prayer_day != now // 86400000:
+                try:
+                    await self._refresh_prayer()  # Once a day: roll the window on
+                except Exception as e:
+                    print(f"MQTT: Prayer schedule refresh failed: {e}")
+                    self._prayer_day = now // 86400000
+            self._schedule_changed.clear()
+            now = unix_ms()
+            entry = None
+            if self._schedule is not None and now is not None:
+                entry = self._schedule.next_entry(now // 1000 - _SCHEDULE_LATE)
+            wait = 60  # Re-check at least every minute (clock resync, new day)
+            if entry is not None:
+                wait = min(wait, (entry[0] - _PREWARM_LEAD) - now / 1000)
+            if wait > 0:
                 try:
-                    nvs_device = esp32.NVS("device")
-                    nvs_device.erase_key("name")
-                    nvs_device.commit()
-                    print("Device name deleted from NVS")
-                except Exception:
+                    await asyncio.wait_for(self._schedule_changed.wait(), wait)
+                except asyncio.TimeoutError:
                     pass
+                continue
+
+            at = entry[0]
+            due = []
+            while entry is not None and entry[0] == at:
+                self._schedule.mark_fired(at)
+                due.append(self._schedule.command(entry))
+                entry = self._schedule.next_entry(now // 1000 - _SCHEDULE_LATE)
+            # The dedup window runs from the deadline, where the play really
+            # happens, so a server play of the same URL sent for the prayer
+            # time is rejected
+            deadline = time.time() + (at * 1000 - now) / 1000
+            for action, props in self._merge_due(due):
+                print("MQTT: Schedule firing %s at %d" % (props["label"], at))
+                self._note_play(props.get("urls", props.get("url")), deadline)
+                for spk in props.get("speakers") or ():
+                    if spk.get("url"):
+                        self._note_play(spk["url"], deadline)
+                asyncio.create_task(
+                    self._submit_at(
+                        at * 1000,
+                        _PREWARM_LEAD * 1000,
+                        action,
+                        props,
+                        f"projectbilal/{self.id}",
+                        self._play_key(action, props),
+                    )
+                )
 
-                # Send confirmation back
-                message = {"status": "success", "message": "WiFi credentials deleted"}
-                self.mqtt.publish(topic, json.dumps(message))
-                ntfy_alert(
-                    "[ESP32 %s] WiFi credentials deleted" % self._label,
-                    topic="projectbilal-events",
-                    priority=2,
-                    tags="wastebasket",
+    @staticmethod
+    def _merge_due(commands):
+        """
+        Merge the play commands of schedule entries due at the same second
+        into one group play, each target a speaker with its own URL and
+        volume, so their LOADs go out together within the group's SSL
+        budget. Playlists keep a session each and stay separate.
+        """
+        plays = [props for action, props in commands if action == "play"]
+        if len(plays) < 2:
+            return commands
+        speakers = []
+        for props in plays:
+            volume = props.get("volume")
+            for spk in props.get("speakers") or [props]:
+                speakers.append(
+                    {
+                        "ip": spk.get("ip"),
+                        "port": spk.get("port"),
+                        "volume": volume if spk.get("volume") is None else spk.get("volume"),
+                        "url": props["url"],
+                    }
                 )
+        first = plays[0]
+        group = {
+            "url": first["url"],
+            "speakers": speakers,
+            "label": first["label"],
+            "at": first["at"],
+            "ssl_budget": first.get("ssl_budget"),
+        }
+        return [("play", group)] + [c for c in commands if c[0] != "play"]
+
+    async def _act_delete_device(self, props, topic, trace):
+        try:
+            # Stop using the schedule and outbox before their files go
+            self._schedule = None
+            self._outbox = None
+            self._prayer = None
+            self._schedule_changed.set()
+            if not clear_device_state():
+                raise OSError("could not clear NVS")
+            print("Device state deleted")
+
+            # Send confirmation back
+            message = {"status": "success", "message": "WiFi credentials deleted"}
+            self.mqtt.publish(topic, json.dumps(message))
+            ntfy_alert(
+                "[ESP32 %s] WiFi credentials deleted" % self._label,
+                topic="projectbilal-events",
+                priority=2,
+                tags="wastebasket",
+            )
 
-                # Wait a moment for message to be sent, then reboot
-                time.sleep(3)
-                print("Rebooting ESP32...")
-                import machine
+            # Wait a moment for message to be sent, then reboot
+            await asyncio.sleep(3)
+            ntfy_flush()
+            print("Rebooting ESP32...")
+            import machine
 
-                machine.reset()
-            except Exception as e:
-                error_response = {
-                    "status": "error",
-                    "message": "Failed to delete WiFi credentials: %s" % str(e),
-                }
-                self.mqtt.publish(topic, json.dumps(error_response))
-                print("Failed to delete WiFi credentials: %s" % e)
-                ntfy_alert(
-                    "[ESP32 %s] Delete WiFi credentials failed: %s" % (self._label, e),
-                    priority=4,
-                    tags="warning",
-                )
+            machine.reset()
+        except Exception as e:
+            error_response = {
+                "status": "error",
+                "message": "Failed to delete WiFi credentials: %s" % str(e),
+            }
+            self.mqtt.publish(topic, json.dumps(error_response))
+            print("Failed to delete WiFi credentials: %s" % e)
+            ntfy_alert(
+                "[ESP32 %s] Delete WiFi credentials failed: %s" % (self._label, e),
+                priority=4,
+                tags="warning",
+            )
 
-    def play(self, url, ip, port, vol, label="audio"):
+    def _deadline(self, props):
+        """Unix-ms deadline of a play_at command, or None to play now.
+        Raises ValueError (or TypeError) if "at" is not a number."""
+        at = props.get("at")
+        if at is None:
+            return None
+        at_ms = int(float(at) * 1000)
+        now = unix_ms()
+        if now is None:
+            print("MQTT: Clock not synced, playing scheduled command now")
+            return None
+        if at_ms <= now:
+            print("MQTT: play_at deadline passed %d ms ago, playing now" % (now - at_ms))
+            return None
+        return at_ms
+
+    async def play(
+        self, url, ip, port, vol, label="audio", at=None, trace=None, preload=None, rid=None
+    ):
+        """Cast url to one speaker; a list of URLs is played as a playlist.
+        rid is the request id its playback reports are tagged with."""
         import gc
         device = None
+        warm = False
         playback_confirmed = False
+        queue = isinstance(url, list)
         self._play_count += 1
+        if trace is None:
+            trace = {"_t0": time.ticks_ms(), "_t": time.ticks_ms()}
+        _phase(trace, "dispatch")
         try:
             print(
                 f"MQTT: Playing audio - URL: {url}, IP: {ip}, Port: {port}, Vol: {vol}"
@@ -468,28 +1201,11 @@ class MQTTHandler(object):
             gc.collect()
 
             # Lazy import to save baseline RAM
-            from cast import Chromecast
+            import cast
 
+            self._cast = cast
             gc.collect()
 
-            # Create Chromecast connection (retry once if speaker is asleep)
-            try:
-                device = Chromecast(ip, port)
-            except OSError as e:
-                if "ETIMEDOUT" in str(e):
-                    print("MQTT: Speaker may be asleep, retrying in 3s...")
-                    ntfy_alert(
-                        "[ESP32 %s] Speaker wake retry: %s" % (self._label, label),
-                        topic="projectbilal-events",
-                        priority=2,
-                        tags="speaker",
-                    )
-                    gc.collect()
-                    time.sleep(3)
-                    device = Chromecast(ip, port)
-                else:
-                    raise
-
             # Play URL with volume (volume is set after app launch, before media load)
             if vol is not None:
                 ntfy_alert(
@@ -498,11 +1214,44 @@ class MQTTHandler(object):
                     priority=2,
                     tags="speaker",
                 )
-            playback_confirmed = device.play_url(url, volume=vol)
+
+            # Reuse a warm pooled connection when the speaker is still attached,
+            # falling back to a cold connect if the session died underneath us
+            device = cast.pooled(ip, port)
+            prepared = None
+            if device:
+                print("MQTT: Reusing warm Chromecast connection")
+                warm = True
+                _phase(trace, "connect")
+                try:
+                    prepared = await device.prepare(vol)
+                    if not prepared or device.closed:
+                        raise OSError("session closed by speaker")
+                except OSError as e:
+                    print("MQTT: Warm connection failed (%s), reconnecting..." % e)
+                    device.disconnect()
+                    device = None
+                    warm = False
+            if device is None:
+                device = await self._cast_connect(ip, port, label)
+                _phase(trace, "connect")
+                prepared = await device.prepare(vol)
+            _phase(trace, "prepare")
+
+            # play_at: the speaker is awake and the app launched, start on time
+            if at is not None and prepared:
+                await _sleep_until(at)
+                _phase(trace, "wait")
+            if prepared and await device.load(url, preload):
+                if at is not None:
+                    trace["jitter"] = unix_ms() - at
+                playback_confirmed = await device.confirmed()
+            _phase(trace, "cast")
+            trace.update(device.timings)  # tcp, tls, status, launch, load
 
             if playback_confirmed:
                 self._play_confirmed_count += 1
-                time.sleep(2)
+                await asyncio.sleep(2)
                 print("MQTT: Audio playback confirmed, starting...")
                 ntfy_alert(
                     "[ESP32 %s] Playback confirmed: %s" % (self._label, label),
@@ -514,7 +1263,7 @@ class MQTTHandler(object):
                 print(
                     "MQTT: Playback not confirmed, waiting longer for Chromecast to start..."
                 )
-                time.sleep(5)
+                await asyncio.sleep(5)
                 ntfy_alert(
                     "[ESP32 %s] Playback NOT confirmed: %s" % (self._label, label),
                     topic="projectbilal-events",
@@ -530,278 +1279,674 @@ class MQTTHandler(object):
             sys.print_exception(e)
 
         finally:
-            # Always disconnect to clean up resources
+            # Keep a confirmed session warm for the next play, close anything else
+            trace["_t"] = time.ticks_ms()
             if device:
                 try:
-                    device.disconnect()
-                    print("MQTT: Chromecast connection closed")
+                    if playback_confirmed and queue:
+                        # The session stays open to follow the playlist
+                        asyncio.create_task(self._watch_queue(device, url, label, rid))
+                    elif playback_confirmed:
+                        self._cast.keep(device)
+                        print("MQTT: Chromecast connection kept warm")
+                    else:
+                        device.disconnect()
+                        print("MQTT: Chromecast connection closed")
                 except Exception as disconnect_e:
                     print(f"MQTT: Error during disconnect: {disconnect_e}")
+            _phase(trace, "disconnect")
 
             # Free SSL memory immediately
             gc.collect()
 
-            # Proactive WiFi health check after casting
-            # Casting often kills WiFi — detect and recover immediately
-            # instead of waiting for the next MQTT ping to fail
-            import network
-            wlan = network.WLAN(network.STA_IF)
-            if not wlan.isconnected():
-                print("MQTT: WiFi dropped after cast, resetting radio...")
-                from utils import wifi_connect
-                wifi_ip = wifi_connect()
-                if wifi_ip:
-                    print(f"MQTT: WiFi recovered with IP: {wifi_ip}")
-                    # Flag for fast reconnect in mqtt_run loop
-                    self._post_cast_reconnect = True
-                else:
-                    print("MQTT: WiFi recovery failed, will retry in main loop")
-
-            # Report playback result to MQTT status topic
-            # MQTT often drops after cast, so queue for reconnection if needed
-            result = json.dumps({
-                "type": "playback_result",
-                "confirmed": playback_confirmed,
-                "label": label,
-                "timestamp": time.time(),
-            })
-            try:
-                if self.connected and self.mqtt:
-                    self.mqtt.publish(self.lwt_topic, result)
-                    print("MQTT: Playback result sent")
-                else:
-                    self._pending_playback_result = result
-                    print("MQTT: Playback result queued for after reconnect")
-            except Exception:
-                self._pending_playback_result = result
-
-    def mqtt_run(self):
-        print("Connected and listening to MQTT Broker")
-        counter = 0
-        health_counter = 0
-        reconnect_attempts = 0
-        reconnect_delay = 5  # Start with 5 seconds
-        max_reconnect_delay = 60  # Max 60 seconds between attempts
-        _HEALTH_INTERVAL = 600  # Publish health every ~600 seconds (~10 minutes)
-
-        # Enable hardware watchdog (120s timeout)
-        from machine import WDT, Pin
-        wdt = WDT(timeout=120000)
+            self._check_wifi_after_cast()
+            self._report_playback(
+                {
+                    "type": "playback_result",
+                    "confirmed": playback_confirmed,
+                    "label": label,
+                    "warm": warm,
+                    "items": len(url) if queue else 1,
+                    "timings": self._finish_trace(trace),
+                    "timestamp": time.time(),
+                },
+                rid,
+            )
 
-        while True:
-            try:
-                time.sleep(1)
-                wdt.feed()
-
-                # Check if reboot was requested during message handling
-                if self.reboot_requested:
-                    print("Executing requested reboot...")
-                    time.sleep(1)
-                    machine.reset()
-
-                # Check for factory reset button (non-blocking check every second)
-                button = Pin(0, Pin.IN, Pin.PULL_UP)
-                if button.value() == 0:  # Button pressed
-                    if check_reset_button():
-                        print("Factory reset confirmed during MQTT operation!")
-                        clear_device_state()
-                        time.sleep(1)
-                        machine.reset()
-
-                # Check for messages
-                try:
-                    self.mqtt.check_msg()
-                except OSError as e:
-                    err = e.errno if hasattr(e, 'errno') else 0
-                    if err == 9 or err == 113:  # EBADF or ECONNABORTED
-                        print(f"Socket corruption detected (errno {err}), forcing WiFi reset...")
-                        import network
-                        wlan = network.WLAN(network.STA_IF)
-                        wlan.disconnect()
-                        wlan.active(False)
-                        time.sleep(3)
-                    print(f"Network error during check_msg: {e}")
-                    raise Exception(f"Network error: {e}")
-                except Exception as e:
-                    error_str = str(e)
-                    if "index out of range" in error_str or "bytes index" in error_str:
-                        print(f"MQTT library error (malformed packet): {e}")
-                        raise Exception("Library error - reconnecting")
-                    else:
-                        raise
+    async def play_group(
+        self, url, speakers, vol, label="audio", ssl_budget=None, at=None, trace=None, rid=None
+    ):
+        """Cast to several speakers at once; speakers are (ip, port, volume,
+        url), where a url of None means the group's url."""
+        import gc
+        results = []
+        timings = [None] * len(speakers)
+        self._play_count += 1
+        if trace is None:
+            trace = {"_t0": time.ticks_ms(), "_t": time.ticks_ms()}
+        _phase(trace, "dispatch")
+        try:
+            print(f"MQTT: Group play - URL: {url}, Speakers: {speakers}, Vol: {vol}")
+            gc.collect()
 
-                counter += 1
-                health_counter += 1
+            # Lazy import to save baseline RAM
+            import cast
 
-                # Periodic health reporting
-                if health_counter >= _HEALTH_INTERVAL:
-                    health_counter = 0
-                    try:
-                        import gc
-                        health = json.dumps({
-                            "type": "health",
-                            "uptime": int(time.time() - self._start_time),
-                            "plays": self._play_count,
-                            "confirmed": self._play_confirmed_count,
-                            "errors": self._error_count,
-                            "free_mem": gc.mem_free(),
-                            "firmware": FIRMWARE_VERSION,
-                        })
-                        self.mqtt.publish(f"projectbilal/{self.id}/health", health)
-                        # Reset counters after successful report to prevent unbounded growth
-                        self._play_count = 0
-                        self._play_confirmed_count = 0
-                        self._error_count = 0
-                    except Exception:
-                        pass  # Best-effort
-
-                if counter >= _PING_INTERVAL:
-                    counter = 0
-
-                    if not self.connected or not self.mqtt:
-                        raise Exception("Connection not established")
-
-                    ping_failed = False
-                    for ping_attempt in range(2):
-                        try:
-                            self.mqtt.ping()
-                            reconnect_attempts = 0
-                            reconnect_delay = 5
-                            ping_failed = False
-                            break
-                        except Exception as ping_error:
-                            ping_failed = True
-                            if ping_attempt == 0:
-                                print(
-                                    f"Ping failed (attempt 1/2): {ping_error}, retrying..."
-                                )
-                                time.sleep(1)
-                            else:
-                                print(f"Ping failed (attempt 2/2): {ping_error}")
-
-                    if ping_failed:
-                        raise Exception("Connection lost - ping failed after retries")
+            self._cast = cast
+            gc.collect()
 
-            except Exception as e:
-                self.connected = False  # Mark disconnected immediately
-                self._error_count += 1
-                error_str = str(e)
-
-                if (
-                    "bytes index out of range" in error_str
-                    or "index out of range" in error_str
-                ):
-                    print(f"MQTT library error (likely malformed packet): {e}")
-                    print("Attempting to recover by reconnecting...")
-                else:
-                    print(f"MQTT connection lost: {e}")
+            async def wait():
+                # play_at: hold the LOADs until the deadline
+                if at is not None:
+                    await _sleep_until(at)
+                    trace["jitter"] = unix_ms() - at
+
+            results = await cast.play_group(
+                speakers,
+                url,
+                vol,
+                ssl_budget,
+                timings=timings,
+                before_load=wait,
+            )
+            _phase(trace, "cast")
 
-                reconnect_attempts += 1
-                print(f"Attempting to reconnect (attempt {reconnect_attempts})")
+            confirmed = sum(1 for ok in results if ok)
+            if confirmed:
+                self._play_confirmed_count += 1
+            ntfy_alert(
+                "[ESP32 %s] Group playback confirmed on %d/%d speakers: %s"
+                % (self._label, confirmed, len(speakers), label),
+                topic="projectbilal-events",
+                priority=2 if confirmed == len(speakers) else 3,
+                tags="speaker" if confirmed == len(speakers) else "warning",
+            )
 
-                # Reboot safety valve — with mDNS disabled, 5 failures means
-                # something is seriously wrong
-                if reconnect_attempts >= 3:
-                    print("Too many reconnect failures, rebooting...")
-                    ntfy_alert(
-                        "[ESP32 %s] Rebooting after %d reconnect failures" % (self._label, reconnect_attempts),
-                        priority=4,
-                        tags="warning",
-                    )
-                    time.sleep(2)
-                    machine.reset()
+        except Exception as e:
+            self._error_count += 1
+            print("MQTT: Group play error: %s" % e)
+            ntfy_alert("[ESP32 %s] Group play failed: %s" % (self._label, e), priority=4, tags="warning")
+            import sys
+            sys.print_exception(e)
 
-                # Clean up current connection
-                try:
-                    if self.mqtt:
-                        self.mqtt.disconnect()
-                except Exception as e:
-                    print(f"MQTT disconnect error during cleanup: {e}")
-                self.mqtt = None  # Free socket even if disconnect failed
-
-                # Fast reconnect after casting (WiFi already recovered in play())
-                if self._post_cast_reconnect:
-                    self._post_cast_reconnect = False
-                    reconnect_delay = 2
-                    print("Fast reconnect after cast (2s)...")
-                    time.sleep(2)
+        finally:
+            gc.collect()
+            self._check_wifi_after_cast()
+            self._report_playback(
+                {
+                    "type": "playback_result",
+                    "confirmed": bool(results) and all(results),
+                    "label": label,
+                    "speakers": [
+                        {
+                            "ip": spk[0],
+                            "port": spk[1],
+                            "confirmed": i < len(results) and results[i],
+                            "timings": timings[i],
+                        }
+                        for i, spk in enumerate(speakers)
+                    ],
+                    "timings": self._finish_trace(trace),
+                    "timestamp": time.time(),
+                },
+                rid,
+            )
+
+    async def _watch_queue(self, device, urls, label, rid):
+        """Report each playlist item as the speaker finishes it, then park
+        the session like a single play would. This runs after the play job
+        has left the worker, so its request id rid is passed in."""
+        reason = None
+        self._cast.watch(device)  # Counts against the pool's SSL budget
+        try:
+            for i, url in enumerate(urls):
+                reason = await device.item_done(i, _QUEUE_ITEM_TIMEOUT * 1000)
+                print("MQTT: Playlist item %d/%d %s" % (i + 1, len(urls), reason))
+                self._report_playback(
+                    {
+                        "type": "queue_item",
+                        "label": label,
+                        "index": i,
+                        "url": url,
+                        "status": reason or "timeout",
+                        "timestamp": time.time(),
+                    },
+                    rid,
+                )
+                if reason is None:
+                    break
+        finally:
+            self._cast.unwatch(device)
+            # An interrupted queue means another play took the speaker over
+            if reason == "FINISHED" or reason == "ERROR":
+                self._cast.keep(device)
+            else:
+                device.disconnect()
+
+    @staticmethod
+    def _lead_ms(props):
+        """How long before its deadline a play_at warms the speaker: props
+        "lead" seconds, clamped to 0-_PREWARM_MAX. Raises ValueError (or
+        TypeError) if it is not a number."""
+        lead = float(props.get("lead", _PREWARM_LEAD))
+        return int(min(max(lead, 0), _PREWARM_MAX) * 1000)
+
+    @staticmethod
+    def _command_age(msg, props):
+        """
+        Seconds since a command was sent, from its "ts" (unix seconds, set by
+        the publisher) or, for play_at, since its "at" deadline. None if the
+        command carries neither or the clock is not synced.
+        """
+        sent = msg.get("ts", props.get("at"))
+        now = unix_ms()
+        if sent is None or now is None:
+            return None
+        return now / 1000 - float(sent)
+
+    @staticmethod
+    def _new_session_stats():
+        # resume: [count, total_ms, max_ms] from connection lost to subscribed
+        # wifi: the same for the part of an incident the radio was down
+        return {
+            "resume": [0, 0, 0],
+            "wifi": [0, 0, 0],
+            "retries": 0,
+            "fast": 0,
+            "kept": 0,
+            "backlog": 0,
+            "stale": 0,
+        }
+
+    def _record_resume(self, kept):
+        """Fold one reconnect's time-to-resume into the session stats."""
+        if self._down_tick is None:
+            return  # First connection since boot
+        ms = time.ticks_diff(time.ticks_ms(), self._down_tick)
+        self._down_tick = None
+        stat = self._session_stats["resume"]
+        stat[0] += 1
+        stat[1] += ms
+        stat[2] = max(stat[2], ms)
+        if kept:
+            self._session_stats["kept"] += 1
+        print("MQTT: Resumed %d ms after connection loss" % ms)
+
+    def _record_wifi(self, since):
+        """Fold one WiFi outage (ticks it began) into the session stats."""
+        if since is None:
+            return
+        ms = time.ticks_diff(time.ticks_ms(), since)
+        stat = self._session_stats["wifi"]
+        stat[0] += 1
+        stat[1] += ms
+        stat[2] = max(stat[2], ms)
+
+    def _session_health(self):
+        """Reconnect metrics since the last health report."""
+        stats = self._session_stats
+        resume = stats["resume"]
+        wifi = stats["wifi"]
+        return {
+            "resumes": resume[0],
+            "kept": stats["kept"],
+            # Time to recover per incident: [avg_ms, max_ms]
+            "resume_ms": [resume[1] // resume[0] if resume[0] else 0, resume[2]],
+            "wifi_outages": wifi[0],
+            "wifi_ms": [wifi[1] // wifi[0] if wifi[0] else 0, wifi[2]],
+            "retries": stats["retries"],
+            "fast": stats["fast"],
+            "backlog": stats["backlog"],
+            "stale": stats["stale"],
+        }
+
+    @staticmethod
+    def _new_queue_stats():
+        # depth: most jobs waiting at once; wait: [count, total_ms, max_ms]
+        return {"depth": 0, "wait": [0, 0, 0], "coalesced": 0, "dropped": 0}
+
+    def _queue_health(self):
+        """Work queue metrics since the last health report."""
+        stats = self._queue_stats
+        wait = stats["wait"]
+        return {
+            "depth": len(self._jobs),
+            "max_depth": stats["depth"],
+            "wait": [wait[1] // wait[0] if wait[0] else 0, wait[2]],
+            "coalesced": stats["coalesced"],
+            "dropped": stats["dropped"],
+        }
+
+    def _finish_trace(self, trace):
+        """Close a play trace: add the total and fold it into the health stats."""
+        trace["total"] = time.ticks_diff(time.ticks_ms(), trace.pop("_t0"))
+        trace.pop("_t", None)
+        for name, ms in trace.items():
+            stat = self._phase_stats.get(name)
+            if stat is None:
+                self._phase_stats[name] = [1, ms, ms]
+            else:
+                stat[0] += 1
+                stat[1] += ms
+                stat[2] = max(stat[2], ms)
+        return trace
+
+    def _check_wifi_after_cast(self):
+        """
+        Proactive WiFi health check after casting.
+        Casting often kills WiFi — detect and recover immediately
+        instead of waiting for the next MQTT ping to fail.
+        """
+        import network
+        wlan = network.WLAN(network.STA_IF)
+        if not wlan.isconnected():
+            print("MQTT: WiFi dropped after cast, resetting radio...")
+            self._close_cast_pool()
+            if self.mqtt:
+                self.mqtt.close()  # Socket is dead; wake the reconnect task
+            from utils import wifi_connect
+            wifi_ip = wifi_connect()
+            if wifi_ip:
+                print(f"MQTT: WiFi recovered with IP: {wifi_ip}")
+                # Lets the reconnect state machine skip the backoff
+                self._post_cast_reconnect = True
+            else:
+                print("MQTT: WiFi recovery failed, will retry in main loop")
+
+    def _report_playback(self, result, rid):
+        """
+        Report playback result to MQTT status topic, tagged with rid, the
+        id of the request that started the play (None without one).
+        MQTT often drops after cast, so it may wait in the outbox.
+        """
+        if rid is not None:
+            result["id"] = rid
+        if self._publish(self.lwt_topic, json.dumps(result)):
+            print("MQTT: Playback result sent")
+        else:
+            print("MQTT: Playback result queued for after reconnect")
+
+    def _publish(self, topic, msg):
+        """
+        Publish now if connected, otherwise (or if the publish fails) keep the
+        message in the outbox for the next connection. True if sent now.
+        """
+        try:
+            if self.connected and self.mqtt:
+                self.mqtt.publish(topic, msg)
+                return True
+        except Exception as e:
+            print(f"MQTT: Publish failed: {e}")
+        if self._outbox:
+            self._outbox.put(topic, msg)
+        return False
+
+    async def _flush_outbox(self):
+        """Send stored telemetry (QoS1, batched), oldest first."""
+        outbox = self._outbox
+        if not outbox or not len(outbox) or self._flushing:
+            return
+        self._flushing = True
+        count = len(outbox)
+        try:
+            if await outbox.flush(self.mqtt):
+                print("MQTT: Sent %d stored messages from outbox" % count)
+            else:
+                print("MQTT: Outbox flush incomplete, %d left" % len(outbox))
+        except Exception as e:
+            print(f"MQTT: Outbox flush failed: {e}")
+        finally:
+            self._flushing = False
+
+    async def _cast_connect(self, ip, port, label):
+        """Cold-connect to a Chromecast (retry once if the speaker is asleep)."""
+        self._cast.evict()
+        try:
+            return await self._cast.connect(ip, port)
+        except OSError as e:
+            if "ETIMEDOUT" not in str(e):
+                raise
+            print("MQTT: Speaker may be asleep, retrying in 3s...")
+            ntfy_alert(
+                "[ESP32 %s] Speaker wake retry: %s" % (self._label, label),
+                topic="projectbilal-events",
+                priority=2,
+                tags="speaker",
+            )
+            import gc
+            gc.collect()
+            await asyncio.sleep(3)
+            return await self._cast.connect(ip, port)
+
+    def _close_cast_pool(self):
+        """Drop warm Chromecast sessions to free sockets and SSL memory."""
+        if self._cast:
+            try:
+                self._cast.close_pool()
+            except Exception as e:
+                print(f"MQTT: Error closing cast pool: {e}")
+
+    async def mqtt_run(self):
+        """
+        Serve MQTT until reboot. Incoming commands are handled by the client's
+        reader task as soon as they arrive; keepalive, health reporting and
+        the other housekeeping run from the housekeeping scheduler, and this
+        task runs the connection state machine.
+        """
+        print("Listening to MQTT Broker" if self.connected else "MQTT: Not connected yet, retrying...")
+        start_reset_button(self._factory_reset)
+        asyncio.create_task(self._worker())
+        self._start_housekeeping()
+        asyncio.create_task(self._run_schedule())
+        await self._reconnect()
+
+    @staticmethod
+    def _factory_reset():
+        """Reset button callback: send queued alerts, then wipe and reboot."""
+        print("Factory reset confirmed during MQTT operation!")
+        ntfy_flush()
+        factory_reset()
+
+    def _start_housekeeping(self):
+        """Register the periodic jobs and start the task that runs them. Each
+        job runs on its own deadline; the task sleeps until the next one."""
+        from machine import WDT
+        wdt = WDT(timeout=_WDT_TIMEOUT)
+        jobs = self._housekeeping
+        jobs.every("wdt", _WDT_FEED, wdt.feed)
+        jobs.every("pool", _POOL_INTERVAL, self._service_pool)
+        jobs.every("ping", _PING_INTERVAL * 1000, self._keepalive)
+        jobs.every("health", _HEALTH_INTERVAL * 1000, self._health)
+        jobs.every("brokers", _PROBE_INTERVAL * 1000, self._probe_brokers)
+        asyncio.create_task(jobs.run())
+
+    @staticmethod
+    def _reboot():
+        """Reboot requested by an action (e.g. after update_app)."""
+        print("Executing requested reboot...")
+        ntfy_flush()
+        time.sleep(1)
+        machine.reset()
+
+    def _service_pool(self):
+        """Answer speaker heartbeats so warm cast sessions stay open."""
+        if self._cast:
+            try:
+                self._cast.service_pool()
+            except Exception as e:
+                print(f"MQTT: Error servicing cast pool: {e}")
+
+    async def _probe_brokers(self):
+        """
+        Measure the connect RTT of every broker endpoint with a throwaway
+        clean session, every _PROBE_INTERVAL, and move to one that is clearly
+        faster than the broker in use.
+        """
+        brokers = self._brokers
+        if len(brokers.list) < 2 or not self.connected:
+            return
+        for i, (host, port) in enumerate(brokers.list):
+            probe = MQTTClient(client_id=self.id + "-probe", server=host, port=port)
+            start = time.ticks_ms()
+            try:
+                await probe.connect(clean_session=True, timeout_s=_PROBE_TIMEOUT)
+                brokers.ok(i, time.ticks_diff(time.ticks_ms(), start))
+            except Exception as e:
+                print("MQTT: Probe of %s:%d failed: %s" % (host, port, e))
+                if i != brokers.current:
+                    brokers.failed(i)
+            probe.disconnect()
+        current, best = brokers.current, brokers.pick()
+        if current is None or best == current or not self.connected:
+            return
+        now_rtt, best_rtt = brokers.rtt(current), brokers.rtt(best)
+        if now_rtt is None or best_rtt is None:
+            return
+        if now_rtt > 2 * best_rtt and now_rtt - best_rtt > _SWITCH_MARGIN:
+            print("MQTT: Moving to faster broker %s:%d (%d ms vs %d ms)"
+                  % (brokers.list[best][0], brokers.list[best][1], best_rtt, now_rtt))
+            self._move_broker()
+
+    def _move_broker(self):
+        """Close the connection without blaming the broker; the reconnect
+        state machine then connects to the one pick() prefers."""
+        if self.connected and self.mqtt:
+            self._switching = True
+            self.mqtt.close()
+
+    async def _keepalive(self):
+        """PINGREQ, every _PING_INTERVAL. A broker that has been silent for the
+        whole keepalive period means the socket is dead even without an error."""
+        client = self.mqtt
+        if not self.connected or client is None or client.closed:
+            return
+        if time.ticks_diff(time.ticks_ms(), client.last_rx) > _KEEPALIVE * 1000:
+            print("MQTT: No reply from broker in %ds" % _KEEPALIVE)
+            client.close()
+            return
+        try:
+            client.ping()
+            await client.drain()
+        except Exception as ping_error:
+            print(f"Ping failed: {ping_error}")
+            client.close()
+
+    async def _health(self):
+        """Publish health, every _HEALTH_INTERVAL seconds."""
+        sync_clock(_CLOCK_MAX_AGE)
+        try:
+            import gc
+            health = json.dumps({
+                "type": "health",
+                "uptime": int(time.time() - self._start_time),
+                "plays": self._play_count,
+                "confirmed": self._play_confirmed_count,
+                "errors": self._error_count,
+                "free_mem": gc.mem_free(),
+                # [free after import, open TLS sessions, heap per session]
+                "heap": [self.boot_free]
+                + (self._cast.heap_stats() if self._cast else [0, 0]),
+                "firmware": FIRMWARE_VERSION,
+                # Per-phase play latency since last report: [avg_ms, max_ms]
+                "timings": {
+                    name: [stat[1] // stat[0], stat[2]]
+                    for name, stat in self._phase_stats.items()
+                },
+                "queue": self._queue_health(),
+                "session": self._session_health(),
+                # Local schedule: [entries, first at, last at]
+                "schedule": self._schedule.summary() if self._schedule else None,
+                # Stored telemetry, in slots: [unsent, overwritten before sending]
+                "outbox": [len(self._outbox), self._outbox.dropped]
+                if self._outbox
+                else None,
+                # Alerts: [queued, sent, POSTs, dropped, failed POSTs]
+                "ntfy": ntfy.health(),
+                # Servers: [index in use, [["host:port", rtt ms, failures], ...]]
+                "endpoints": {
+                    "mqtt": self._brokers.health(),
+                    "ntfy": ntfy.servers().health(),
+                },
+                # Housekeeping jobs since last report:
+                # name -> [runs, avg late ms, max late ms, missed runs]
+                "jobs": self._housekeeping.stats(),
+            })
+            # Kept in the outbox while offline, so counters can reset either way
+            if self._publish(f"projectbilal/{self.id}/health", health):
+                await self._flush_outbox()
+            # Reset counters after report to prevent unbounded growth
+            self._play_count = 0
+            self._play_confirmed_count = 0
+            self._error_count = 0
+            self._phase_stats = {}
+            self._queue_stats = self._new_queue_stats()
+            self._session_stats = self._new_session_stats()
+        except Exception:
+            pass  # Best-effort
+
+    def _drop_client(self):
+        """Close the current client, if any, and forget it."""
+        try:
+            if self.mqtt:
+                self.mqtt.disconnect()
+        except Exception as e:
+            print(f"MQTT disconnect error during cleanup: {e}")
+        self.mqtt = None  # Free socket even if disconnect failed
+
+    def _connection_lost(self, wlan):
+        """Start an incident after the connection dropped; returns the state
+        to recover from."""
+        self.connected = False  # Mark disconnected immediately
+        if self._down_tick is None:
+            self._down_tick = time.ticks_ms()
+        self._error_count += 1
+
+        err = self.mqtt.error if self.mqtt else None
+        errno = err.errno if hasattr(err, "errno") else 0
+        self._drop_client()
+        broker = self._brokers.current
+        if self._switching:
+            self._switching = False
+        elif broker is not None and wlan.isconnected() and not self._post_cast_reconnect:
+            self._brokers.failed(broker)  # Prefer another broker for a while
+        if errno == 9 or errno == 113:  # EBADF or ECONNABORTED
+            print(f"Socket corruption detected (errno {errno}), forcing WiFi reset...")
+            wlan.disconnect()
+            wlan.active(False)
+            return _WIFI_DOWN
+        print("MQTT connection lost (%s)" % (err or "closed"))
+        return _BROKER_DOWN if wlan.isconnected() else _WIFI_DOWN
+
+    async def _reconnect(self):
+        """
+        Connection state machine, for as long as the device runs:
+
+            CONNECTED   --connection lost--> BROKER_DOWN, or WIFI_DOWN if
+                                             the radio is down too
+            WIFI_DOWN   --wifi_connect()---> BROKER_DOWN
+            BROKER_DOWN --mqtt_connect()---> CONNECTED
+            BROKER_DOWN --WiFi lost--------> WIFI_DOWN
+
+        WiFi and broker retries back off separately and with jitter, so a
+        fleet that lost the broker together does not reconnect in lockstep.
+        A drop right after a cast, whose WiFi was already recovered in the
+        play path, retries the broker after a short fixed delay instead. The
+        device only reboots once an incident has gone _STUCK_AFTER seconds
+        without recovering.
+        """
+        import network
+        from utils import wifi_connect
+
+        wlan = network.WLAN(network.STA_IF)
+        wifi_backoff = Backoff(_WIFI_BACKOFF, _WIFI_BACKOFF_CAP)
+        broker_backoff = Backoff(_BROKER_BACKOFF, _BROKER_BACKOFF_CAP)
+        failover = Backoff(_FAILOVER_DELAY, _FAILOVER_DELAY)  # Jitter only
+        state = _CONNECTED
+        delay = 0  # ms before the next attempt
+        failures = 0  # Failed WiFi and broker attempts in this incident
+        down = wifi_down = None  # Ticks the incident / WiFi outage began
+
+        while True:
+            if state == _CONNECTED:
+                if self.mqtt and not self.mqtt.closed:
+                    await self.mqtt.wait_closed()
+                while self._updating:  # The update dropped the link itself
+                    await asyncio.sleep(1)
+                state = self._connection_lost(wlan)
+                down = self._down_tick
+                wifi_down = down if state == _WIFI_DOWN else None
+                wifi_backoff.reset()
+                broker_backoff.reset()
+                failures = 0
+                if self._post_cast_reconnect and state == _BROKER_DOWN:
+                    print("Fast reconnect after cast (%d ms)..." % _FAST_RECONNECT)
+                    self._session_stats["fast"] += 1
+                    delay = _FAST_RECONNECT
                 else:
-                    # Sleep in chunks to keep watchdog fed
-                    print(f"Waiting {reconnect_delay} seconds before reconnect...")
-                    remaining = reconnect_delay
-                    while remaining > 0:
-                        time.sleep(min(remaining, 30))
-                        remaining -= 30
-                        wdt.feed()
-                wdt.feed()
-
-                # Verify WiFi before MQTT reconnect
-                import network
-                wlan = network.WLAN(network.STA_IF)
-                if not wlan.isconnected():
-                    print("WiFi disconnected, reconnecting WiFi first...")
-                    wdt.feed()
-                    from utils import wifi_connect
-                    wifi_ip = wifi_connect()
-                    if not wifi_ip:
-                        print("WiFi reconnect failed, will retry...")
-                        ntfy_alert(
-                            "[ESP32 %s] WiFi reconnect failed (attempt %d)" % (self._label, reconnect_attempts),
-                            priority=4,
-                            tags="warning",
-                        )
-                        reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
-                        continue
-                    ntfy_alert(
-                        "[ESP32 %s] WiFi reconnected before MQTT" % self._label,
-                        topic="projectbilal-events",
-                        priority=2,
-                        tags="electric_plug",
-                    )
+                    delay = (wifi_backoff if state == _WIFI_DOWN else broker_backoff).next()
+                self._post_cast_reconnect = False
+                continue
 
-                # Attempt to reconnect MQTT
-                wdt.feed()
-                try:
-                    success = self.mqtt_connect()
-                    if success:
-                        print("Reconnection successful!")
-                        ntfy_alert(
-                            "[ESP32 %s] Reconnected after disconnect" % self._label,
-                            topic="projectbilal-events",
-                            priority=2,
-                            tags="electric_plug",
-                        )
-                        self.send_status_update("online")
-
-                        # Flush any pending playback result from before disconnect
-                        if self._pending_playback_result:
-                            try:
-                                self.mqtt.publish(self.lwt_topic, self._pending_playback_result)
-                                print("MQTT: Sent pending playback result after reconnect")
-                            except Exception:
-                                pass
-                            self._pending_playback_result = None
-
-                        reconnect_attempts = 0
-                        reconnect_delay = 5
-                        counter = 0
-                        health_counter = 0
-                    else:
-                        print("Reconnection failed")
+            stuck = time.ticks_diff(time.ticks_ms(), down) // 1000
+            if stuck >= _STUCK_AFTER:
+                print("Connection not recovered in %ds, rebooting..." % stuck)
+                ntfy_alert(
+                    "[ESP32 %s] Rebooting, %s for %ds after %d failed attempts"
+                    % (self._label, _STATE_NAMES[state], stuck, failures),
+                    priority=4,
+                    tags="warning",
+                )
+                ntfy_flush()
+                time.sleep(2)
+                machine.reset()
+
+            print("MQTT: %s, next attempt in %d ms" % (_STATE_NAMES[state], delay))
+            await asyncio.sleep(delay / 1000)
+            while self._updating:  # Started while the link was already down
+                await asyncio.sleep(1)
+
+            if state == _WIFI_DOWN:
+                wifi_ip = wifi_connect()
+                if not wifi_ip:
+                    print("WiFi reconnect failed, will retry...")
+                    failures += 1
+                    if failures & (failures - 1) == 0:  # 1st, 2nd, 4th, 8th...
                         ntfy_alert(
-                            "[ESP32 %s] MQTT reconnect failed after %s attempts"
-                            % (self._label, reconnect_attempts),
+                            "[ESP32 %s] WiFi reconnect failed (attempt %d)"
+                            % (self._label, failures),
                             priority=4,
                             tags="warning",
                         )
-                        reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
+                    delay = wifi_backoff.next()
+                    continue
+                self._record_wifi(wifi_down)
+                wifi_down = None
+                ntfy_alert(
+                    "[ESP32 %s] WiFi reconnected before MQTT" % self._label,
+                    topic="projectbilal-events",
+                    priority=2,
+                    tags="electric_plug",
+                )
+                state = _BROKER_DOWN
+                broker_backoff.reset()
+                delay = broker_backoff.next()
+                continue
 
-                except Exception as reconnect_error:
-                    print("Reconnection attempt failed: %s" % reconnect_error)
+            # _BROKER_DOWN
+            if not wlan.isconnected():
+                print("WiFi disconnected, reconnecting WiFi first...")
+                state = _WIFI_DOWN
+                wifi_down = time.ticks_ms()
+                delay = wifi_backoff.next()
+                continue
+            self._drop_client()  # Leftovers of a failed attempt
+            try:
+                await self.mqtt_connect()
+            except Exception as reconnect_error:
+                print("Reconnection attempt failed: %s" % reconnect_error)
+                self._error_count += 1
+                self._session_stats["retries"] += 1
+                failures += 1
+                if failures & (failures - 1) == 0:
                     ntfy_alert(
                         "[ESP32 %s] MQTT reconnect failed after %s attempts"
-                        % (self._label, reconnect_attempts),
+                        % (self._label, failures),
                         priority=4,
                         tags="warning",
                     )
-                    reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
+                # Another broker that is not cooling down gets tried at once
+                if self._brokers.available(self._brokers.current):
+                    delay = failover.next()
+                else:
+                    delay = broker_backoff.next()
+                continue
+            recovered = time.ticks_diff(time.ticks_ms(), down)
+            print("Reconnection successful!")
+            ntfy_alert(
+                "[ESP32 %s] Reconnected after disconnect (%ds, %d failed attempts)"
+                % (self._label, recovered // 1000, failures),
+                topic="projectbilal-events",
+                priority=2,
+                tags="electric_plug",
+            )
+            state = _CONNECTED
@@ -0,0 +1,243 @@
+import uasyncio as asyncio
+import utime as time
+from micropython import const
+
+# ntfy alert dispatcher. Once start() has been called, alerts are queued in
+# memory and a background task sends them: bursts are coalesced into one
+# multi-line POST per topic over a kept-alive HTTP connection, POSTs are
+# rate limited, and nothing is sent while a cast holds the dispatcher (so
+# alerts never compete with the Chromecast TLS session for time or heap).
+# Before start() (boot, BLE setup) alerts are posted immediately, as before.
+
+_HOST = "34.53.103.114"  # Default server, until set_servers() stores a list
+_PORT = const(80)
+_QUEUE_MAX = const(16)  # Alerts kept in memory; the lowest priority goes first
+_COALESCE_MS = const(500)  # Wait this long after the first alert for the rest of a burst
+_MIN_GAP_MS = const(2000)  # At most one POST per 2 s (ntfy rate-limits per IP)
+_HOLD_MAX_MS = const(60000)  # Send anyway if a cast holds alerts longer than this
+_IO_TIMEOUT = const(10)  # Seconds for connect / one request
+
+_queue = []  # [topic, priority, tags, message]
+_wake = None
+_task = None
+_holds = 0
+_held_since = 0
+_r = None
+_w = None
+_servers = None
+stats = {"posts": 0, "alerts": 0, "dropped": 0, "errors": 0}
+
+
+def start():
+    """Start the background sender on the running event loop."""
+    global _task, _wake
+    if _task is None:
+        _wake = asyncio.Event()
+        _task = asyncio.create_task(_run())
+
+
+def alert(message, topic, priority=None, tags=None):
+    """Queue an alert for the sender. Returns False if it is not running."""
+    if _task is None:
+        return False
+    if len(_queue) >= _QUEUE_MAX:
+        # Drop the oldest of the least urgent alerts
+        low = min(_queue, key=lambda a: a[1] or 3)
+        _queue.remove(low)
+        stats["dropped"] += 1
+    _queue.append([topic, priority, tags, message])
+    _wake.set()
+    return True
+
+
+def servers():
+    """The ntfy server list (endpoints.Endpoints), loaded on first use."""
+    global _servers
+    if _servers is None:
+        from endpoints import Endpoints
+
+        _servers = Endpoints("ntfy", (_HOST, _PORT))
+    return _servers
+
+
+def set_servers(items):
+    """Store a new server list (see endpoints.parse()); the kept-alive
+    connection is dropped so the next POST picks from it."""
+    servers().set(items)
+    _close()
+
+
+def health():
+    """[queued, alerts sent, POSTs, dropped, failed POSTs]"""
+    return [len(_queue), stats["alerts"], stats["posts"], stats["dropped"], stats["errors"]]
+
+
+def hold():
+    """Keep queued alerts back until release() (nestable)."""
+    global _holds, _held_since
+    if not _holds:
+        _held_since = time.ticks_ms()
+    _holds += 1
+
+
+def release():
+    global _holds
+    if _holds:
+        _holds -= 1
+        if not _holds and _wake:
+            _wake.set()
+
+
+def _take():
+    """Remove the oldest alert plus every other queued alert for its topic;
+    returns (topic, priority, tags, message) for one combined POST."""
+    topic = _queue[0][0]
+    batch = [a for a in _queue if a[0] == topic]
+    for a in batch:
+        _queue.remove(a)
+    priority = max(a[1] or 3 for a in batch)
+    tags = []
+    for a in batch:
+        for t in (a[2] or "").split(","):
+            if t and t not in tags:
+                tags.append(t)
+    message = "\n".join(a[3] for a in batch)
+    stats["alerts"] += len(batch)
+    return topic, priority if priority != 3 else None, ",".join(tags), message
+
+
+def _request(host, topic, priority, tags, message):
+    if isinstance(message, str):
+        message = message.encode()
+    head = "POST /%s HTTP/1.1\r\nHost: %s\r\nTitle: Bilal ESP32\r\n" % (topic, host)
+    if priority:
+        head += "Priority: %d\r\n" % priority
+    if tags:
+        head += "Tags: %s\r\n" % tags
+    head += "Content-Length: %d\r\nConnection: keep-alive\r\n\r\n" % len(message)
+    return head.encode() + message
+
+
+def _close():
+    global _r, _w
+    try:
+        if _w:
+            _w.close()
+    except Exception:
+        pass
+    _r = _w = None
+
+
+async def _post(server, data):
+    """Send one request on the kept-alive connection (opened to server if
+    there is none) and read the response. Returns False if the server closed
+    the connection instead of answering."""
+    global _r, _w
+    if _w is None:
+        _r, _w = await asyncio.open_connection(*server)
+    _w.write(data)
+    await _w.drain()
+    status = await _r.readline()
+    if not status:
+        return False
+    length = 0
+    keep = not status.startswith(b"HTTP/1.0")
+    while True:
+        line = await _r.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection" and b"close" in value.lower():
+            keep = False
+    if length:
+        await _r.readexactly(length)
+    if not keep:
+        _close()
+    return True
+
+
+async def _send(batch):
+    hosts = servers()
+    for attempt in range(2):
+        fresh = _w is None or hosts.current is None
+        if fresh:
+            _close()
+            hosts.current = hosts.pick()
+        i = hosts.current
+        server = hosts.list[i]
+        start = time.ticks_ms()
+        try:
+            # A kept-alive connection the server has since closed fails on
+            # first use; the second attempt runs on a fresh one
+            if await asyncio.wait_for(_post(server, _request(server[0], *batch)), _IO_TIMEOUT):
+                if fresh:
+                    hosts.ok(i, time.ticks_diff(time.ticks_ms(), start))
+                stats["posts"] += 1
+                return
+        except Exception as e:
+            if attempt:
+                print("ntfy: send to %s failed: %s" % (server[0], e))
+        if fresh:
+            hosts.failed(i)  # The retry goes to another server, if there is one
+        _close()
+    stats["errors"] += 1
+
+
+async def _run():
+    last = time.ticks_add(time.ticks_ms(), -_MIN_GAP_MS)
+    while True:
+        while not _queue:
+            _wake.clear()
+            await _wake.wait()
+        await asyncio.sleep_ms(_COALESCE_MS)
+        while _holds and time.ticks_diff(time.ticks_ms(), _held_since) < _HOLD_MAX_MS:
+            _wake.clear()
+            try:
+                await asyncio.wait_for(_wake.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        gap = _MIN_GAP_MS - time.ticks_diff(time.ticks_ms(), last)
+        if gap > 0:
+            await asyncio.sleep_ms(gap)
+        if _queue:
+            await _send(_take())
+            last = time.ticks_ms()
+
+
+def flush_sync():
+    """
+    Post everything still queued with blocking requests and stop queueing,
+    so later alerts are posted directly too. For paths that are about to
+    reboot, or that run after the event loop has died.
+    """
+    global _task
+    if _task is not None:
+        try:
+            _task.cancel()
+        except Exception:
+            pass
+        _task = None
+    _close()
+    while _queue:
+        post(*_take())
+
+
+def post(topic, priority, tags, message):
+    """Blocking single POST on a new connection (the pre-dispatcher path)."""
+    hosts = servers()
+    i = hosts.current = hosts.pick()
+    try:
+        import urequests
+
+        headers = {"Title": "Bilal ESP32"}
+        if priority:
+            headers["Priority"] = str(priority)
+        if tags:
+            headers["Tags"] = tags
+        url = "http://%s:%d/%s" % (hosts.list[i][0], hosts.list[i][1], topic)
+        urequests.post(url, data=message, headers=headers).close()
+    except Exception:
+        hosts.failed(i)
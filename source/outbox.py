@@ -0,0 +1,164 @@
+import esp32
+from struct import pack_into, unpack_from
+from micropython import const
+
+# Outbox: telemetry that could not be published (MQTT down, publish failed)
+# waits here until the next connection. Records live in a ring of fixed-size
+# slots in one preallocated file, written append-only: each record is written
+# once into slot seq % _SLOTS and never rewritten, and nothing else in the
+# file changes on append. The newest seq is recovered at boot by scanning the
+# slot headers; the last acknowledged seq is kept in NVS and only written once
+# per acknowledged batch. A record bigger than a slot (a health snapshot, a
+# large group play result) takes up to _SPAN consecutive slots, one seq each;
+# the continuation slots carry their own header, so they are never taken for
+# the start of a record.
+
+_PATH = "/outbox.bin"
+_SLOTS = const(32)
+_SIZE = const(1024)  # Bytes per slot, header included
+_HEAD = const(8)  # magic(1) seq(4) topic_len(1) payload_len(2)
+_DATA = const(_SIZE - _HEAD)  # Record bytes per slot
+_SPAN = const(4)  # Most slots one record may take
+_MAGIC = const(0xB1)
+_MORE = const(0xB2)  # Continuation slot: magic(1) seq(4) 0(1) chunk_len(2)
+_BATCH = const(8)  # Records published before waiting for their PUBACKs
+_NVS_NAME = "outbox"
+
+
+class Outbox:
+    def __init__(self, path=_PATH):
+        self._path = path
+        self._buf = bytearray(_SIZE)
+        self._nvs = esp32.NVS(_NVS_NAME)
+        self.dropped = 0  # Slots overwritten before they could be sent
+        try:
+            acked = self._nvs.get_i32("acked")
+        except OSError:
+            acked = -1
+
+        try:
+            self._f = open(path, "r+b")
+            newest = self._scan()
+        except OSError:
+            self._f = self._create()
+            newest = -1
+        self.head = max(newest, acked) + 1  # Next seq to write
+        self.tail = max(acked + 1, self.head - _SLOTS)  # Oldest unsent seq
+        if self.head > self.tail:
+            print("Outbox: %d unsent slots" % (self.head - self.tail))
+
+    def _create(self):
+        print("Outbox: creating %s (%d x %d bytes)" % (self._path, _SLOTS, _SIZE))
+        f = open(self._path, "w+b")
+        for _ in range(_SLOTS):
+            f.write(self._buf)  # Still all zeros: every slot starts empty
+        f.flush()
+        return f
+
+    def _scan(self):
+        """Return the highest seq found in the slot headers, or -1."""
+        newest = -1
+        head = memoryview(self._buf)[:_HEAD]
+        for slot in range(_SLOTS):
+            self._f.seek(slot * _SIZE)
+            if self._f.readinto(head) != _HEAD:
+                raise OSError("outbox file truncated")
+            if head[0] == _MAGIC or head[0] == _MORE:
+                newest = max(newest, unpack_from(">I", head, 1)[0])
+        return newest
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def put(self, topic, payload):
+        """Append a record. When the ring is full the oldest unsent slots are
+        overwritten. Returns False if the record needs more than _SPAN
+        slots."""
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        n = len(topic) + len(payload)
+        if n > _SPAN * _DATA or len(topic) > 255:
+            print("Outbox: record too large (%d bytes), not stored" % n)
+            return False
+
+        data = memoryview(topic + payload)
+        buf = self._buf
+        for i in range(0, n, _DATA):
+            chunk = data[i : i + _DATA]
+            if i:
+                pack_into(">BIBH", buf, 0, _MORE, self.head, 0, len(chunk))
+            else:
+                pack_into(">BIBH", buf, 0, _MAGIC, self.head, len(topic), len(payload))
+            buf[_HEAD : _HEAD + len(chunk)] = chunk
+            for j in range(_HEAD + len(chunk), _SIZE):
+                buf[j] = 0
+            self._f.seek((self.head % _SLOTS) * _SIZE)
+            self._f.write(buf)
+            self.head += 1
+            if self.head - self.tail > _SLOTS:
+                self.tail = self.head - _SLOTS
+                self.dropped += 1
+        self._f.flush()
+        return True
+
+    def _get(self, seq):
+        """Read the record that starts at seq; returns (topic, payload, slots
+        it takes) or None if seq is a continuation slot, or the record has
+        been partly reused or is damaged."""
+        buf = self._buf
+        self._f.seek((seq % _SLOTS) * _SIZE)
+        self._f.readinto(buf)
+        magic, rseq, tlen, plen = unpack_from(">BIBH", buf, 0)
+        n = tlen + plen
+        if magic != _MAGIC or rseq != seq or n > _SPAN * _DATA:
+            return None
+        if n <= _DATA:
+            t = _HEAD + tlen
+            return bytes(buf[_HEAD:t]), bytes(buf[t : t + plen]), 1
+        data = bytearray(n)
+        data[:_DATA] = buf[_HEAD:]
+        slots = (n + _DATA - 1) // _DATA
+        for k in range(1, slots):
+            if seq + k >= self.head:
+                return None
+            self._f.seek(((seq + k) % _SLOTS) * _SIZE)
+            self._f.readinto(buf)
+            magic, rseq, _, clen = unpack_from(">BIBH", buf, 0)
+            if magic != _MORE or rseq != seq + k or k * _DATA + clen > n:
+                return None
+            data[k * _DATA : k * _DATA + clen] = buf[_HEAD : _HEAD + clen]
+        return bytes(data[:tlen]), bytes(data[tlen:]), slots
+
+    def _ack(self, seq):
+        if seq + 1 > self.tail:
+            self.tail = seq + 1
+        self._nvs.set_i32("acked", seq)
+        self._nvs.commit()
+
+    async def flush(self, client, timeout_s=10):
+        """
+        Publish unsent records with QoS1. Records go out _BATCH at a time
+        without waiting in between, then the batch's PUBACKs are awaited
+        together, so a backlog costs one round trip per batch rather than
+        per record. Returns True once the outbox is empty; False if the
+        connection dropped or an acknowledgement timed out (the unacked
+        batch is resent next time).
+        """
+        while self.tail < self.head:
+            seq = self.tail
+            pids = []
+            while seq < self.head and len(pids) < _BATCH:
+                record = self._get(seq)
+                if record is None:
+                    seq += 1  # Continuation of an overwritten record, or damaged
+                    continue
+                pids.append(client.publish(record[0], record[1], qos=1))
+                seq += record[2]
+            await client.drain()
+            for pid in pids:
+                if not await client.published(pid, timeout_s):
+                    return False
+            self._ack(seq - 1)
+        return True
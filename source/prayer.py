@@ -0,0 +1,266 @@
+import math
+from struct import pack_into, unpack_from
+from micropython import const
+
+# Prayer-time calculation (the PrayTimes.org method: low-precision solar
+# position, refined by re-evaluating it at each estimate, "middle of the
+# night" high-latitude rule)
+# and a precomputed yearly table. The table holds, per day, six int16 times
+# in minutes from that day's UTC midnight, so a lookup is one small read
+# from flash with no trig. Negative values or values past 1440 are fine:
+# far east of Greenwich fajr falls on the previous UTC day.
+#
+# All angles are in degrees. Times are computed from days since J2000
+# rather than Julian dates: ESP32 floats are single precision, and a JD of
+# ~2.46 million would only resolve to a quarter of a day.
+
+NAMES = ("fajr", "sunrise", "dhuhr", "asr", "maghrib", "isha")
+
+# method: (fajr angle, maghrib angle or minutes after sunset, isha angle or
+# minutes after maghrib); ints in the last two slots are minutes
+METHODS = {
+    "MWL": (18.0, 0, 17.0),
+    "ISNA": (15.0, 0, 15.0),
+    "Egypt": (19.5, 0, 17.5),
+    "Makkah": (18.5, 0, 90),
+    "Karachi": (18.0, 0, 18.0),
+    "Tehran": (17.7, 4.5, 14.0),
+}
+ASR = {"standard": 1, "hanafi": 2}
+
+_PATH = "/prayer.bin"
+_MAGIC = b"BPT1"
+_HEADER = const(20)  # magic(4) year(2) lat(4) lon(4) method(1) asr(1) days(2) pad(2)
+_TABLE_DAYS = const(373)  # A (leap) year plus a week into the next one
+_DAY = const(12)  # Six int16 times
+_J2000_DAYS = const(10957)  # 2000-01-01 in days since the unix epoch
+_PASSES = const(2)  # Solar position evaluations per time
+_NONE = const(-32768)  # Stored for a time that does not occur
+
+
+def _sin(d):
+    return math.sin(math.radians(d))
+
+
+def _cos(d):
+    return math.cos(math.radians(d))
+
+
+def _tan(d):
+    return math.tan(math.radians(d))
+
+
+def _sun(d):
+    """Declination (degrees) and equation of time (hours) at d days from J2000."""
+    g = (357.529 + 0.98560028 * d) % 360
+    q = (280.459 + 0.98564736 * d) % 360
+    L = (q + 1.915 * _sin(g) + 0.020 * _sin(2 * g)) % 360
+    e = 23.439 - 0.00000036 * d
+    ra = math.degrees(math.atan2(_cos(e) * _sin(L), _cos(L))) / 15
+    eqt = q / 15 - ra % 24
+    if eqt > 12:
+        eqt -= 24
+    elif eqt < -12:
+        eqt += 24
+    return math.degrees(math.asin(_sin(e) * _sin(L))), eqt
+
+
+class _Day:
+    """Solar times for one date and place, in hours of local mean time."""
+
+    def __init__(self, lat, base):
+        self.lat = lat
+        self.base = base  # Days from J2000 at local midnight
+
+    def noon(self, t):
+        return 12 - _sun(self.base + t / 24)[1]
+
+    def angle_time(self, angle, t, before_noon):
+        """Time the sun is `angle` degrees below the horizon (None if never)."""
+        decl = _sun(self.base + t / 24)[0]
+        c = (-_sin(angle) - _sin(decl) * _sin(self.lat)) / (_cos(decl) * _cos(self.lat))
+        if c < -1 or c > 1:
+            return None
+        h = math.degrees(math.acos(c)) / 15
+        return self.noon(t) + (-h if before_noon else h)
+
+    def asr_time(self, factor, t):
+        decl = _sun(self.base + t / 24)[0]
+        angle = -math.degrees(math.atan(1 / (factor + _tan(abs(self.lat - decl)))))
+        return self.angle_time(angle, t, False)
+
+
+def compute(lat, lon, method, asr, days):
+    """
+    Prayer times for the UTC date `days` (days since 1970-01-01) as six
+    minutes from that date's UTC midnight, in NAMES order; _NONE for a time
+    that does not occur that day (polar day or night).
+    """
+    fajr_angle, maghrib_param, isha_param = METHODS[method]
+    day = _Day(lat, days - _J2000_DAYS - 0.5 - lon / 360)
+
+    # Start from rough guesses and re-evaluate the sun at each estimate.
+    # PrayTimes.org stops after one pass; the second matters near the
+    # twilight limit, where the event is hours from its guess
+    fajr, sunrise, dhuhr, asr_t, sunset, maghrib, isha = 5, 6, 12, 13, 18, 18, 18
+    for _ in range(_PASSES):
+        fajr = day.angle_time(fajr_angle, fajr or 5, True)
+        sunrise = day.angle_time(0.833, sunrise or 6, True)
+        dhuhr = day.noon(dhuhr)
+        asr_t = day.asr_time(ASR[asr], asr_t or 13)
+        sunset = day.angle_time(0.833, sunset or 18, False)
+        if sunset is None:
+            maghrib = None
+        elif isinstance(maghrib_param, int):
+            maghrib = sunset + maghrib_param / 60
+        else:
+            maghrib = day.angle_time(maghrib_param, maghrib or 18, False)
+        if isinstance(isha_param, int):
+            isha = maghrib + isha_param / 60 if maghrib is not None else None
+        else:
+            isha = day.angle_time(isha_param, isha or 18, False)
+
+    # High latitudes: keep fajr / isha within half the night of sunrise /
+    # sunset when twilight never ends or lasts unreasonably long. Under the
+    # midnight sun or polar night there is no sunrise or sunset to anchor to
+    if sunrise is not None and sunset is not None:
+        portion = (24 + sunrise - sunset) / 2
+        if fajr is None or sunrise - fajr > portion:
+            fajr = sunrise - portion
+        if isha is None or isha - sunset > portion:
+            isha = sunset + portion
+        if maghrib is None or maghrib - sunset > portion:
+            maghrib = sunset + portion
+
+    zone = lon / 15  # Local mean time -> UTC
+    return tuple(
+        _NONE if h is None else int(math.floor((h - zone) * 60 + 0.5))
+        for h in (fajr, sunrise, dhuhr, asr_t, maghrib, isha)
+    )
+
+
+def civil(days):
+    """(year, month, day) of a day count since 1970-01-01."""
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    m = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (m <= 2), m, doy - (153 * mp + 2) // 5 + 1
+
+
+def days_from_civil(y, m, d):
+    """Day count since 1970-01-01 of a calendar date."""
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m - 3 if m > 2 else m + 9) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+class PrayerTable:
+    """A year of precomputed times for one place and method, kept in flash."""
+
+    def __init__(self, path=_PATH):
+        self._path = path
+        self.key = None  # table_key() the table was built for
+        self._first = 0  # Day count of the first row
+        self._days = 0
+        try:
+            with open(path, "rb") as f:
+                head = f.read(_HEADER)
+            if head[:4] == _MAGIC:
+                year, lat, lon, m, a, n = unpack_from(">HiiBBH", head, 4)
+                self.key = (year, lat, lon, sorted(METHODS)[m], sorted(ASR)[a])
+                self._first = days_from_civil(year, 1, 1)
+                self._days = n
+        except (OSError, ValueError, IndexError):
+            pass
+
+    async def build(self, key):
+        """Compute and store the table for a table_key(); yields to the event
+        loop between days so a build never starves MQTT or the watchdog."""
+        import uasyncio as asyncio
+
+        year, lat, lon, method, asr = key
+        first = days_from_civil(year, 1, 1)
+        data = bytearray(_HEADER + _TABLE_DAYS * _DAY)
+        data[:4] = _MAGIC
+        pack_into(
+            ">HiiBBH", data, 4, year, lat, lon,
+            sorted(METHODS).index(method), sorted(ASR).index(asr), _TABLE_DAYS,
+        )
+        offset = _HEADER
+        for i in range(_TABLE_DAYS):
+            row = compute(lat / 10000, lon / 10000, method, asr, first + i)
+            pack_into(">6h", data, offset, *row)
+            offset += _DAY
+            await asyncio.sleep(0)
+        with open(self._path, "wb") as f:
+            f.write(data)
+        self.key = key
+        self._first = first
+        self._days = _TABLE_DAYS
+
+    def day(self, days):
+        """Six unix-second times (None where a time does not occur) for UTC
+        day `days`, or None if the table does not cover it. O(1): one 12-byte
+        read, no float maths."""
+        i = days - self._first
+        if self.key is None or not 0 <= i < self._days:
+            return None
+        with open(self._path, "rb") as f:
+            f.seek(_HEADER + i * _DAY)
+            row = unpack_from(">6h", f.read(_DAY))
+        midnight = days * 86400
+        return tuple(None if m == _NONE else midnight + m * 60 for m in row)
+
+
+def table_key(config, year):
+    """What a table depends on: (year, lat e4, lon e4, method, asr). Raises
+    ValueError/KeyError for an unknown method or missing coordinates."""
+    method = config.get("method", "MWL")
+    asr = config.get("asr", "standard")
+    if method not in METHODS or asr not in ASR:
+        raise ValueError("unknown method %s / asr %s" % (method, asr))
+    lat = float(config["lat"])
+    lon = float(config["lon"])
+    if not (-90 < lat < 90 and -180 <= lon <= 180):
+        raise ValueError("bad coordinates")
+    return year, int(round(lat * 10000)), int(round(lon * 10000)), method, asr
+
+
+def schedule_props(table, config, now_s, days):
+    """
+    Build a set_schedule payload (see schedule.py) from the table for the
+    next `days` days: one entry per prayer that has a URL in config["urls"].
+    """
+    urls = []
+    labels = []
+    index = {}
+    for name in NAMES:
+        url = config.get("urls", {}).get(name)
+        if url:
+            index[name] = len(urls)
+            urls.append(url)
+            labels.append(name)
+    volume = config.get("volume")
+    volume = int(volume * 100) if volume is not None else None
+    entries = []
+    today = now_s // 86400
+    for d in range(today, today + days):
+        times = table.day(d)
+        if times is None:
+            continue
+        for name, at in zip(NAMES, times):
+            if name in index and at is not None and at > now_s:
+                entries.append([at, index[name], 0, volume, index[name]])
+    return {
+        "urls": urls,
+        "targets": [config["target"]],
+        "labels": labels,
+        "entries": entries,
+    }
@@ -0,0 +1,77 @@
+import utime as time
+from micropython import const
+
+# Request/response bookkeeping for commands that carry an "id". Every such
+# command gets an "ack" on projectbilal/<device>/rpc as soon as it has been
+# admitted (or refused), and a "result" once the worker has run it. The
+# journal remembers the last reply for the most recent admitted ids, so a
+# command that arrives again (broker redelivery, backend retry) is answered
+# from the journal instead of being executed twice. Refusals are not
+# remembered: a command refused as stale, dropped, ... may be sent again
+# with the same id.
+
+_JOURNAL_SIZE = const(32)
+
+
+class Journal:
+    """Last reply per request id for the most recently used ids."""
+
+    def __init__(self, size=_JOURNAL_SIZE):
+        self._size = size
+        self._replies = {}
+        self._order = []  # Least recently used first
+
+    def __len__(self):
+        return len(self._order)
+
+    def get(self, rid):
+        reply = self._replies.get(rid)
+        if reply is not None:
+            self._order.remove(rid)
+            self._order.append(rid)
+        return reply
+
+    def put(self, rid, reply):
+        if rid in self._replies:
+            self._order.remove(rid)
+        elif len(self._order) >= self._size:
+            del self._replies[self._order.pop(0)]
+        self._replies[rid] = reply
+        self._order.append(rid)
+
+    def forget(self, rid):
+        if self._replies.pop(rid, None) is not None:
+            self._order.remove(rid)
+
+
+def ack(rid, action, status, rx_tick, **extra):
+    """Reply sent when a command is admitted ("queued", "scheduled") or
+    refused ("coalesced", "dropped", "stale", "unknown", "bad_request")."""
+    reply = {
+        "type": "ack",
+        "id": rid,
+        "action": action,
+        "status": status,
+        "device_ms": time.ticks_diff(time.ticks_ms(), rx_tick),
+    }
+    reply.update(extra)
+    return reply
+
+
+def result(rid, action, error, rx_tick, queued_tick, start_tick):
+    """Reply sent once the worker has run a command. device_ms runs from the
+    packet's arrival, so the backend can split round-trip time into network
+    and device time."""
+    now = time.ticks_ms()
+    reply = {
+        "type": "result",
+        "id": rid,
+        "action": action,
+        "status": "error" if error else "ok",
+        "queue_ms": time.ticks_diff(start_tick, queued_tick),
+        "run_ms": time.ticks_diff(now, start_tick),
+        "device_ms": time.ticks_diff(now, rx_tick),
+    }
+    if error:
+        reply["error"] = str(error)
+    return reply
@@ -0,0 +1,173 @@
+import esp32
+import json
+from struct import pack_into, unpack_from
+from micropython import const
+
+# Multi-day play schedule kept on the device, so prayer-time plays fire from
+# a local timer and do not depend on the broker being reachable at that
+# second. The server pushes it with the "set_schedule" action:
+#
+#   {"urls": ["http://.../fajr.mp3", ["http://.../athan.mp3", "http://.../dua.mp3"]],
+#    "targets": [{"ip": "192.168.1.20", "port": 8009},
+#                {"speakers": [{"ip": ..., "port": ...}, ...]}],
+#    "labels": ["fajr", "dhuhr", ...],
+#    "entries": [[unix_seconds, url_id, target_id, volume_pct, label_id], ...]}
+#
+# A URL id that names a list is played as a playlist. volume_pct is 0-100,
+# or null to leave the speaker's volume alone; label_id may be omitted.
+# Stored as one file: a header, the JSON tables (URLs, targets, labels) and
+# the entries as a packed array sorted by time. Only the tables are parsed at
+# load; entries are read straight out of the packed bytes.
+
+_PATH = "/schedule.bin"
+_MAGIC = b"BSC1"
+_HEADER = const(8)  # magic(4) tables_len(2) count(2)
+_ENTRY = const(8)  # at(4) url(1) target(1) volume(1) label(1)
+_ENTRY_FMT = ">IBBBB"
+_NO_VALUE = const(255)  # volume / label not set
+_MAX_ENTRIES = const(512)  # About two weeks of five prayers for a few targets
+_NVS_NAME = "schedule"
+
+
+class Schedule:
+    def __init__(self, path=_PATH):
+        self._path = path
+        self._nvs = esp32.NVS(_NVS_NAME)
+        self.tables = {"urls": [], "targets": [], "labels": []}
+        self._entries = b""
+        # (at, n): the last entry fired was at unix second `at`, and the
+        # first n entries at that second have fired, so a reboot replays none
+        # of them and entries sharing a time (several targets) all fire
+        try:
+            fired_at = self._nvs.get_i32("fired")
+        except OSError:
+            fired_at = 0
+        try:
+            n = self._nvs.get_i32("fired_n")
+        except OSError:
+            n = _MAX_ENTRIES  # Stored before the count: all at fired_at fired
+        self.fired = (fired_at, n)
+        try:
+            with open(path, "rb") as f:
+                self._parse(f.read())
+            print("Schedule: %d entries loaded" % len(self))
+        except OSError:
+            pass  # No schedule pushed yet
+        except ValueError as e:
+            print("Schedule: ignoring damaged %s: %s" % (path, e))
+
+    def __len__(self):
+        return len(self._entries) // _ENTRY
+
+    def _parse(self, data):
+        if data[:4] != _MAGIC:
+            raise ValueError("bad magic")
+        tables_len, count = unpack_from(">HH", data, 4)
+        start = _HEADER + tables_len
+        if len(data) != start + count * _ENTRY:
+            raise ValueError("truncated")
+        self.tables = json.loads(data[_HEADER:start])
+        self._entries = data[start:]
+
+    def store(self, props):
+        """
+        Validate a set_schedule payload and replace the stored schedule with
+        it. Returns the number of entries; raises ValueError if malformed.
+        """
+        urls = props.get("urls") or []
+        targets = props.get("targets") or []
+        labels = props.get("labels") or []
+        # By time only: the rest of an entry may mix ints and nulls. The
+        # sort is stable, so entries sharing a time keep the server's order.
+        entries = sorted(props.get("entries") or [], key=lambda e: e[0])
+        if len(entries) > _MAX_ENTRIES:
+            raise ValueError("more than %d entries" % _MAX_ENTRIES)
+        if len(urls) >= _NO_VALUE or len(targets) >= _NO_VALUE or len(labels) >= _NO_VALUE:
+            raise ValueError("too many urls, targets or labels")
+
+        tables = json.dumps({"urls": urls, "targets": targets, "labels": labels})
+        data = bytearray(_HEADER + len(tables) + len(entries) * _ENTRY)
+        data[:4] = _MAGIC
+        pack_into(">HH", data, 4, len(tables), len(entries))
+        data[_HEADER : _HEADER + len(tables)] = tables.encode()
+        offset = _HEADER + len(tables)
+        for e in entries:
+            at, url_id, target_id = int(e[0]), int(e[1]), int(e[2])
+            if not 0 <= at < 1 << 32:
+                raise ValueError("entry time %d out of range" % at)
+            if not (0 <= url_id < len(urls) and 0 <= target_id < len(targets)):
+                raise ValueError("entry %d refers to a missing url or target" % at)
+            volume = e[3] if len(e) > 3 and e[3] is not None else _NO_VALUE
+            if volume != _NO_VALUE and not 0 <= volume <= 100:
+                raise ValueError("entry %d volume %s not 0-100" % (at, volume))
+            label = e[4] if len(e) > 4 and e[4] is not None else _NO_VALUE
+            if label != _NO_VALUE and not 0 <= label < len(labels):
+                raise ValueError("entry %d refers to a missing label" % at)
+            pack_into(_ENTRY_FMT, data, offset, at, url_id, target_id, int(volume), int(label))
+            offset += _ENTRY
+
+        with open(self._path, "wb") as f:
+            f.write(data)
+        self._parse(bytes(data))
+        return len(self)
+
+    def clear(self):
+        self.store({})
+
+    def mark_fired(self, at):
+        """Record that the entry next_entry() returned, at `at`, fired."""
+        fired_at, n = self.fired
+        self.fired = (at, n + 1 if at == fired_at else 1)
+        self._nvs.set_i32("fired", self.fired[0])
+        self._nvs.set_i32("fired_n", self.fired[1])
+        self._nvs.commit()
+
+    def _first_after(self, at):
+        """Index of the first entry scheduled later than unix second `at`."""
+        lo, hi = 0, len(self)
+        while lo < hi:  # Binary search: entries are sorted by time
+            mid = (lo + hi) // 2
+            if unpack_from(">I", self._entries, mid * _ENTRY)[0] <= at:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def next_entry(self, after):
+        """First entry scheduled later than unix second `after` that has not
+        fired yet; returns (at, url_id, target_id, volume, label_id) or None."""
+        fired_at, n = self.fired
+        # Past the n entries that fired at fired_at, but never past the
+        # entries after it
+        i = min(self._first_after(fired_at - 1) + n, self._first_after(fired_at))
+        i = max(i, self._first_after(after))
+        if i == len(self):
+            return None
+        return unpack_from(_ENTRY_FMT, self._entries, i * _ENTRY)
+
+    def command(self, entry):
+        """Build the (action, props) of a play command for an entry."""
+        at, url_id, target_id, volume, label_id = entry
+        url = self.tables["urls"][url_id]
+        props = dict(self.tables["targets"][target_id])
+        props["at"] = at
+        if volume != _NO_VALUE:
+            props["volume"] = volume / 100
+        labels = self.tables["labels"]
+        props["label"] = labels[label_id] if label_id < len(labels) else "schedule"
+        if isinstance(url, list):
+            props["urls"] = url
+            return "play_queue", props
+        props["url"] = url
+        return "play", props
+
+    def summary(self):
+        """[entries, first at, last at] for status replies and health."""
+        n = len(self)
+        if not n:
+            return [0, None, None]
+        return [
+            n,
+            unpack_from(">I", self._entries, 0)[0],
+            unpack_from(">I", self._entries, (n - 1) * _ENTRY)[0],
+        ]
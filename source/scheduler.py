@@ -0,0 +1,100 @@
+import heapq
+import utime as time
+import uasyncio as asyncio
+
+# Periodic housekeeping on absolute deadlines. One task sleeps until the
+# earliest deadline instead of every job counting its own sleeps, so a slow
+# job does not push the others back and a period does not drift by the time
+# its job took. Deadlines are kept on a private millisecond clock advanced
+# with ticks_diff(): it does not wrap the way ticks_ms() does, so the heap can
+# order deadlines with plain comparisons.
+
+
+class Scheduler:
+    def __init__(self):
+        self._heap = []  # [deadline, seq, name, period_ms, fn], earliest first
+        self._seq = 0
+        self._tick = time.ticks_ms()
+        self._now = 0
+        self._changed = asyncio.Event()
+        self._stats = {}  # name -> [runs, total late ms, max late ms, missed]
+
+    def _clock(self):
+        tick = time.ticks_ms()
+        self._now += time.ticks_diff(tick, self._tick)
+        self._tick = tick
+        return self._now
+
+    def _push(self, deadline, name, period, fn):
+        self._seq += 1
+        heapq.heappush(self._heap, [deadline, self._seq, name, period, fn])
+        self._changed.set()
+
+    def every(self, name, period_ms, fn, first_ms=None):
+        """Run fn() every period_ms, the first time after first_ms (default:
+        one period). A coroutine returned by fn runs as its own task."""
+        delay = period_ms if first_ms is None else first_ms
+        self._push(self._clock() + delay, name, period_ms, fn)
+
+    def after(self, name, delay_ms, fn):
+        """Run fn() once, delay_ms from now."""
+        self._push(self._clock() + delay_ms, name, 0, fn)
+
+    def stats(self):
+        """Per-job lateness since the last call: name -> [runs, avg late ms,
+        max late ms, missed runs]. Resets the counters."""
+        stats = self._stats
+        self._stats = {}
+        return {
+            name: [s[0], s[1] // s[0], s[2], s[3]] for name, s in stats.items()
+        }
+
+    async def run(self):
+        while True:
+            if not self._heap:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            now = self._clock()
+            wait = self._heap[0][0] - now
+            if wait > 0:
+                # Sleep until the deadline, or until a job is added that
+                # may be due sooner
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), wait / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job = heapq.heappop(self._heap)
+            deadline, _, name, period, fn = job
+            late = now - deadline
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = [0, 0, 0, 0]
+            stat[0] += 1
+            stat[1] += late
+            if late > stat[2]:
+                stat[2] = late
+            try:
+                result = fn()
+                if result is not None and hasattr(result, "send"):
+                    asyncio.create_task(result)
+            except Exception as e:
+                print("Scheduler: %s failed: %s" % (name, e))
+
+            if period:
+                # Stay on the original grid; runs that fell entirely inside a
+                # blocked stretch are counted, not replayed back to back
+                deadline += period
+                if deadline <= now:
+                    missed = (now - deadline) // period + 1
+                    stat[3] += missed
+                    deadline += missed * period
+                job[0] = deadline
+                self._seq += 1
+                job[1] = self._seq
+                heapq.heappush(self._heap, job)
+            # Let other tasks in between jobs that are due back to back
+            await asyncio.sleep(0)
@@ -6,7 +6,6 @@ import machine
 from machine import Pin
 from micropython import const
 import esp32
-import uasyncio as asyncio
 import gc
 
 _BUFFER_SIZE = const(128)  # Make this big enough for your data
@@ -15,52 +14,130 @@ _NVS_NAME = const("wifi_creds")  # NVS namespace
 _WIFI_TIMEOUT = const(15)  # WiFi connection timeout per attempt (seconds)
 
 _LED_PIN = const(2)  # For the ESP32 built-in LED
-_BLINK_DELAY = const(0.25)  # Blink delay in seconds
+_LED_TIMER = const(0)  # Hardware timer that drives LED patterns
+_BLINK_MS = const(250)  # Time between LED toggles
 _BLINK_COUNT = {
     "wifi": const(6),
     "mqtt": const(4),
     "default": const(8),
     "reset": const(10),
 }
+_LED_QUEUE_MAX = const(4)  # Patterns waiting behind the one playing
 _LED = Pin(_LED_PIN, Pin.OUT)  # Create single LED instance
 
 _BOOT_BUTTON_PIN = const(0)  # Built-in BOOT button on ESP32
 _RESET_HOLD_TIME = const(8)  # Seconds to hold button for factory reset
 
+# LED patterns play from a periodic hardware timer, so callers queue a
+# pattern and return at once instead of sleeping through the blinks
+_led_timer = None
+_led_toggles = 0  # Toggles left in the pattern playing now
+_led_queue = []  # Toggle counts of the patterns waiting
+
+
+def _led_tick(timer):
+    global _led_toggles
+    if not _led_toggles:
+        if not _led_queue:
+            _led_stop()
+            return
+        _led_toggles = _led_queue.pop(0)
+    _LED.value(not _LED.value())
+    _led_toggles -= 1
+
+
+def _led_stop():
+    global _led_timer, _led_toggles
+    if _led_timer is not None:
+        _led_timer.deinit()
+        _led_timer = None
+    _led_toggles = 0
+    _LED.off()
+
 
 def led_toggle(info=None):
-    # Use _LED instead of creating new instance
+    """Queue a named blink pattern; returns immediately."""
+    global _led_timer
     blinks = _BLINK_COUNT.get(info, _BLINK_COUNT["default"])
-    for x in range(blinks):
-        _LED.value(not _LED.value())
-        time.sleep(_BLINK_DELAY)
-    _LED.off()
+    if len(_led_queue) >= _LED_QUEUE_MAX or (_led_queue and _led_queue[-1] == blinks):
+        return  # A burst of events needs no more than one blink pattern
+    _led_queue.append(blinks)
+    if _led_timer is None:
+        _LED.off()
+        _led_timer = machine.Timer(_LED_TIMER)
+        _led_timer.init(period=_BLINK_MS, mode=machine.Timer.PERIODIC, callback=_led_tick)
+
+
+def led_wait():
+    """Block until queued LED patterns have finished (before a reset)."""
+    while _led_timer is not None:
+        time.sleep_ms(50)
 
 
 def led_on():
+    del _led_queue[:]
+    _led_stop()
     _LED.on()
 
 
 def led_off():
-    _LED.off()
+    del _led_queue[:]
+    _led_stop()
 
 
-_NTFY_BASE = "http://34.53.103.114"
+def ntfy_alert(message, topic="projectbilal-errors", priority=None, tags=None):
+    """Send an ntfy alert: queued for the background dispatcher once it runs
+    (see ntfy.py), otherwise posted right away."""
+    try:
+        import ntfy
+    except ImportError:  # Files from an older update_app list (see main.py)
+        print("ntfy unavailable, alert not sent: %s" % message)
+        return
 
+    if not ntfy.alert(message, topic, priority, tags):
+        ntfy.post(topic, priority, tags, message)
 
-def ntfy_alert(message, topic="projectbilal-errors", priority=None, tags=None):
+
+def ntfy_flush():
+    """Deliver queued alerts now (blocking); call before a reboot."""
     try:
-        import urequests
+        import ntfy
+    except ImportError:
+        return
 
-        url = "%s/%s" % (_NTFY_BASE, topic)
-        headers = {"Title": "Bilal ESP32"}
-        if priority:
-            headers["Priority"] = str(priority)
-        if tags:
-            headers["Tags"] = tags
-        urequests.post(url, data=message, headers=headers)
-    except Exception:
-        pass
+    ntfy.flush_sync()
+
+
+def download(url, path):
+    """Stream url into path in 1 KB chunks, so a file never has to fit in
+    RAM. Returns the bytes written; raises OSError on an HTTP error."""
+    import urequests
+
+    r = urequests.get(url)
+    try:
+        if r.status_code != 200:
+            raise OSError("HTTP %d" % r.status_code)
+        total = 0
+        with open(path, "wb") as f:
+            while True:
+                chunk = r.raw.read(1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+                total += len(chunk)
+        return total
+    finally:
+        r.close()
+
+
+def file_exists(path):
+    import os
+
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
 
 
 # get mac address for mqtt connection
@@ -70,6 +147,64 @@ def get_mac():
     return mac
 
 
+_NTP_HOST = "pool.ntp.org"
+_NTP_DELTA = const(2208988800)  # Seconds between the NTP (1900) and Unix epochs
+_NTP_RETRY_MS = const(300000)  # After a failed sync, wait 5 minutes before the next
+_clock = None  # (ticks_ms, unix ms) anchor from the last NTP sync
+_ntp_failed = None  # ticks_ms of the last failed sync, None after a good one
+
+
+def sync_clock(max_age_ms=None):
+    """
+    Anchor unix time to ticks_ms from one NTP query, keeping the sub-second
+    part that ntptime.settime() truncates. Skipped if the anchor is younger
+    than max_age_ms. Resync well within ticks_diff's ~6 day range.
+    The query blocks (DNS plus up to 2 s for the reply), so after a failure
+    the next one is only tried _NTP_RETRY_MS later; callers on the event
+    loop then get the old answer at once.
+    Returns True if the clock is usable.
+    """
+    global _clock, _ntp_failed
+    if _clock and max_age_ms and time.ticks_diff(time.ticks_ms(), _clock[0]) < max_age_ms:
+        return True
+    if _ntp_failed is not None and time.ticks_diff(time.ticks_ms(), _ntp_failed) < _NTP_RETRY_MS:
+        return _clock is not None
+    import socket
+    import struct
+
+    s = None
+    try:
+        addr = socket.getaddrinfo(_NTP_HOST, 123)[0][-1]
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(2)
+        query = bytearray(48)
+        query[0] = 0x1B  # LI=0, VN=3, Mode=3 (client)
+        sent = time.ticks_ms()
+        s.sendto(query, addr)
+        msg = s.recv(48)
+        now = time.ticks_ms()
+        secs, frac = struct.unpack("!II", msg[40:48])  # Transmit timestamp
+        unix_ms = (secs - _NTP_DELTA) * 1000 + ((frac * 1000) >> 32)
+        _clock = (now, unix_ms + time.ticks_diff(now, sent) // 2)
+        _ntp_failed = None
+        print("NTP: clock synced (rtt %d ms)" % time.ticks_diff(now, sent))
+        return True
+    except Exception as e:
+        print(f"NTP: sync failed: {e}")
+        _ntp_failed = time.ticks_ms()
+        return _clock is not None
+    finally:
+        if s:
+            s.close()
+
+
+def unix_ms():
+    """Current unix time in ms from the NTP anchor, or None if never synced."""
+    if _clock is None:
+        return None
+    return _clock[1] + time.ticks_diff(time.ticks_ms(), _clock[0])
+
+
 # connect to wifi with provided credentials and return ip
 def wifi_connect_with_creds(SSID, PASSWORD, SECURITY):
     """
@@ -271,8 +406,9 @@ def wifi_scan():
 
 def clear_device_state():
     """
-    Clear all device configuration from NVS (factory reset).
-    This removes WiFi credentials and any other saved state.
+    Clear all device configuration (factory reset): WiFi credentials and
+    device name in NVS, and the schedule, prayer, endpoint and outbox state
+    in NVS and on flash.
     """
     try:
         print("Factory reset: Clearing all device state from NVS...")
@@ -308,6 +444,30 @@ def clear_device_state():
         except:
             pass
 
+        # Schedule, prayer times, server lists and unsent telemetry, so the
+        # next owner gets no plays or messages meant for the previous one
+        import os
+
+        for path in ("/schedule.bin", "/prayer.json", "/prayer.bin", "/outbox.bin"):
+            try:
+                os.remove(path)
+                print("  - Removed %s" % path)
+            except OSError:
+                pass
+        for namespace, keys in (
+            ("schedule", ("fired", "fired_n")),
+            ("endpoints", ("mqtt", "ntfy")),
+            ("outbox", ("acked",)),
+        ):
+            nvs_state = esp32.NVS(namespace)
+            for key in keys:
+                try:
+                    nvs_state.erase_key(key)
+                except OSError:
+                    pass
+            nvs_state.commit()
+        print("  - Cleared schedule, endpoints and outbox state")
+
         print("Factory reset: NVS cleared successfully")
         return True
     except Exception as e:
@@ -325,6 +485,7 @@ def check_reset_button():
     # Button is pressed when value is 0 (active low with pull-up)
     if button.value() == 0:
         print(f"Reset button pressed, checking hold time ({_RESET_HOLD_TIME}s)...")
+        led_off()  # Take the LED over from any pattern still playing
 
         # Visual feedback - rapid blink while waiting
         start_time = time.time()
@@ -332,7 +493,7 @@ def check_reset_button():
             if button.value() == 1:
                 # Button released early
                 print("Reset button released early, reset cancelled")
-                _LED.off()
+                led_off()
                 return False
 
             # Blink LED rapidly to show we're counting
@@ -342,7 +503,7 @@ def check_reset_button():
         # Button held for full duration - STOP blinking to signal user can release
         print("Reset button held for required time!")
         print("LED solid ON - waiting for button release...")
-        _LED.on()  # Turn LED solid to indicate "you can release now"
+        led_on()  # Turn LED solid to indicate "you can release now"
 
         # Wait for user to release button
         while button.value() == 0:
@@ -352,29 +513,98 @@ def check_reset_button():
 
         # Confirmation pattern - fast blinks to confirm reset
         led_toggle("reset")
+        led_wait()
         return True
 
     return False
 
 
-async def monitor_reset_button():
-    """
-    Background task to continuously monitor for factory reset button press.
-    Runs during normal operation (WiFi/MQTT mode).
-    """
-    button = Pin(_BOOT_BUTTON_PIN, Pin.IN, Pin.PULL_UP)
-    print("Reset button monitoring started (hold BOOT button 8s for factory reset)")
-
-    while True:
-        await asyncio.sleep(0.5)  # Check every 500ms
+_BUTTON_TIMER = const(1)  # Hardware timer that follows a button press
+_BUTTON_TICK_MS = const(100)  # How often a held button is sampled
+_DEBOUNCE_MS = const(50)  # Shorter presses are contact bounce
+
+# Reset button service: the pin IRQ wakes a timer on press, the timer tracks
+# the hold (blinking the LED) and calls on_reset after release once the
+# button was held _RESET_HOLD_TIME. Nothing polls the pin while it is idle.
+_button = None
+_button_timer = None
+_button_pressed = 0  # ticks_ms of the press, 0 while idle
+_button_armed = False  # Held long enough; waiting for release
+_on_reset = None
+
+
+def _button_irq(pin):
+    global _button_timer, _button_pressed, _button_armed
+    if _button_pressed:
+        return  # Already tracking this press (or bounce on it)
+    _button_pressed = time.ticks_ms() or 1
+    _button_armed = False
+    _button_timer = machine.Timer(_BUTTON_TIMER)
+    _button_timer.init(period=_BUTTON_TICK_MS, mode=machine.Timer.PERIODIC, callback=_button_tick)
+
+
+def _button_release():
+    global _button_timer, _button_pressed
+    _button_timer.deinit()
+    _button_timer = None
+    _button_pressed = 0
+
+
+def _button_tick(timer):
+    global _button_armed
+    held = time.ticks_diff(time.ticks_ms(), _button_pressed)
+    if _button.value() == 1:  # Released
+        armed = _button_armed
+        _button_release()
+        if armed:
+            print("Button released - performing factory reset!")
+            _on_reset()
+        elif held >= _DEBOUNCE_MS + _BUTTON_TICK_MS:  # Else bounce: never announced
+            print("Reset button released early, reset cancelled")
+            led_off()
+        return
+    if _button_armed:
+        return
+    if held >= _RESET_HOLD_TIME * 1000:
+        # Held long enough - LED solid to signal the button can be released
+        print("Reset button held for required time!")
+        _button_armed = True
+        led_on()
+    elif held >= _DEBOUNCE_MS:
+        if held < _DEBOUNCE_MS + _BUTTON_TICK_MS:
+            print(f"Reset button pressed, hold {_RESET_HOLD_TIME}s for factory reset...")
+            led_off()  # Take the LED over from any pattern still playing
+        if (held // _BUTTON_TICK_MS) % 2:
+            _LED.value(not _LED.value())  # Rapid blink while counting
+
+
+def factory_reset():
+    """Confirm with the reset pattern, wipe the device state and reboot."""
+    # Blinks inline: this runs in a timer callback, where the LED timer's own
+    # callback cannot run until it returns (and it never does)
+    led_off()
+    for _ in range(_BLINK_COUNT["reset"]):
+        _LED.value(not _LED.value())
+        time.sleep_ms(_BLINK_MS)
+    _LED.off()
+    print("Factory reset confirmed! Clearing device and rebooting...")
+    clear_device_state()
+    time.sleep(1)
+    machine.reset()
 
-        if button.value() == 0:  # Button pressed
-            print("Reset button detected during operation...")
-            if check_reset_button():
-                # Factory reset confirmed
-                print("Factory reset confirmed! Clearing device and rebooting...")
-                clear_device_state()
-                time.sleep(1)
-                machine.reset()
 
-        await asyncio.sleep(0.5)  # Additional delay between checks
+def start_reset_button(on_reset=None):
+    """
+    Watch the BOOT button without polling: holding it _RESET_HOLD_TIME
+    seconds and releasing calls on_reset (from the timer callback, outside
+    hard IRQ context), factory_reset by default. Calling it again replaces
+    the callback; without one (BLE started next to MQTT) it keeps the
+    callback already set.
+    """
+    global _button, _on_reset
+    if on_reset is not None or _on_reset is None:
+        _on_reset = on_reset or factory_reset
+    if _button is None:
+        _button = Pin(_BOOT_BUTTON_PIN, Pin.IN, Pin.PULL_UP)
+        _button.irq(trigger=Pin.IRQ_FALLING, handler=_button_irq)
+        print(f"Reset button armed (hold BOOT button {_RESET_HOLD_TIME}s for factory reset)")
@@ -0,0 +1,240 @@
+"""
+Benchmark source/cast.py against the fake receiver in fake_cast.py.
+
+Starts a FakeReceiver on a loopback port (own thread and event loop, so the
+blocking client can be measured too) and plays N URLs through each client:
+
+    async-cold   cast.connect() + play_url() + disconnect() every time
+    async-warm   one pooled session re-used via cast.pooled()/keep()
+    sync-cold    the blocking sync_cast.Chromecast, new session every time
+
+Per phase it reports median / p95 / max milliseconds from the client's own
+`timings`, wall time per play, and allocation figures from tracemalloc.
+`peak KB` is the high-water mark above the starting heap during one play,
+which is what decides whether a play fits next to the TLS buffers on the
+ESP32. `blocks` is the count of Python allocations still live after the play,
+i.e. what a pooled session pins. CPython objects are larger than
+MicroPython's, so compare runs with each other, not with gc.mem_free() on a
+device.
+
+    python3 tools/bench_cast.py -n 50
+    python3 tools/bench_cast.py -n 20 --split 7 --oversized 20000 --ping-ms 200
+    python3 tools/bench_cast.py -n 20 --drop LOAD --drop-rate 0.2
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import upy_host  # noqa: E402
+from fake_cast import add_fault_arguments, receiver_from_args  # noqa: E402
+from sync_cast import Chromecast  # noqa: E402
+
+cast = upy_host.import_cast()
+
+URL = "http://example.invalid/adhan.mp3"
+PHASES = ("tcp", "tls", "status", "launch", "load")
+
+
+# --- Fake receiver thread ---
+
+
+class ReceiverThread(threading.Thread):
+    def __init__(self, receiver, certfile, keyfile):
+        threading.Thread.__init__(self, daemon=True)
+        self.receiver = receiver
+        self._cert = (certfile, keyfile)
+        self._ready = threading.Event()
+        self.port = None
+        self.loop = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.port = self.loop.run_until_complete(
+            self.receiver.serve("127.0.0.1", 0, *self._cert)
+        )
+        self._ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        threading.Thread.start(self)
+        self._ready.wait(10)
+        return self.port
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(10)
+
+    async def _shutdown(self):
+        self.receiver.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+
+# --- Measurement ---
+
+
+class Sample(object):
+    def __init__(self):
+        self.ok = False
+        self.wall = 0
+        self.timings = {}
+        self.peak = 0
+        self.blocks = 0
+
+
+def _measure(sample, base):
+    current, peak = tracemalloc.get_traced_memory()
+    sample.peak = peak - base[1]
+    sample.blocks = len(tracemalloc.take_snapshot().traces) - base[0]
+
+
+def _start():
+    blocks = len(tracemalloc.take_snapshot().traces)
+    tracemalloc.reset_peak()
+    return blocks, tracemalloc.get_traced_memory()[0]
+
+
+async def _async_cold(port, n, timeout_ms):
+    samples = []
+    for _ in range(n):
+        s = Sample()
+        base = _start()
+        t0 = time.perf_counter()
+        try:
+            device = await cast.connect("127.0.0.1", port)
+            try:
+                if await device.prepare():
+                    await device.load(URL)
+                    s.ok = await device.confirmed(timeout_ms)
+                s.timings = dict(device.timings)
+            finally:
+                device.disconnect()
+        except OSError as e:
+            print("connect failed:", e)
+        s.wall = (time.perf_counter() - t0) * 1000
+        _measure(s, base)
+        samples.append(s)
+    return samples
+
+
+async def _async_warm(port, n, timeout_ms):
+    samples = []
+    for _ in range(n):
+        s = Sample()
+        base = _start()
+        t0 = time.perf_counter()
+        device = cast.pooled("127.0.0.1", port)
+        try:
+            if device is None:
+                device = await cast.connect("127.0.0.1", port)
+            if await device.prepare():
+                await device.load(URL)
+                s.ok = await device.confirmed(timeout_ms)
+            s.timings = dict(device.timings)
+        except OSError as e:
+            print("connect failed:", e)
+            device = None
+        if device is not None:
+            if s.ok:
+                cast.keep(device)
+            else:
+                device.disconnect()
+        s.wall = (time.perf_counter() - t0) * 1000
+        _measure(s, base)
+        samples.append(s)
+        await asyncio.sleep(0)  # Let the reader task answer PINGs between plays
+    cast.close_pool()
+    return samples
+
+
+def _sync_cold(port, n, timeout_ms):
+    samples = []
+    for _ in range(n):
+        s = Sample()
+        base = _start()
+        t0 = time.perf_counter()
+        try:
+            device = Chromecast("127.0.0.1", port)
+            try:
+                s.ok = device.play_url(URL)
+            finally:
+                device.disconnect()
+        except OSError as e:
+            print("connect failed:", e)
+        s.wall = (time.perf_counter() - t0) * 1000
+        _measure(s, base)
+        samples.append(s)
+    return samples
+
+
+def _pct(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def report(name, samples):
+    ok = sum(1 for s in samples if s.ok)
+    print("\n%s: %d/%d confirmed" % (name, ok, len(samples)))
+    print("  %-8s %5s %8s %8s %8s" % ("phase", "n", "median", "p95", "max"))
+    rows = [(k, [s.timings[k] for s in samples if k in s.timings]) for k in PHASES]
+    rows.append(("wall", [s.wall for s in samples]))
+    for key, values in rows:
+        if values:
+            print(
+                "  %-8s %5d %8.1f %8.1f %8.1f"
+                % (key, len(values), _pct(values, 50), _pct(values, 95), max(values))
+            )
+    peaks = [s.peak / 1024.0 for s in samples]
+    blocks = [s.blocks for s in samples]
+    n = len(samples)
+    print("  %-8s %5d %8.1f %8.1f %8.1f" % ("peak KB", n, _pct(peaks, 50), _pct(peaks, 95), max(peaks)))
+    print("  %-8s %5d %8d %8d %8d" % ("blocks", n, _pct(blocks, 50), _pct(blocks, 95), max(blocks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument(
+        "--client",
+        choices=("async-cold", "async-warm", "sync-cold", "all"),
+        default="all",
+    )
+    parser.add_argument("--timeout-ms", type=int, default=8000)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    receiver = receiver_from_args(args)
+    certfile, keyfile = upy_host.self_signed_cert(tempfile.mkdtemp())
+    server = ReceiverThread(receiver, certfile, keyfile)
+    port = server.start()
+
+    tracemalloc.start()
+    runs = []
+    if args.client in ("async-cold", "all"):
+        runs.append(("async-cold", asyncio.run(_async_cold(port, args.iterations, args.timeout_ms))))
+    if args.client in ("async-warm", "all"):
+        runs.append(("async-warm", asyncio.run(_async_warm(port, args.iterations, args.timeout_ms))))
+    if args.client in ("sync-cold", "all"):
+        runs.append(("sync-cold", _sync_cold(port, args.iterations, args.timeout_ms)))
+    tracemalloc.stop()
+    server.stop()
+
+    for name, samples in runs:
+        report(name, samples)
+    print("\nreceiver:", dict(receiver.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Broker failover check for source/mqtt.py against stand-in brokers.
+
+Runs the firmware's MQTTHandler (on upy_host's device stand-ins) against
+FakeBrokers from fake_broker.py on loopback:
+
+    A  slow: CONNACK after --slow-ms
+    B  fast
+    C  refuses every connection ("server unavailable")
+    D  fast, only listed by the set_brokers step
+
+and walks through:
+
+    boot         broker list [A, B, C]; nothing measured yet, so A (first)
+    probe        connect-RTT probe of every broker; moves to B
+    crash B      B stops; fails over to A, no reboot
+    restart B    B is back; the next probe moves back to B
+    set_brokers  a command replaces the list with [C, D]; moves to D
+
+Each step prints the time until the handler was connected again, where it
+ended up, and the broker health the device would report. A step fails if
+the handler ends up elsewhere or the firmware asks for a reboot.
+
+    python3 tools/bench_failover.py
+    python3 tools/bench_failover.py --slow-ms 800
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import upy_host  # noqa: E402
+
+upy_host.install_device()
+from fake_broker import FakeBroker  # noqa: E402
+import mqtt  # noqa: E402
+
+DEVICE_ID = "0200000000aa"
+
+
+async def _until(predicate, timeout_s):
+    start = time.monotonic()
+    while not predicate():
+        if time.monotonic() - start > timeout_s:
+            raise TimeoutError
+        await asyncio.sleep(0.01)
+    return (time.monotonic() - start) * 1000
+
+
+def _on(handler, broker):
+    """The handler is connected to broker."""
+    return handler.connected and handler.mqtt is not None and handler.mqtt.port == broker.port
+
+
+class Run(object):
+    def __init__(self, handler, brokers, timeout_s):
+        self.handler = handler
+        self.brokers = brokers
+        self.timeout_s = timeout_s
+        self.failed = 0
+
+    async def step(self, name, action, expect):
+        result = action()
+        if asyncio.iscoroutine(result):
+            await result
+        try:
+            ms = await _until(lambda: _on(self.handler, expect), self.timeout_s)
+            ok = "ok"
+        except TimeoutError:
+            ms = self.timeout_s * 1000
+            ok = "FAILED"
+            self.failed += 1
+        where = [b.name for b in self.brokers if _on(self.handler, b)]
+        health = self.handler._brokers.health()[1]
+        print(
+            "  %-12s %-6s %7.0f ms  on %-2s  %s"
+            % (name, ok, ms, where[0] if where else "-",
+               "  ".join("%s:%s/%s" % (h[0].rsplit(":", 1)[1], h[1], h[2]) for h in health))
+        )
+
+
+async def scenario(args):
+    a = FakeBroker("A", connack_ms=args.slow_ms)
+    b = FakeBroker("B")
+    c = FakeBroker("C", refuse=True)
+    d = FakeBroker("D")
+    for broker in (a, b, c, d):
+        await broker.serve()
+    brokers = (a, b, c, d)
+
+    upy_host.device_files(tempfile.mkdtemp())
+    handler = mqtt.MQTTHandler(DEVICE_ID)
+    handler._brokers.set(["127.0.0.1:%d" % x.port for x in (a, b, c)])
+    run = Run(handler, brokers, args.timeout)
+
+    print("Broker failover (A slow %d ms, B fast, C refusing, D fast)" % args.slow_ms)
+    print("  %-12s %-6s %10s  %-5s  port:rtt/failures per broker" % ("step", "", "recover", "on"))
+    task = None
+
+    def boot():
+        nonlocal task
+
+        async def serve():
+            try:
+                await handler.mqtt_connect()
+            except Exception as e:
+                print("  first connect failed:", e)
+            await handler.mqtt_run()
+
+        task = asyncio.ensure_future(serve())
+
+    await run.step("boot", boot, a)
+    await run.step("probe", handler._probe_brokers, b)
+    await run.step("crash B", b.stop, a)
+    await b.start()
+    await run.step("restart B", handler._probe_brokers, b)
+
+    command = {
+        "action": "set_brokers",
+        "props": {"brokers": ["127.0.0.1:%d" % x.port for x in (c, d)]},
+    }
+    await run.step(
+        "set_brokers",
+        lambda: b.publish("projectbilal/%s" % DEVICE_ID, json.dumps(command)),
+        d,
+    )
+
+    if task.done() and isinstance(task.exception(), upy_host.Reset):
+        print("  device rebooted")
+        run.failed += 1
+    task.cancel()
+    for broker in brokers:
+        broker.stop()
+    await asyncio.sleep(0.1)  # Let the dropped connections wind down
+    print("  session:", handler._session_health())
+    return run.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slow-ms", type=int, default=400)
+    parser.add_argument("--timeout", type=float, default=30, help="seconds per step")
+    args = parser.parse_args()
+    failed = asyncio.run(scenario(args))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Accuracy and speed benchmark for source/prayer.py.
+
+The reference is an independent implementation: the NOAA solar calculator
+equations (Meeus) for declination and equation of time, evaluated at the
+event time itself and iterated to convergence, where the firmware uses the
+low-precision PrayTimes.org formulas with two refinement passes. Both
+apply the same conventions (0.833 deg sunrise/sunset, method angles,
+"middle of the night" high-latitude rule), so the differences measure the
+firmware's approximations rather than differing definitions.
+
+For every place it compares all six times for each day of a year and
+reports mean / p95 / max absolute error in minutes (the firmware rounds to
+whole minutes, so errors up to 0.5 min are rounding alone; larger ones
+are left on the days around the midnight sun / polar night), then times
+compute() per day, a full table build and a table lookup.
+
+Host floats are double precision; on the ESP32 (single precision) expect
+roughly another minute at worst, which is why prayer.py works in days from
+J2000 instead of Julian dates.
+
+    python3 tools/bench_prayer.py
+    python3 tools/bench_prayer.py --year 2027 --method ISNA --asr hanafi
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import upy_host  # noqa: E402
+
+upy_host.install()
+import prayer  # noqa: E402
+
+PLACES = (
+    ("Mecca", 21.4225, 39.8262),
+    ("Jakarta", -6.2088, 106.8456),
+    ("London", 51.5074, -0.1278),
+    ("New York", 40.7128, -74.0060),
+    ("Sydney", -33.8688, 151.2093),
+    ("Oslo", 59.9139, 10.7522),  # Twilight never ends in summer
+    ("Tromso", 69.6492, 18.9553),  # Midnight sun and polar night
+    ("Honolulu", 21.3069, -157.8583),
+)
+
+
+# --- Reference (NOAA / Meeus, iterated) ---
+
+
+def _noaa_sun(jd):
+    """Declination (deg) and equation of time (minutes) at Julian date jd."""
+    r = math.radians
+    t = (jd - 2451545.0) / 36525
+    l0 = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360
+    m = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    c = (
+        math.sin(r(m)) * (1.914602 - t * (0.004817 + 0.000014 * t))
+        + math.sin(r(2 * m)) * (0.019993 - 0.000101 * t)
+        + math.sin(r(3 * m)) * 0.000289
+    )
+    omega = 125.04 - 1934.136 * t
+    lam = l0 + c - 0.00569 - 0.00478 * math.sin(r(omega))
+    eps0 = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+    eps = eps0 + 0.00256 * math.cos(r(omega))
+    decl = math.degrees(math.asin(math.sin(r(eps)) * math.sin(r(lam))))
+    y = math.tan(r(eps / 2)) ** 2
+    eqt = 4 * math.degrees(
+        y * math.sin(2 * r(l0))
+        - 2 * e * math.sin(r(m))
+        + 4 * e * y * math.sin(r(m)) * math.cos(2 * r(l0))
+        - 0.5 * y * y * math.sin(4 * r(l0))
+        - 1.25 * e * e * math.sin(2 * r(m))
+    )
+    return decl, eqt
+
+
+class _RefDay(object):
+    def __init__(self, lat, lon, days):
+        self.lat = lat
+        self.lon = lon
+        self.jd0 = 2440587.5 + days  # JD at this UTC midnight
+
+    def _sun(self, minutes):
+        return _noaa_sun(self.jd0 + minutes / 1440.0)
+
+    def noon(self):
+        t = 720 - 4 * self.lon
+        for _ in range(5):
+            t = 720 - 4 * self.lon - self._sun(t)[1]
+        return t
+
+    def altitude_time(self, altitude_fn, before_noon):
+        """UTC minutes when the sun reaches altitude_fn(decl) (None if never)."""
+        r = math.radians
+        t = self.noon() + (-360 if before_noon else 360)
+        for _ in range(8):
+            decl, eqt = self._sun(t)
+            a = altitude_fn(decl)
+            c = (math.sin(r(a)) - math.sin(r(self.lat)) * math.sin(r(decl))) / (
+                math.cos(r(self.lat)) * math.cos(r(decl))
+            )
+            if not -1 <= c <= 1:
+                return None
+            h = math.degrees(math.acos(c)) * 4
+            noon = 720 - 4 * self.lon - eqt
+            t = noon - h if before_noon else noon + h
+        return t
+
+
+def reference(lat, lon, method, asr, days):
+    fajr_angle, maghrib_param, isha_param = prayer.METHODS[method]
+    factor = prayer.ASR[asr]
+    day = _RefDay(lat, lon, days)
+    fajr = day.altitude_time(lambda d: -fajr_angle, True)
+    sunrise = day.altitude_time(lambda d: -0.833, True)
+    dhuhr = day.noon()
+    asr_t = day.altitude_time(
+        lambda d: math.degrees(math.atan(1 / (factor + math.tan(math.radians(abs(lat - d)))))),
+        False,
+    )
+    sunset = day.altitude_time(lambda d: -0.833, False)
+    if sunset is None:
+        maghrib = None
+    elif isinstance(maghrib_param, int):
+        maghrib = sunset + maghrib_param
+    else:
+        maghrib = day.altitude_time(lambda d: -maghrib_param, False)
+    if isinstance(isha_param, int):
+        isha = maghrib + isha_param if maghrib is not None else None
+    else:
+        isha = day.altitude_time(lambda d: -isha_param, False)
+
+    if sunrise is not None and sunset is not None:
+        portion = (1440 + sunrise - sunset) / 2
+        if fajr is None or sunrise - fajr > portion:
+            fajr = sunrise - portion
+        if isha is None or isha - sunset > portion:
+            isha = sunset + portion
+        if maghrib is None or maghrib - sunset > portion:
+            maghrib = sunset + portion
+    return (fajr, sunrise, dhuhr, asr_t, maghrib, isha)
+
+
+# --- Benchmark ---
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def accuracy(year, method, asr):
+    first = prayer.days_from_civil(year, 1, 1)
+    n = prayer.days_from_civil(year + 1, 1, 1) - first
+    print("Accuracy vs reference, %d, %s, asr %s (minutes)" % (year, method, asr))
+    print("  %-10s %-8s %6s %6s %6s" % ("place", "time", "mean", "p95", "max"))
+    worst = 0
+    for name, lat, lon in PLACES:
+        errors = [[] for _ in prayer.NAMES]
+        missing = 0
+        for d in range(first, first + n):
+            got = prayer.compute(lat, lon, method, asr, d)
+            want = reference(lat, lon, method, asr, d)
+            for i in range(len(prayer.NAMES)):
+                if (got[i] == prayer._NONE) != (want[i] is None):
+                    missing += 1  # One side found the event, the other did not
+                elif want[i] is not None:
+                    errors[i].append(abs(got[i] - want[i]))
+        if missing:
+            print("  %-10s %d times occur on one side only (polar edge days)" % (name, missing))
+        for i, label in enumerate(prayer.NAMES):
+            e = errors[i] or [0]
+            worst = max(worst, max(e))
+            print(
+                "  %-10s %-8s %6.2f %6.2f %6.2f"
+                % (name if i == 0 else "", label, sum(e) / len(e), _pct(e, 95), max(e))
+            )
+    print("  worst: %.2f min" % worst)
+
+
+def speed(year, method, asr):
+    lat, lon = PLACES[0][1:]
+    first = prayer.days_from_civil(year, 1, 1)
+    n = 365
+    t0 = time.perf_counter()
+    for d in range(first, first + n):
+        prayer.compute(lat, lon, method, asr, d)
+    per_day = (time.perf_counter() - t0) / n * 1e6
+
+    path = os.path.join(tempfile.mkdtemp(), "prayer.bin")
+    table = prayer.PrayerTable(path)
+    key = prayer.table_key({"lat": lat, "lon": lon, "method": method, "asr": asr}, year)
+    t0 = time.perf_counter()
+    asyncio.run(table.build(key))
+    build = (time.perf_counter() - t0) * 1000
+
+    # The stored table must round-trip exactly
+    for d in range(first, first + n):
+        row = prayer.compute(key[1] / 10000, key[2] / 10000, method, asr, d)
+        want = tuple(None if m == prayer._NONE else d * 86400 + m * 60 for m in row)
+        assert table.day(d) == want, d
+
+    t0 = time.perf_counter()
+    for d in range(first, first + n):
+        table.day(d)
+    lookup = (time.perf_counter() - t0) / n * 1e6
+
+    print("\nSpeed (host CPython)")
+    print("  compute()     %8.1f us / day" % per_day)
+    print("  table build   %8.1f ms (%d days, %d bytes)" % (build, prayer._TABLE_DAYS, os.path.getsize(path)))
+    print("  table lookup  %8.1f us / day (file read, no trig)" % lookup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--year", type=int, default=time.gmtime().tm_year)
+    parser.add_argument("--method", choices=sorted(prayer.METHODS), default="MWL")
+    parser.add_argument("--asr", choices=sorted(prayer.ASR), default="standard")
+    args = parser.parse_args()
+    accuracy(args.year, args.method, args.asr)
+    speed(args.year, args.method, args.asr)
+
+
+if __name__ == "__main__":
+    main()
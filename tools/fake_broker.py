@@ -0,0 +1,275 @@
+"""
+Stand-in MQTT 3.1.1 broker for exercising source/amqtt.py and mqtt.py
+without the production VM.
+
+Handles what the firmware uses: CONNECT (with last will and persistent
+sessions), SUBSCRIBE with QoS 0/1, PUBLISH with QoS 0/1 (PUBACK both ways),
+PINGREQ and DISCONNECT. Topic filters may use the "+" and "#" wildcards.
+A client that connects with clean_session=False gets its subscriptions and
+the QoS 1 messages published while it was away back, and "session present"
+in CONNACK, like the real broker.
+
+Faults, to compare brokers and exercise failover:
+
+    --connack-ms MS   answer CONNECT after MS (a slow or overloaded broker)
+    --refuse          answer CONNECT with "server unavailable"
+
+stop() / start() in code simulate a crash and a restart on the same port.
+The codec here is written independently of amqtt.py on purpose.
+
+    python3 tools/fake_broker.py --port 1883 --connack-ms 250
+"""
+
+import argparse
+import asyncio
+import struct
+from collections import Counter
+
+
+def _encode_length(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _encode_str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return struct.pack(">H", len(s)) + s
+
+
+def _decode_str(data, i):
+    n = struct.unpack_from(">H", data, i)[0]
+    return data[i + 2 : i + 2 + n], i + 2 + n
+
+
+def packet(first, body=b""):
+    return bytes((first,)) + _encode_length(len(body)) + body
+
+
+def _matches(pattern, topic):
+    levels = topic.split(b"/")
+    parts = pattern.split(b"/")
+    for i, part in enumerate(parts):
+        if part == b"#":
+            return True
+        if i >= len(levels) or part not in (b"+", levels[i]):
+            return False
+    return len(parts) == len(levels)
+
+
+class _Session(object):
+    def __init__(self):
+        self.subs = {}  # topic filter -> granted QoS
+        self.queued = []  # (topic, payload) QoS 1 messages for an offline client
+        self.writer = None
+        self.clean = True  # Forgotten when the connection ends
+
+
+class FakeBroker(object):
+    """One broker; any number of clients, sessions kept across reconnects."""
+
+    def __init__(self, name="broker", connack_ms=0, refuse=False):
+        self.name = name
+        self.connack_ms = connack_ms
+        self.refuse = refuse
+        self.port = None
+        self.stats = Counter()
+        self.received = []  # (client id, topic, payload) of every PUBLISH
+        self.on_publish = None  # Optional callback(client id, topic, payload)
+        self._sessions = {}
+        self._server = None
+        self._writers = set()
+        self._pid = 0
+
+    # --- Server ---
+
+    async def serve(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._client, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def start(self):
+        """Listen again on the previous port after stop()."""
+        return await self.serve(port=self.port)
+
+    def stop(self):
+        """Crash: stop listening and drop every connection without a word."""
+        if self._server:
+            self._server.close()
+            self._server = None
+        for w in list(self._writers):
+            w.transport.abort()
+        self._writers.clear()
+
+    @property
+    def running(self):
+        return self._server is not None
+
+    def clients(self):
+        """Client ids currently connected."""
+        return [cid for cid, s in self._sessions.items() if s.writer is not None]
+
+    # --- Publishing ---
+
+    def publish(self, topic, payload, qos=1):
+        """Deliver a message as if another client had published it."""
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        for session in self._sessions.values():
+            granted = [q for f, q in session.subs.items() if _matches(f, topic)]
+            if not granted:
+                continue
+            q = min(qos, max(granted))
+            if session.writer is not None:
+                self._send_publish(session.writer, topic, payload, q)
+            elif q:
+                session.queued.append((topic, payload))
+
+    def _send_publish(self, writer, topic, payload, qos):
+        body = _encode_str(topic)
+        if qos:
+            self._pid = self._pid % 0xFFFF + 1
+            body += struct.pack(">H", self._pid)
+        writer.write(packet(0x30 | qos << 1, body + payload))
+        self.stats["delivered"] += 1
+
+    # --- Connection ---
+
+    async def _read(self, reader):
+        first = (await reader.readexactly(1))[0]
+        n = shift = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return first, await reader.readexactly(n)
+
+    async def _client(self, reader, writer):
+        self._writers.add(writer)
+        cid = None
+        will = None
+        try:
+            first, body = await self._read(reader)
+            if first != 0x10:
+                return
+            cid, will, clean = self._parse_connect(body)
+            self.stats["connects"] += 1
+            if self.connack_ms:
+                await asyncio.sleep(self.connack_ms / 1000)
+            if self.refuse:
+                self.stats["refused"] += 1
+                will = None
+                writer.write(packet(0x20, b"\x00\x03"))  # Server unavailable
+                await writer.drain()
+                return
+            session = self._sessions.get(cid)
+            present = session is not None and not clean
+            if session is not None and session.writer is not None:
+                session.writer.transport.abort()  # Same id connected twice
+            if not present:
+                session = self._sessions[cid] = _Session()
+            else:
+                self.stats["resumed"] += 1
+            session.writer = writer
+            session.clean = clean
+            writer.write(packet(0x20, bytes((1 if present else 0, 0))))
+            for topic, payload in session.queued:
+                self._send_publish(writer, topic, payload, 1)
+            session.queued = []
+            await self._serve_client(reader, writer, cid, session)
+            will = None  # Clean DISCONNECT: no last will
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            session = self._sessions.get(cid)
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    del self._sessions[cid]
+            if will is not None:
+                self.stats["wills"] += 1
+                self.publish(*will)
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    def _parse_connect(self, body):
+        _, i = _decode_str(body, 0)  # "MQTT"
+        flags = body[i + 1]
+        i += 4  # level, flags, keepalive
+        cid, i = _decode_str(body, i)
+        will = None
+        if flags & 0x04:
+            topic, i = _decode_str(body, i)
+            msg, i = _decode_str(body, i)
+            will = (topic, msg, flags >> 3 & 3)
+        return cid.decode(), will, bool(flags & 0x02)
+
+    async def _serve_client(self, reader, writer, cid, session):
+        while True:
+            first, body = await self._read(reader)
+            kind = first & 0xF0
+            if kind == 0x30:
+                qos = first >> 1 & 3
+                topic, i = _decode_str(body, 0)
+                if qos:
+                    writer.write(packet(0x40, body[i : i + 2]))
+                    i += 2
+                payload = body[i:]
+                self.stats["published"] += 1
+                self.received.append((cid, topic.decode(), payload))
+                if self.on_publish:
+                    self.on_publish(cid, topic.decode(), payload)
+                self.publish(topic, payload, qos)
+            elif kind == 0x80:
+                pid = body[:2]
+                i = 2
+                granted = bytearray()
+                while i < len(body):
+                    f, i = _decode_str(body, i)
+                    q = min(body[i], 1)
+                    i += 1
+                    session.subs[f] = q
+                    granted.append(q)
+                writer.write(packet(0x90, pid + bytes(granted)))
+                self.stats["subscribes"] += 1
+            elif kind == 0x40:
+                pass  # PUBACK for a delivery; nothing is redelivered here
+            elif kind == 0xC0:
+                writer.write(packet(0xD0))
+                self.stats["pings"] += 1
+            elif kind == 0xE0:
+                return
+            await writer.drain()
+
+
+async def _main(args):
+    broker = FakeBroker(connack_ms=args.connack_ms, refuse=args.refuse)
+    port = await broker.serve(args.host, args.port)
+    print("Fake broker listening on %s:%d" % (args.host, port))
+    while True:
+        await asyncio.sleep(30)
+        print(dict(broker.stats), "clients:", broker.clients())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--connack-ms", type=int, default=0)
+    parser.add_argument("--refuse", action="store_true")
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,417 @@
+"""
+Fake Chromecast receiver for exercising source/cast.py without a speaker.
+
+Speaks CastV2 over TLS (4-byte big-endian length + CastMessage protobuf) and
+answers the messages the firmware sends: CONNECT, GET_STATUS, LAUNCH,
+SET_VOLUME, media GET_STATUS, LOAD and QUEUE_LOAD. The Default Media
+Receiver's state survives reconnects, like a real speaker, so warm plays skip
+LAUNCH.
+
+Faults can be injected to reproduce what flaky speakers and Wi-Fi do:
+
+    --delay-ms      extra latency before every reply
+    --launch-ms     time the app takes to start
+    --load-ms       time until MEDIA_STATUS confirms a LOAD
+    --item-ms MS    play each item for MS, then report the next / IDLE FINISHED
+    --split N       write frames in N-byte chunks (partial TLS reads)
+    --drop TYPE     never answer TYPE (LAUNCH, LOAD, GET_STATUS, ...)
+    --drop-rate P   answer dropped types with probability 1 - P
+    --oversized N   precede each status with an N-byte junk frame
+    --ping-ms MS    send heartbeat PINGs every MS and count the PONGs
+
+The codec here is written independently of cast.py on purpose, so it checks
+the firmware's framing instead of agreeing with it by construction.
+
+Run standalone to point a device (or cast.py on the host) at it:
+
+    python3 tools/fake_cast.py --port 8009 --launch-ms 1500 --ping-ms 5000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import ssl
+import struct
+import tempfile
+from collections import Counter
+
+NS_CONN = "urn:x-cast:com.google.cast.tp.connection"
+NS_HEARTBEAT = "urn:x-cast:com.google.cast.tp.heartbeat"
+NS_RECV = "urn:x-cast:com.google.cast.receiver"
+NS_MEDIA = "urn:x-cast:com.google.cast.media"
+
+MEDIA_APP_ID = "CC1AD845"
+RECEIVER = "receiver-0"
+
+
+# --- CastMessage codec ---
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _field(tag, data):
+    return _varint(tag << 3 | 2) + _varint(len(data)) + data
+
+
+def encode(namespace, payload, src=RECEIVER, dst="sender-0"):
+    """Encode one length-prefixed CastMessage with a JSON payload."""
+    if not isinstance(payload, (bytes, bytearray)):
+        # Real receivers send compact JSON; the firmware's parsers rely on it
+        payload = json.dumps(payload, separators=(",", ":")).encode()
+    body = (
+        b"\x08\x00"  # protocol_version CASTV2_1_0
+        + _field(2, src.encode())
+        + _field(3, dst.encode())
+        + _field(4, namespace.encode())
+        + b"\x28\x00"  # payload_type STRING
+        + _field(6, payload)
+    )
+    return struct.pack(">I", len(body)) + body
+
+
+def decode(body):
+    """Decode a CastMessage body into {field_number: value}."""
+    fields = {}
+    i = 0
+    while i < len(body):
+        key = 0
+        shift = 0
+        while True:
+            b = body[i]
+            i += 1
+            key |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        tag, wire = key >> 3, key & 7
+        n = 0
+        shift = 0
+        while True:
+            b = body[i]
+            i += 1
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        if wire == 0:
+            fields[tag] = n
+        elif wire == 2:
+            fields[tag] = body[i : i + n]
+            i += n
+        else:
+            raise ValueError("unsupported wire type %d" % wire)
+    return fields
+
+
+# --- Receiver ---
+
+
+class FakeReceiver(object):
+    """One simulated speaker; serve() may accept any number of sessions."""
+
+    def __init__(
+        self,
+        delay_ms=0,
+        launch_ms=300,
+        load_ms=150,
+        item_ms=0,
+        split=0,
+        drop=(),
+        drop_rate=1.0,
+        oversized=0,
+        ping_ms=0,
+        running=False,
+        seed=None,
+    ):
+        self.delay_ms = delay_ms
+        self.launch_ms = launch_ms
+        self.load_ms = load_ms
+        self.item_ms = item_ms
+        self.split = split
+        self.drop = set(t.upper() for t in drop)
+        self.drop_rate = drop_rate
+        self.oversized = oversized
+        self.ping_ms = ping_ms
+        self.transport_id = "web-1" if running else None
+        self.volume = 1.0
+        self.media_session = 0
+        self.queue = []
+        self.current = 0
+        self._next_item = 1
+        self._player = None  # (task, writer, lock, src, dst) of the playing session
+        self.stats = Counter()
+        self._launches = 1 if running else 0
+        self._random = random.Random(seed)
+        self._server = None
+
+    # --- Server ---
+
+    async def serve(self, host, port, certfile, keyfile):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile, keyfile)
+        self._server = await asyncio.start_server(self._session, host, port, ssl=ctx)
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    async def _session(self, reader, writer):
+        self.stats["sessions"] += 1
+        lock = asyncio.Lock()
+        pinger = None
+        if self.ping_ms:
+            pinger = asyncio.ensure_future(self._pinger(writer, lock))
+        try:
+            while True:
+                head = await reader.readexactly(4)
+                (n,) = struct.unpack(">I", head)
+                fields = decode(await reader.readexactly(n))
+                self.stats["frames_in"] += 1
+                asyncio.ensure_future(self._dispatch(fields, writer, lock))
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            if pinger:
+                pinger.cancel()
+            writer.close()
+
+    async def _pinger(self, writer, lock):
+        while True:
+            await asyncio.sleep(self.ping_ms / 1000)
+            self.stats["pings"] += 1
+            await self._write(writer, lock, encode(NS_HEARTBEAT, {"type": "PING"}))
+
+    async def _write(self, writer, lock, frame):
+        async with lock:
+            if self.split:
+                for i in range(0, len(frame), self.split):
+                    writer.write(frame[i : i + self.split])
+                    await writer.drain()
+                    await asyncio.sleep(0.002)
+                self.stats["split_frames"] += 1
+            else:
+                writer.write(frame)
+                await writer.drain()
+            self.stats["frames_out"] += 1
+
+    def _dropped(self, kind):
+        if kind in self.drop and self._random.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return True
+        return False
+
+    async def _junk(self, writer, lock, namespace):
+        # Oversized frames the client must skip without buffering them
+        pad = "x" * max(0, self.oversized - 200)
+        frame = encode(namespace, {"type": "DEVICE_INFO", "pad": pad})
+        self.stats["oversized"] += 1
+        await self._write(writer, lock, frame)
+
+    # --- Messages ---
+
+    async def _dispatch(self, fields, writer, lock):
+        ns = fields.get(4, b"").decode()
+        src = fields.get(2, b"").decode()
+        dst = fields.get(3, b"").decode()
+        msg = json.loads(bytes(fields.get(6, b"{}")))
+        kind = msg.get("type", "")
+        self.stats[kind] += 1
+
+        if ns == NS_HEARTBEAT:
+            if kind == "PONG":
+                self.stats["pongs"] += 1
+            elif kind == "PING":
+                await self._write(writer, lock, encode(NS_HEARTBEAT, {"type": "PONG"}, dst, src))
+            return
+        if ns == NS_CONN or self._dropped(kind):
+            return
+        if self.delay_ms:
+            await asyncio.sleep(self.delay_ms / 1000)
+
+        if ns == NS_RECV:
+            if kind == "LAUNCH":
+                await asyncio.sleep(self.launch_ms / 1000)
+                self._launches += 1
+                self.transport_id = "web-%d" % self._launches
+            elif kind == "SET_VOLUME":
+                self.volume = msg.get("volume", {}).get("level", self.volume)
+            elif kind != "GET_STATUS":
+                return
+            if self.oversized:
+                await self._junk(writer, lock, NS_RECV)
+                await self._junk(writer, lock, "urn:x-cast:com.example.junk")
+            reply = self._receiver_status(msg.get("requestId", 0))
+            await self._write(writer, lock, encode(NS_RECV, reply, dst, src))
+        elif ns == NS_MEDIA:
+            if dst != self.transport_id:
+                return  # Not addressed to a running app; real devices ignore it
+            if kind in ("LOAD", "QUEUE_LOAD"):
+                await asyncio.sleep(self.load_ms / 1000)
+                await self._interrupt()
+                items = msg.get("items") or [{"media": msg.get("media", {})}]
+                self.media_session += 1
+                self.queue = [dict(item, itemId=self._next_item + i) for i, item in enumerate(items)]
+                self._next_item += len(items)
+                self.current = 0
+                status = [self._media_status("BUFFERING")]
+                if self.item_ms:
+                    task = asyncio.ensure_future(self._play(writer, lock, dst, src))
+                    self._player = (task, writer, lock, dst, src)
+            elif kind == "GET_STATUS":
+                status = []
+            else:
+                return
+            reply = {
+                "type": "MEDIA_STATUS",
+                "status": status,
+                "requestId": msg.get("requestId", 0),
+            }
+            await self._write(writer, lock, encode(NS_MEDIA, reply, dst, src))
+
+    def _receiver_status(self, request_id):
+        apps = [
+            {
+                # A backdrop app ahead of ours, so a lazy transportId match fails
+                "appId": "E8C28D3C",
+                "displayName": "Backdrop",
+                "transportId": "backdrop-0",
+                "sessionId": "backdrop-0",
+            }
+        ]
+        if self.transport_id:
+            apps.append(
+                {
+                    "appId": MEDIA_APP_ID,
+                    "displayName": "Default Media Receiver",
+                    "transportId": self.transport_id,
+                    "sessionId": self.transport_id,
+                }
+            )
+        return {
+            "type": "RECEIVER_STATUS",
+            "requestId": request_id,
+            "status": {
+                "applications": apps,
+                "volume": {"level": self.volume, "muted": False},
+            },
+        }
+
+    def _media_status(self, state, reason=None):
+        status = {
+            "mediaSessionId": self.media_session,
+            "playerState": state,
+            "currentTime": 0,
+            "volume": {"level": self.volume, "muted": False},
+        }
+        if reason:
+            status["idleReason"] = reason
+        else:
+            item = self.queue[self.current]
+            status["currentItemId"] = item["itemId"]
+            status["media"] = item.get("media", {})
+            if len(self.queue) > 1:
+                status["items"] = [{"itemId": i["itemId"]} for i in self.queue]
+        return status
+
+    async def _media_update(self, writer, lock, src, dst, state, reason=None):
+        reply = {"type": "MEDIA_STATUS", "status": [self._media_status(state, reason)], "requestId": 0}
+        await self._write(writer, lock, encode(NS_MEDIA, reply, src, dst))
+
+    async def _play(self, writer, lock, src, dst):
+        # Simulated playback: each item lasts item_ms, then the next starts
+        await asyncio.sleep(0.05)
+        await self._media_update(writer, lock, src, dst, "PLAYING")
+        for i in range(len(self.queue)):
+            await asyncio.sleep(self.item_ms / 1000)
+            self.stats["items_played"] += 1
+            if i + 1 < len(self.queue):
+                self.current = i + 1
+                await self._media_update(writer, lock, src, dst, "PLAYING")
+        self._player = None
+        await self._media_update(writer, lock, src, dst, "IDLE", "FINISHED")
+
+    async def _interrupt(self):
+        # A new LOAD replaces whatever is playing, as on a real speaker
+        if self._player is None:
+            return
+        task, writer, lock, src, dst = self._player
+        self._player = None
+        task.cancel()
+        try:
+            await self._media_update(writer, lock, src, dst, "IDLE", "INTERRUPTED")
+        except (ConnectionError, RuntimeError, ssl.SSLError):
+            pass
+
+
+def add_fault_arguments(parser):
+    """The fault-injection switches, shared with the benchmark driver."""
+    parser.add_argument("--delay-ms", type=int, default=0)
+    parser.add_argument("--launch-ms", type=int, default=300)
+    parser.add_argument("--load-ms", type=int, default=150)
+    parser.add_argument("--item-ms", type=int, default=0)
+    parser.add_argument("--split", type=int, default=0, metavar="N")
+    parser.add_argument("--drop", action="append", default=[], metavar="TYPE")
+    parser.add_argument("--drop-rate", type=float, default=1.0, metavar="P")
+    parser.add_argument("--oversized", type=int, default=0, metavar="N")
+    parser.add_argument("--ping-ms", type=int, default=0)
+    parser.add_argument("--running", action="store_true", help="app already running")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def receiver_from_args(args):
+    return FakeReceiver(
+        delay_ms=args.delay_ms,
+        launch_ms=args.launch_ms,
+        load_ms=args.load_ms,
+        item_ms=args.item_ms,
+        split=args.split,
+        drop=args.drop,
+        drop_rate=args.drop_rate,
+        oversized=args.oversized,
+        ping_ms=args.ping_ms,
+        running=args.running,
+        seed=args.seed,
+    )
+
+
+async def _main(args):
+    import upy_host
+
+    receiver = receiver_from_args(args)
+    if args.cert:
+        certfile, keyfile = args.cert, args.key
+    else:
+        certfile, keyfile = upy_host.self_signed_cert(tempfile.mkdtemp())
+    port = await receiver.serve(args.host, args.port, certfile, keyfile)
+    print("Fake Chromecast listening on %s:%d" % (args.host, port))
+    try:
+        while True:
+            await asyncio.sleep(30)
+            print(dict(receiver.stats))
+    finally:
+        receiver.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8009)
+    parser.add_argument("--cert", help="PEM certificate (default: self-signed)")
+    parser.add_argument("--key", help="PEM private key for --cert")
+    add_fault_arguments(parser)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
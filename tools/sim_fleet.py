@@ -0,0 +1,432 @@
+"""
+Fleet simulator: thousands of virtual devices running the firmware's
+MQTTHandler on one Linux host, to size the broker and the command server.
+
+Every virtual device is a real mqtt.MQTTHandler (amqtt client, work queue,
+housekeeping scheduler, reconnect state machine) on upy_host's device
+stand-ins. Only the speaker is simulated: a cast module whose sessions take
+--cast-ms to connect and start playing. The devices share one event loop
+with a command server that
+
+    - boots the fleet over --ramp seconds
+    - sends every device a play with a request id at each prayer burst
+      (every --burst-every seconds, spread over --burst-spread ms), the way
+      the backend fans out the athan
+    - at --storm-at seconds drops every device's connection at once
+      (--storm blip), or crashes the in-process broker for --storm-down
+      seconds (--storm crash), to cause a reconnect storm
+
+Devices send their own keepalive pings and publish health every --health
+seconds (600 on the device).
+
+Reported:
+
+    fan-out   command published -> the device's MQTT callback
+    ack       command published -> "queued" ack back at the command server
+    result    command published -> "result" back (includes the simulated play)
+    devices   the devices with the worst result latency
+    storm     time until each device was connected again, peak reconnects/s
+    traffic   packets the broker handled, alerts the fleet would have sent
+
+The broker is an in-process fake_broker.FakeBroker unless --broker points
+at a real one (e.g. mosquitto). The devices and an in-process broker share
+one CPU core, so compare runs with each other rather than with production.
+
+One process means one NVS and one clock for every device, so the virtual
+devices run without the outbox and the local schedule (they would share
+one file) and start with the clock already synced. Without the outbox, a
+result published while the broker is down is lost, which shows up as
+"without a result" for the burst that was playing during a storm.
+
+    python3 tools/sim_fleet.py -n 500 --duration 120
+    python3 tools/sim_fleet.py -n 2000 --broker 127.0.0.1:1883 --storm-at 90
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import types
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import upy_host  # noqa: E402
+
+upy_host.install_device()
+from fake_broker import FakeBroker  # noqa: E402
+import amqtt  # noqa: E402
+import endpoints  # noqa: E402
+import mqtt  # noqa: E402
+import utils  # noqa: E402
+
+_QUIET = ("mqtt", "amqtt", "utils", "ntfy", "endpoints", "scheduler")
+
+
+# --- Simulated speaker ---
+
+
+class _Speaker(object):
+    """One simulated Chromecast session."""
+
+    def __init__(self, ms):
+        self.closed = False
+        self.timings = {}
+        self._ms = ms
+
+    async def prepare(self, volume=None):
+        await asyncio.sleep(self._ms / 2000)
+        return True
+
+    async def load(self, url, preload_s=None):
+        await asyncio.sleep(self._ms / 2000)
+        return True
+
+    async def confirmed(self, timeout_ms=8000):
+        return True
+
+    def disconnect(self):
+        self.closed = True
+
+
+def speaker_module(cast_ms):
+    """Stand-in for source/cast.py with the calls mqtt.py makes."""
+    cast = types.ModuleType("cast")
+
+    async def connect(ip, port, timeout_s=5):
+        await asyncio.sleep(cast_ms / 4000)  # TCP + TLS
+        return _Speaker(cast_ms)
+
+    cast.connect = connect
+    cast.pooled = lambda ip, port: None
+    cast.keep = lambda device: device.disconnect()
+    cast.evict = lambda *args, **kwargs: None
+    cast.service_pool = lambda: None
+    cast.close_pool = lambda: None
+    cast.watch = cast.unwatch = lambda device: None
+    return cast
+
+
+# --- Measurements ---
+
+
+def _pct(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _row(name, values, unit="ms"):
+    print(
+        "  %-10s %7d %9.1f %9.1f %9.1f %9.1f  %s"
+        % (name, len(values), _pct(values, 50), _pct(values, 95), _pct(values, 99),
+           max(values) if values else float("nan"), unit)
+    )
+
+
+class Fleet(object):
+    def __init__(self, args, host, port):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.devices = []  # MQTTHandler per virtual device
+        self.commands = {}  # id -> [device index, sent, received, acked, result, burst]
+        self.health = 0
+        self.alerts = Counter()  # Alert text without the device label
+        self.server = None
+        self.tasks = []
+
+    # Device side
+
+    def _wrap_callback(self, handler):
+        """Record when a command reaches the device, then run the real callback."""
+        sub_cb = handler.sub_cb
+
+        def callback(topic, msg):
+            if b'"id"' in msg:
+                command = self.commands.get(json.loads(msg).get("id"))
+                if command is not None and command[2] is None:
+                    command[2] = time.monotonic()
+            sub_cb(topic, msg)
+
+        handler.sub_cb = callback
+
+    async def _boot(self, handler, delay):
+        await asyncio.sleep(delay)
+        try:
+            await handler.mqtt_connect()
+        except Exception:
+            pass  # The reconnect state machine retries
+        await handler.mqtt_run()
+
+    def start_devices(self):
+        n = self.args.devices
+        for i in range(n):
+            handler = mqtt.MQTTHandler("02%010x" % i)
+            self._wrap_callback(handler)
+            self.devices.append(handler)
+            delay = self.args.ramp * i / n
+            self.tasks.append(asyncio.ensure_future(self._boot(handler, delay)))
+
+    def connected(self):
+        return sum(1 for d in self.devices if d.connected)
+
+    # Command server side
+
+    async def _connect_server(self):
+        self.server = amqtt.MQTTClient("sim-server", self.host, self.port, keepalive=60)
+        self.server.set_callback(self._reply)
+        await self.server.connect()
+        await self.server.subscribe("projectbilal/+/rpc")
+        await self.server.subscribe("projectbilal/+/health")
+
+    async def serve(self):
+        """Keep the command server connected (it loses the broker in a crash
+        storm like everyone else) and pinged."""
+        while True:
+            try:
+                if self.server is None or self.server.closed:
+                    await self._connect_server()
+                self.server.ping()
+                await asyncio.wait_for(self.server.wait_closed(), 30)
+            except (OSError, asyncio.TimeoutError, amqtt.MQTTException):
+                await asyncio.sleep(0.5)
+
+    async def server_up(self, timeout_s=30):
+        start = time.monotonic()
+        while self.server is None or self.server.closed:
+            if time.monotonic() - start > timeout_s:
+                raise OSError("command server cannot reach the broker")
+            await asyncio.sleep(0.1)
+
+    def _reply(self, topic, msg):
+        now = time.monotonic()
+        if topic.endswith(b"/health"):
+            self.health += 1
+            return
+        try:
+            reply = json.loads(msg)
+        except ValueError:
+            return
+        command = self.commands.get(reply.get("id"))
+        if command is None:
+            return
+        if reply.get("type") == "ack" and command[3] is None:
+            command[3] = now
+        elif reply.get("type") == "result" and command[4] is None:
+            command[4] = now
+
+    async def burst(self, number):
+        """A play to every device, spread over --burst-spread ms."""
+        await self.server_up()
+        n = len(self.devices)
+        spread = self.args.burst_spread / 1000
+        start = time.monotonic()
+        for i, handler in enumerate(self.devices):
+            due = start + spread * i / n
+            if due > time.monotonic():
+                await self.server.drain()
+                await asyncio.sleep(due - time.monotonic())
+            rid = "b%d-%d" % (number, i)
+            command = {
+                "action": "play",
+                "id": rid,
+                "ts": time.time(),
+                "props": {
+                    "url": "http://example.invalid/athan-%d.mp3" % number,
+                    "ip": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                    "port": 8009,
+                    "label": "athan",
+                },
+            }
+            try:
+                self.server.publish("projectbilal/%s" % handler.id, json.dumps(command), qos=1)
+            except OSError:
+                await self.server_up()
+                continue
+            self.commands[rid] = [i, time.monotonic(), None, None, None, number]
+        await self.server.drain()
+
+    async def storm(self, broker):
+        """Drop every connection at once; returns per-device recovery ms and
+        the most reconnects seen in one second."""
+        start = time.monotonic()
+        if self.args.storm == "crash" and broker is not None:
+            broker.stop()
+            await asyncio.sleep(self.args.storm_down)
+            await broker.start()
+        else:
+            for handler in self.devices:
+                if handler.mqtt is not None:
+                    handler.mqtt.close()
+            await asyncio.sleep(0.2)
+        recovered = {}
+        peak = 0
+        second = time.monotonic()
+        count = 0
+        while len(recovered) < len(self.devices):
+            now = time.monotonic()
+            if now - start > self.args.storm_timeout:
+                break
+            for i, handler in enumerate(self.devices):
+                if i not in recovered and handler.connected:
+                    recovered[i] = (now - start) * 1000
+                    count += 1
+            if now - second >= 1:
+                peak = max(peak, count)
+                count = 0
+                second = now
+            await asyncio.sleep(0.05)
+        return list(recovered.values()), max(peak, count)
+
+
+async def run(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if 2 * args.devices + 64 > hard:
+        print("Warning: %d file descriptors may not be enough (ulimit -n)" % hard)
+
+    if not args.verbose:
+        for name in _QUIET:
+            sys.modules[name].print = lambda *a, **k: None
+        sys.print_exception = lambda e: None
+    # One collect on the host scans every device's objects
+    gc.collect = lambda *a: 0
+    sys.modules["cast"] = speaker_module(args.cast_ms)
+    mqtt._HEALTH_INTERVAL = args.health
+    mqtt.MQTTHandler._open_outbox = staticmethod(lambda: None)
+    mqtt.MQTTHandler._open_schedule = staticmethod(lambda: None)
+    utils._clock = (utils.time.ticks_ms(), int(time.time() * 1000))
+
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.rpartition(":")
+        port = int(port)
+    else:
+        broker = FakeBroker("sim")
+        host, port = "127.0.0.1", await broker.serve()
+    endpoints.Endpoints("mqtt", (host, port)).set([[host, port]])
+
+    fleet = Fleet(args, host, port)
+
+    def alert(message, *a, **k):
+        kind = message.split("] ", 1)[-1].split(":", 1)[0]
+        fleet.alerts[kind[:60]] += 1
+
+    mqtt.ntfy_alert = alert
+    fleet.tasks.append(asyncio.ensure_future(fleet.serve()))
+    await fleet.server_up()
+    print(
+        "Fleet: %d devices -> %s:%d (%s), ramp %ds, health every %ds"
+        % (args.devices, host, port, "in-process" if broker else "external",
+           args.ramp, args.health)
+    )
+    began = time.monotonic()
+    fleet.start_devices()
+
+    def elapsed():
+        return time.monotonic() - began
+
+    await asyncio.sleep(args.ramp)
+    print("  t=%4.0fs  %d/%d connected" % (elapsed(), fleet.connected(), args.devices))
+
+    storm = None
+    bursts = 0
+    next_burst = args.ramp + 5
+    while elapsed() < args.duration:
+        if args.storm_at and storm is None and elapsed() >= args.storm_at:
+            print("  t=%4.0fs  reconnect storm (%s)" % (elapsed(), args.storm))
+            storm = await fleet.storm(broker)
+            print("  t=%4.0fs  %d/%d connected" % (elapsed(), fleet.connected(), args.devices))
+        elif args.burst_every and elapsed() >= next_burst:
+            bursts += 1
+            print("  t=%4.0fs  prayer burst %d" % (elapsed(), bursts))
+            await fleet.burst(bursts)
+            next_burst += args.burst_every
+        else:
+            await asyncio.sleep(0.2)
+
+    # Let the last plays finish
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and any(c[4] is None for c in fleet.commands.values()):
+        await asyncio.sleep(0.2)
+
+    report(fleet, broker, storm, elapsed())
+    for task in fleet.tasks:
+        task.cancel()
+    if broker is not None:
+        broker.stop()
+    await asyncio.sleep(0.1)
+
+
+def report(fleet, broker, storm, seconds):
+    commands = list(fleet.commands.values())
+    print("\nCommands (%d sent)" % len(commands))
+    print("  %-10s %7s %9s %9s %9s %9s" % ("", "n", "p50", "p95", "p99", "max"))
+    _row("fan-out", [(c[2] - c[1]) * 1000 for c in commands if c[2]])
+    _row("ack", [(c[3] - c[1]) * 1000 for c in commands if c[3]])
+    _row("result", [(c[4] - c[1]) * 1000 for c in commands if c[4]])
+    lost = Counter(c[5] for c in commands if c[4] is None)
+    if lost:
+        print(
+            "  without a result: %s"
+            % ", ".join("%d in burst %d" % (n, b) for b, n in sorted(lost.items()))
+        )
+
+    per_device = {}
+    for c in commands:
+        if c[4]:
+            per_device.setdefault(c[0], []).append((c[4] - c[1]) * 1000)
+    if per_device:
+        worst = sorted(per_device.items(), key=lambda kv: -max(kv[1]))[:5]
+        print("\nSlowest devices (result ms per command)")
+        for i, values in worst:
+            print("  %s  %s" % (fleet.devices[i].id, " ".join("%.0f" % v for v in values)))
+
+    if storm is not None:
+        recovered, peak = storm
+        print("\nReconnect storm")
+        print("  %-10s %7s %9s %9s %9s %9s" % ("", "n", "p50", "p95", "p99", "max"))
+        _row("recover", recovered)
+        print("  not recovered: %d, peak reconnects: %d/s" % (len(fleet.devices) - len(recovered), peak))
+
+    print("\nTraffic over %.0f s" % seconds)
+    alerts = sum(fleet.alerts.values())
+    print("  health reports: %d, alerts: %d (%.1f/min)"
+          % (fleet.health, alerts, alerts * 60 / seconds))
+    for kind, count in fleet.alerts.most_common(5):
+        print("    %5d  %s" % (count, kind))
+    if broker is not None:
+        stats = broker.stats
+        print(
+            "  broker: %d connects (%d resumed), %d publishes in, %d delivered, %d pings, %d wills"
+            % (stats["connects"], stats["resumed"], stats["published"], stats["delivered"],
+               stats["pings"], stats["wills"])
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--devices", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=90, help="seconds")
+    parser.add_argument("--broker", metavar="HOST:PORT", help="external broker")
+    parser.add_argument("--ramp", type=float, default=10, help="boot spread, seconds")
+    parser.add_argument("--health", type=int, default=600, help="health interval, seconds")
+    parser.add_argument("--burst-every", type=float, default=30, help="seconds, 0 = none")
+    parser.add_argument("--burst-spread", type=float, default=500, help="ms")
+    parser.add_argument("--cast-ms", type=int, default=1500, help="simulated speaker start")
+    parser.add_argument("--storm-at", type=float, default=0, help="seconds, 0 = none")
+    parser.add_argument("--storm", choices=("blip", "crash"), default="blip")
+    parser.add_argument("--storm-down", type=float, default=5, help="crash outage, seconds")
+    parser.add_argument("--storm-timeout", type=float, default=120)
+    parser.add_argument("-v", "--verbose", action="store_true", help="firmware logs")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Blocking CastV2 client, kept on the host as a baseline for bench_cast.py.
+
+The firmware only uses cast.AsyncChromecast. This client shares its session
+state and namespace handlers (cast.CastSession) and drives them from a plain
+blocking TLS socket, one frame per _pump(), so the two can be compared
+against the same fake receiver.
+"""
+
+import gc
+import os
+import socket
+import sys
+import time
+from struct import unpack_from
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import upy_host  # noqa: E402
+
+cast = upy_host.import_cast()
+
+
+class Chromecast(cast.CastSession):
+    """A class to handle Chromecast communication and media control."""
+
+    def __init__(self, cast_ip, cast_port, timeout_s=5):
+        cast.CastSession.__init__(self, cast_ip, cast_port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout_s)
+        self.s = None
+
+        try:
+            # Connect and wrap socket with SSL
+            self._sock.connect((self.ip, cast_port))
+            self.s = upy_host.wrap_socket(self._sock)
+
+            # Send initial CONNECT and GET_STATUS messages
+            self._send(cast._CONNECT)
+            self._send(cast._GET_STATUS)
+            self._status_requested = True
+
+            # After handshake, use shorter timeout for message polling
+            self._sock.settimeout(3)
+        except Exception:
+            self.disconnect()
+            raise
+
+    # --- Low-Level Socket Operations ---
+
+    def _send(self, data):
+        """Send all data on SSL sockets (handles partial writes)."""
+        mv = memoryview(data)
+        total = 0
+        while total < len(data):
+            n = self.s.write(mv[total:])
+            if n is None:
+                # Some MicroPython ports return None; treat as all written
+                break
+            total += n
+
+    def _read_into(self, mv):
+        """Fill mv completely from the socket (handles partial reads)."""
+        got = 0
+        n = len(mv)
+        while got < n:
+            k = self.s.readinto(mv[got:])
+            if not k:
+                self.closed = True
+                raise OSError("socket closed while reading")
+            got += k
+
+    def _drain(self, n):
+        """Discard n bytes from the socket, reusing the receive buffer."""
+        while n > 0:
+            k = min(n, cast._RX_SIZE)
+            self._read_into(self._rxv[:k])
+            n -= k
+
+    def _pump(self):
+        """Blocking twin of AsyncChromecast._pump(): header first, then dispatch."""
+        rx = self._rxv
+        self._read_into(rx[:4])
+        siz = unpack_from(">I", self._rx)[0]
+        if siz <= 0 or siz > cast._MAX_FRAME:
+            raise OSError("invalid cast frame size: %d" % siz)
+
+        got = min(siz, cast._HEAD_SIZE)
+        self._read_into(rx[:got])
+        src, _, ns, payload = cast._decode(rx[:got])
+        handler = None
+        if ns is not None:
+            handler = self._handler(ns)
+            if handler is None or siz > cast._RX_SIZE:
+                self._drain(siz - got)
+                return
+        elif siz > cast._RX_SIZE:
+            self._drain(siz - got)
+            return
+
+        if siz > got:
+            self._read_into(rx[got:siz])
+            src, _, ns, payload = cast._decode(rx[:siz])
+        if handler is None and ns is not None:
+            handler = self._handler(ns)
+        if handler is not None and src is not None and payload is not None:
+            handler(src, payload)
+
+    def _wait(self, done, timeout_ms):
+        """Pump frames until done() is true; False on timeout or close."""
+        start = self._ticks_ms()
+        while not done():
+            if self.closed or self._ticks_diff(self._ticks_ms(), start) >= timeout_ms:
+                return False
+            try:
+                self._pump()
+            except OSError:
+                time.sleep(0.3)  # Don't abort on a single socket timeout
+        return True
+
+    # --- Core Chromecast Methods ---
+
+    def play_url(self, url, volume=None, preload_s=None):
+        """Play audio from specified URL on the Chromecast.
+
+        Args:
+            url: The media URL to play, or a list of URLs to queue in order
+            volume: Optional volume level (0.0 to 1.0). If None, volume is not changed.
+            preload_s: For a list, seconds before an item ends to buffer the next
+        """
+        # 1. Reuse the Default Media Receiver if it is already running,
+        #    otherwise launch it and wait for the new session's transport ID
+        transport_id = self._running_transport_id()
+        if transport_id:
+            print("Default Media Receiver already running, skipping LAUNCH")
+        else:
+            self._send(cast._LAUNCH)
+            transport_id = self._wait_for_transport_id(timeout_ms=8000)
+        if not transport_id:
+            print("Error: Failed to get transport ID for new session.")
+            return False
+
+        # 2. Connect to the media session transport
+        self._send(cast._encode(cast._NS_CONN, cast._P_CONNECT, dest=transport_id))
+
+        # 3. Set volume AFTER app is running (before loading media)
+        if volume is not None:
+            self.set_volume(volume)
+            time.sleep(0.3)  # Let volume settle before loading media
+            print(f"Volume set to {volume} after app launch")
+
+        self._send(cast._encode(cast._NS_MEDIA, cast._P_MEDIA_STATUS, dest=transport_id))
+
+        # 4. Construct and send the LOAD (or QUEUE_LOAD) command
+        self.media_confirmed = False
+        self._start_queue(len(url) if isinstance(url, (list, tuple)) else 0)
+        self._send(cast._load_frame(url, transport_id, preload_s))
+
+        # 5. Wait for MEDIA_STATUS confirmation with timeout
+        return self._wait(lambda: self.media_confirmed, 8000)
+
+    def _running_transport_id(self, timeout_ms=2000):
+        if not self._status_requested:
+            self._send(cast._GET_STATUS)
+        self._status_requested = False
+        self._receiver_status = False
+        self.transport_id = None
+
+        if self._wait(lambda: self._receiver_status, timeout_ms):
+            return self.transport_id
+        return None  # No status yet; launching is the safe default
+
+    def _wait_for_transport_id(self, timeout_ms=4000):
+        if self._wait(lambda: self.transport_id, timeout_ms):
+            return self.transport_id
+        return None
+
+    def disconnect(self):
+        """Close the connection to the Chromecast device."""
+        try:
+            if self.s:
+                self.s.close()
+        finally:
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+        gc.collect()
@@ -0,0 +1,318 @@
+"""
+Host (CPython) stand-ins for the MicroPython modules the firmware imports,
+so the code in source/ can be exercised on Linux by the tools in this folder.
+
+Call install() before importing any firmware module, or install_device()
+for modules that also touch the board (mqtt.py and what it imports). Only
+the pieces the firmware actually touches are provided; this is not a
+MicroPython emulator.
+"""
+
+import asyncio
+import gc
+import json
+import os
+import socket
+import ssl
+import sys
+import time
+import types
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+
+# What gc.mem_free() reports; tools can lower it to exercise memory budgets
+heap_free = 110000
+
+_installed = False
+
+
+def _ticks_ms():
+    return int(time.monotonic() * 1000) & 0x3FFFFFFF
+
+
+def _ticks_us():
+    return int(time.monotonic() * 1000000) & 0x3FFFFFFF
+
+
+def _ticks_diff(a, b):
+    # Same wrap-around semantics as MicroPython's 30-bit ticks
+    return ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+
+def _ticks_add(a, delta):
+    return (a + delta) & 0x3FFFFFFF
+
+
+async def _stream_readinto(self, buf):
+    """MicroPython's Stream.readinto() on top of asyncio.StreamReader."""
+    data = await self.read(len(buf))
+    buf[: len(data)] = data
+    return len(data)
+
+
+def install():
+    """Register the MicroPython module aliases and patches (idempotent)."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    if SOURCE_DIR not in sys.path:
+        sys.path.insert(0, SOURCE_DIR)
+
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda x: x
+    sys.modules["micropython"] = micropython
+
+    utime = types.ModuleType("utime")
+    for name in ("time", "time_ns", "sleep", "gmtime", "localtime", "mktime"):
+        setattr(utime, name, getattr(time, name))
+    utime.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    utime.ticks_ms = _ticks_ms
+    utime.ticks_us = _ticks_us
+    utime.ticks_diff = _ticks_diff
+    utime.ticks_add = _ticks_add
+    sys.modules["utime"] = utime
+
+    sys.modules["usocket"] = socket
+    sys.modules["uasyncio"] = asyncio
+    asyncio.StreamReader.readinto = _stream_readinto
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    gc.mem_free = lambda: heap_free
+
+
+class _SSLSocket(object):
+    """MicroPython-style SSL socket (read/write/readinto) over CPython's.
+
+    CPython's wrap_socket() detaches the plain socket, while MicroPython's
+    leaves it usable (sync_cast.py keeps calling settimeout() on it), so the
+    TLS layer runs on a duplicate descriptor and follows the original's
+    timeout.
+    """
+
+    def __init__(self, raw, sock):
+        self._raw = raw
+        self._s = sock
+
+    def write(self, data):
+        self._s.settimeout(self._raw.gettimeout())
+        return self._s.send(data)
+
+    def read(self, n):
+        self._s.settimeout(self._raw.gettimeout())
+        return self._s.recv(n)
+
+    def readinto(self, buf):
+        self._s.settimeout(self._raw.gettimeout())
+        return self._s.recv_into(buf)
+
+    def fileno(self):
+        return self._s.fileno()
+
+    def close(self):
+        self._s.close()
+
+
+def wrap_socket(sock):
+    """MicroPython's ssl.wrap_socket() for tools/sync_cast.py: no certificate
+    checks, since Cast receivers present self-signed certificates."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    dup = socket.socket(fileno=os.dup(sock.fileno()))
+    return _SSLSocket(sock, ctx.wrap_socket(dup))
+
+
+def import_cast():
+    """Import source/cast.py with the MicroPython stand-ins installed."""
+    install()
+    import cast
+
+    return cast
+
+
+def self_signed_cert(directory):
+    """Create a throwaway self-signed certificate; returns (certfile, keyfile)."""
+    import subprocess
+
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "2", "-subj", "/CN=fake-cast",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+# --- Device stand-ins ---
+#
+# mqtt.py and the modules it imports also touch the board: NVS, pins and
+# timers, the WiFi interface, BLE and OTA. install_device() registers
+# in-memory versions of those so a whole MQTTHandler can run on the host.
+# They record state instead of driving hardware: timers never fire, and
+# machine.reset() raises Reset so a tool can tell a reboot happened.
+
+# network.WLAN().isconnected(); tools clear it to simulate a WiFi outage
+wifi_up = True
+
+# Every esp32.NVS namespace: (namespace, key) -> bytes or int
+nvs = {}
+
+_device_installed = False
+
+
+class Reset(Exception):
+    """Raised by machine.reset()."""
+
+
+class _NVS(object):
+    def __init__(self, namespace):
+        self._ns = namespace
+
+    def get_blob(self, key, buf):
+        value = nvs.get((self._ns, key))
+        if value is None:
+            raise OSError(-4354)  # ESP_ERR_NVS_NOT_FOUND
+        buf[: len(value)] = value
+        return len(value)
+
+    def set_blob(self, key, value):
+        nvs[(self._ns, key)] = value.encode() if isinstance(value, str) else bytes(value)
+
+    def get_i32(self, key):
+        value = nvs.get((self._ns, key))
+        if value is None:
+            raise OSError(-4354)
+        return value
+
+    def set_i32(self, key, value):
+        nvs[(self._ns, key)] = value
+
+    def erase_key(self, key):
+        if nvs.pop((self._ns, key), None) is None:
+            raise OSError(-4354)
+
+    def commit(self):
+        pass
+
+
+class _Pin(object):
+    IN = OUT = PULL_UP = IRQ_FALLING = 0
+
+    def __init__(self, *args, **kwargs):
+        self._value = 1
+
+    def value(self, *args):
+        if args:
+            self._value = args[0]
+        return self._value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, *args, **kwargs):
+        pass
+
+
+class _Timer(object):
+    PERIODIC = ONE_SHOT = 0
+
+    def __init__(self, *args):
+        pass
+
+    def init(self, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+
+class _WDT(object):
+    def __init__(self, **kwargs):
+        pass
+
+    def feed(self):
+        pass
+
+
+class _WLAN(object):
+    def __init__(self, *args):
+        pass
+
+    def isconnected(self):
+        return wifi_up
+
+    def active(self, *args):
+        return True
+
+    def connect(self, *args):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def config(self, *args, **kwargs):
+        return b"\x02\x00\x00\x00\x00\x01"
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+
+def _reset():
+    raise Reset()
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install_device():
+    """install() plus the board stand-ins above (idempotent)."""
+    global _device_installed
+    install()
+    if _device_installed:
+        return
+    _device_installed = True
+
+    _module("esp32", NVS=_NVS)
+    _module(
+        "machine",
+        Pin=_Pin,
+        Timer=_Timer,
+        WDT=_WDT,
+        reset=_reset,
+        unique_id=lambda: b"\x02\x00\x00\x00\x00\x01",
+    )
+    _module("network", WLAN=_WLAN, STA_IF=0, AP_IF=1)
+    _module("urequests")  # No blocking HTTP on the host: posts fail and are dropped
+    _module("ujson", **{k: getattr(json, k) for k in ("dumps", "loads", "dump", "load")})
+    _module("aioble")
+    _module("bluetooth", UUID=lambda x: x)
+    ota = _module("ota")
+    ota.update = _module("ota.update")
+    sys.print_exception = lambda e: print("%s: %s" % (type(e).__name__, e))
+
+
+def device_files(directory):
+    """Point the firmware's flash files (outbox, schedule, prayer table and
+    config) into directory instead of the host's /."""
+    import mqtt
+    import outbox
+    import prayer
+    import schedule
+
+    outbox.Outbox.__init__.__defaults__ = (os.path.join(directory, "outbox.bin"),)
+    schedule.Schedule.__init__.__defaults__ = (os.path.join(directory, "schedule.bin"),)
+    prayer.PrayerTable.__init__.__defaults__ = (os.path.join(directory, "prayer.bin"),)
+    mqtt._PRAYER_CONFIG = os.path.join(directory, "prayer.json")